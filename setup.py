@@ -57,5 +57,6 @@ setup(
     platforms = 'Linux',
     classifiers = classif,
     packages = ['treewatcher'],
-    install_requires = ["inotifyx>=0.1.1"]
+    extras_require = {'inotifyx': ["inotifyx>=0.1.1"],
+                      'scandir': ["scandir"]}
     )
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This script measures the events throughput and latency of a monitor for
+some events storms, in serial, threaded and multiprocessing modes.
+
+Each case (storm, mode, number of workers) runs in its own process, the
+storm being generated by a child process which records the time of each
+operation. For each case, we report :
+
+ - the number of events handled per second, from the start of the storm
+   to the last callback,
+ - the percentiles of the latency between an operation and its callback
+   (close_write for the files creations, delete and moved for the others),
+ - the CPU time of the monitor process and of its worker processes,
+ - the peak RSS of the monitor process and of its worker processes.
+
+Examples:
+=========
+
+$ ./benchmarks.py
+$ ./benchmarks.py --storms small_files,renames --modes threaded --workers 1,2,4,8
+$ ./benchmarks.py --files 20000 --json new.json --compare old.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import resource
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, EventsCallbacks, ThreadedEventsCallbacks, \
+                        MultiProcessingEventsCallbacks
+from scenarios import create_files_tree
+
+MODES = ('serial', 'threaded', 'multiprocessing')
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class _Recorder(object):
+    """
+    Record the (event name, path, time) of each callback call.
+    'moved' records the destination path.
+    """
+
+    def create(self, path, is_dir):
+        """ record """
+        self._record('create', path)
+
+
+    def delete(self, path, is_dir):
+        """ record """
+        self._record('delete', path)
+
+
+    def close_write(self, path, is_dir):
+        """ record """
+        self._record('close_write', path)
+
+
+    def moved(self, src, dst, is_dir):
+        """ record """
+        self._record('moved', dst)
+
+
+class SerialRecorder(EventsCallbacks, _Recorder):
+    """
+    Records in a list
+    """
+    def __init__(self):
+        """ init """
+        EventsCallbacks.__init__(self)
+        self.records = []
+
+
+    def _record(self, name, path):
+        """ list.append is atomic """
+        self.records.append((name, path, time.time()))
+
+
+    def collect(self):
+        """ Returns the records """
+        return self.records
+
+
+class ThreadedRecorder(ThreadedEventsCallbacks, SerialRecorder):
+    """
+    Records in a list, from the worker threads
+    """
+    def __init__(self):
+        """ init """
+        ThreadedEventsCallbacks.__init__(self)
+        self.records = []
+
+
+class MultiProcessingRecorder(MultiProcessingEventsCallbacks, _Recorder):
+    """
+    The worker processes send their records to the monitor process
+    """
+    def __init__(self):
+        """ init """
+        MultiProcessingEventsCallbacks.__init__(self)
+        self.records_queue = multiprocessing.Queue()
+        self.records = []
+
+
+    def _record(self, name, path):
+        """ send """
+        self.records_queue.put((name, path, time.time()))
+
+
+    def collect(self):
+        """ Returns the records received so far """
+        while not self.records_queue.empty():
+            self.records.append(self.records_queue.get())
+        return self.records
+
+
+RECORDERS = {
+  'serial': SerialRecorder,
+  'threaded': ThreadedRecorder,
+  'multiprocessing': MultiProcessingRecorder,
+}
+
+
+def _write_file(path):
+    """
+    Create a small file and returns the time it was created
+    """
+    now = time.time()
+    with open(path, 'w') as myfile:
+        myfile.write('x' * 64)
+    return now
+
+
+def _list_files(root):
+    """
+    Returns the files of the 'root' tree, sorted
+    """
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        files.extend(os.path.join(dirpath, name) for name in filenames)
+    return sorted(files)
+
+
+class Storm(object):
+    """
+    An events storm : 'setup' prepares the tree before it's monitored,
+    'run' generates the storm and returns {path: operation time} for the
+    'timed_event' events. The time is taken just before the operation.
+    """
+    timed_event = None
+
+    def __init__(self, root, files):
+        """ init """
+        self.root = root
+        self.files = files
+
+
+    def setup(self):
+        """ nothing by default """
+        pass
+
+
+    def expected(self):
+        """ number of timed events """
+        return self.files
+
+
+class SmallFilesStorm(Storm):
+    """
+    Many small files in one directory
+    """
+    timed_event = 'close_write'
+
+    def run(self):
+        """ create the files """
+        return dict((path, _write_file(path))
+                    for path in (os.path.join(self.root, 'file%06d' % i) for i in xrange(self.files)))
+
+
+class DeepTreeStorm(Storm):
+    """
+    A deep chain of directories, with some files in each of them
+    """
+    timed_event = 'close_write'
+    depth = 50
+
+    def expected(self):
+        """ the files are evenly spread """
+        return (self.files // self.depth) * self.depth
+
+
+    def run(self):
+        """ create the directories and their files """
+        times = {}
+        location = self.root
+        for level in xrange(self.depth):
+            location = os.path.join(location, 'level%02d' % level)
+            os.mkdir(location)
+            for i in xrange(self.files // self.depth):
+                path = os.path.join(location, 'file%06d' % i)
+                times[path] = _write_file(path)
+        return times
+
+
+class RenamesStorm(Storm):
+    """
+    A rename burst : every file of a tree is renamed in place
+    """
+    timed_event = 'moved'
+    dirs = 10
+
+    def expected(self):
+        """ the files are evenly spread """
+        return (self.files // self.dirs) * self.dirs
+
+
+    def setup(self):
+        """ the tree to rename """
+        create_files_tree(self.root, files_number=self.files // self.dirs, dirs_number=self.dirs)
+
+
+    def run(self):
+        """ rename the files """
+        times = {}
+        for path in _list_files(self.root):
+            times[path + '.renamed'] = time.time()
+            os.rename(path, path + '.renamed')
+        return times
+
+
+class DeletesStorm(RenamesStorm):
+    """
+    Every file of a tree is removed, then its directories
+    """
+    timed_event = 'delete'
+
+    def run(self):
+        """ remove the files and the directories """
+        times = {}
+        for path in _list_files(self.root):
+            times[path] = time.time()
+            os.remove(path)
+        for name in os.listdir(self.root):
+            os.rmdir(os.path.join(self.root, name))
+        return times
+
+
+STORMS = {
+  'small_files': SmallFilesStorm,
+  'deep_tree': DeepTreeStorm,
+  'renames': RenamesStorm,
+  'deletes': DeletesStorm,
+}
+
+
+def _generate(storm, connection):
+    """
+    Generator process : run the storm and send the operation times
+    """
+    start = time.time()
+    times = storm.run()
+    connection.send((start, times))
+    connection.close()
+
+
+def _process_usage(pid):
+    """
+    Returns the (CPU seconds, peak RSS in KB) of a worker process
+    """
+    with open('/proc/%d/stat' % pid) as stat_file:
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(_CLOCK_TICKS)
+    peak_rss = 0
+    with open('/proc/%d/status' % pid) as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1])
+    return cpu, peak_rss
+
+
+def _percentile(values, percent):
+    """
+    Returns the 'percent' percentile of the sorted 'values'
+    """
+    if not values:
+        return None
+    index = min(int(round(percent / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def run_case(storm_name, mode, workers, options):
+    """
+    Run one case in the current process and returns its results
+    """
+    root = tempfile.mkdtemp(prefix='treewatcher_bench_', dir=options.tmpdir)
+    try:
+        storm = STORMS[storm_name](root, options.files)
+        storm.setup()
+        callbacks = RECORDERS[mode]()
+        stm = choose_source_tree_monitor(options.stm)
+        stm.set_events_callbacks(callbacks)
+        if mode != 'serial':
+            stm.set_workers_number(workers)
+        stm.start()
+        try:
+            stm.add_source_dir(root)
+            # the worker processes are started by the first call
+            stm.process_events(timeout=0.01)
+
+            expected = storm.expected()
+            timed_event = storm.timed_event
+            # the records already checked by done, and the paths seen
+            checked = [ 0 ]
+            seen = set()
+
+            def done():
+                """ all the timed events have been handled """
+                records = callbacks.collect()
+                for record in records[checked[0]:]:
+                    if record[0] == timed_event:
+                        seen.add(record[1])
+                checked[0] = len(records)
+                return len(seen) >= expected
+
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu = usage.ru_utime + usage.ru_stime
+            receiver, sender = multiprocessing.Pipe(False)
+            generator = multiprocessing.Process(target=_generate, args=(storm, sender))
+            generator.start()
+            stm.process_events(timeout=options.timeout, until_predicate=done, sleep_delay=0.01)
+            start, times = receiver.recv()
+            generator.join()
+
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu = usage.ru_utime + usage.ru_stime - cpu
+            peak_rss = usage.ru_maxrss
+            workers_peak_rss = 0
+            for process in stm._worker_processes:
+                worker_cpu, worker_peak_rss = _process_usage(process.pid)
+                cpu += worker_cpu
+                workers_peak_rss = max(workers_peak_rss, worker_peak_rss)
+            records = callbacks.collect()
+        finally:
+            stm.stop()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    # the first callback of each path : a file created in a new directory
+    # can be reported both by the crawl of the directory and by inotify
+    callback_times = {}
+    for name, path, callback_time in records:
+        if name == timed_event and path in times and path not in callback_times:
+            callback_times[path] = callback_time
+    latencies = sorted(callback_time - times[path] for path, callback_time in callback_times.iteritems())
+    seconds = max(record[2] for record in records) - start if records else None
+    return {
+      'storm': storm_name,
+      'mode': mode,
+      'workers': workers,
+      'events': len(records),
+      'seconds': seconds,
+      'events_per_second': len(records) / seconds if seconds else None,
+      'missing': expected - len(latencies),
+      'latency': dict(('p%d' % percent, _percentile(latencies, percent)) for percent in (50, 90, 99, 100)),
+      'cpu_seconds': cpu,
+      'peak_rss_kb': peak_rss,
+      'workers_peak_rss_kb': workers_peak_rss,
+    }
+
+
+def _run_case_process(storm_name, mode, workers, options, connection):
+    """
+    Process running one case
+    """
+    connection.send(run_case(storm_name, mode, workers, options))
+    connection.close()
+
+
+def run_cases(options):
+    """
+    Run each case in its own process, for a clean peak RSS
+    """
+    results = []
+    for storm_name in options.storms:
+        for mode in options.modes:
+            for workers in ((1,) if mode == 'serial' else options.workers):
+                receiver, sender = multiprocessing.Pipe(False)
+                process = multiprocessing.Process(target=_run_case_process,
+                                                  args=(storm_name, mode, workers, options, sender))
+                process.start()
+                result = receiver.recv()
+                process.join()
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def _case_key(result):
+    """ identify a case across runs """
+    return (result['storm'], result['mode'], result['workers'])
+
+
+def print_result(result, reference=None):
+    """
+    One line per case. With a 'reference' result, the throughput change is shown.
+    """
+    latency = result['latency']
+
+    def milliseconds(value):
+        """ format a latency """
+        if value is None:
+            return '-'
+        return '%.2f' % (value * 1000)
+
+    line = '%-12s %-16s %2d workers : %8.0f events/s  latency ms p50 %s p90 %s p99 %s max %s  ' \
+           'cpu %.2fs  rss %d KB (workers %d KB)' % \
+           (result['storm'], result['mode'], result['workers'], result['events_per_second'] or 0,
+            milliseconds(latency['p50']), milliseconds(latency['p90']), milliseconds(latency['p99']),
+            milliseconds(latency['p100']), result['cpu_seconds'], result['peak_rss_kb'],
+            result['workers_peak_rss_kb'])
+    if result['missing']:
+        line += '  %d events missing' % result['missing']
+    if reference is not None and reference['events_per_second'] and result['events_per_second']:
+        change = result['events_per_second'] / reference['events_per_second'] - 1
+        line += '  %+.1f%%' % (change * 100)
+    print line
+
+
+def main():
+    """ Main function """
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--storms', default=','.join(sorted(STORMS)),
+                      help='comma separated storms among %s' % ', '.join(sorted(STORMS)))
+    parser.add_option('--modes', default=','.join(MODES), help='comma separated modes among %s' % ', '.join(MODES))
+    parser.add_option('--workers', default='1,2,4', help='comma separated numbers of workers (threaded and '
+                                                         'multiprocessing modes)')
+    parser.add_option('--files', type='int', default=2000, help='number of files of each storm')
+    parser.add_option('--stm', default=None, help='source tree monitor name (see SOURCE_TREE_MONITORS)')
+    parser.add_option('--timeout', type='float', default=60, help='maximum duration of a case in seconds')
+    parser.add_option('--tmpdir', default=None, help='where to create the trees')
+    parser.add_option('--json', dest='json_file', default=None, help='write the results in this file')
+    parser.add_option('--compare', default=None, help='compare the throughput with the results of this file')
+    (options, args) = parser.parse_args()
+
+    options.storms = options.storms.split(',')
+    options.modes = options.modes.split(',')
+    options.workers = [ int(workers) for workers in options.workers.split(',') ]
+    for storm_name in options.storms:
+        if storm_name not in STORMS:
+            parser.error('unknown storm %r' % storm_name)
+    for mode in options.modes:
+        if mode not in MODES:
+            parser.error('unknown mode %r' % mode)
+
+    results = run_cases(options)
+
+    if options.compare:
+        with open(options.compare) as compare_file:
+            references = dict((_case_key(result), result) for result in json.load(compare_file)['results'])
+        print
+        print 'compared to %s :' % options.compare
+        for result in results:
+            print_result(result, references.get(_case_key(result)))
+
+    if options.json_file:
+        run = {
+          'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+          'python': platform.python_version(),
+          'platform': platform.platform(),
+          'cpus': multiprocessing.cpu_count(),
+          'files': options.files,
+          'stm': options.stm,
+        }
+        with open(options.json_file, 'w') as json_file:
+            json.dump({'run': run, 'results': results}, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
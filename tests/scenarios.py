@@ -138,16 +138,20 @@ class TestTreeWatcher(unittest.TestCase):
     and check if we've got the rigght number of inotify events
     """
 
-    def setup_helper(self, callbacks, workers=1):
+    def setup_helper(self, callbacks, workers=1, batching=False, partitioned=False, queue_bound=None,
+                     stm_name=None):
         """
         Helper that set the state of the treewatcher.
         It avoids a lot of copy and paste between test files
         """
         self.test_dir = tempfile.mkdtemp()
-        self.stm = choose_source_tree_monitor()
+        self.stm = choose_source_tree_monitor(stm_name)
         self.callbacks = callbacks
         self.stm.set_events_callbacks(self.callbacks)
         self.stm.set_workers_number(workers)
+        self.stm.set_events_batching(batching)
+        self.stm.set_events_partitioning(partitioned)
+        self.stm.set_events_queue_bound(queue_bound)
         self.stm.start()
         self.stm.add_source_dir(self.test_dir)
 
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the asyncio front-end.
+
+The monitor is driven by a stub event loop : we call the reader and
+the timers it registered ourself.
+"""
+
+import os
+import sys
+import time
+import heapq
+import select
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, _inotify
+from treewatcher.budget import BUDGET_POLL
+from treewatcher.asyncio_ import asyncio, AsyncioSourceTreeMonitor, AsyncioEventsCallbacks
+from scenarios import create_files, create_files_tree
+
+
+class StubHandle(object):
+    """
+    What call_soon and call_later return
+    """
+    def __init__(self, when, callback, args):
+        """ init """
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        """ cancel """
+        self.cancelled = True
+
+
+    def __lt__(self, other):
+        """ ordered by time """
+        return self.when < other.when
+
+
+class StubLoop(object):
+    """
+    The part of the event loop API used by the front-end
+    """
+    def __init__(self):
+        """ init """
+        self.readers = {}
+        self.timers = []
+
+
+    def get_debug(self):
+        """ used by the futures """
+        return False
+
+
+    def call_exception_handler(self, context):
+        """ used by the futures whose exception was never retrieved """
+        pass
+
+
+    def add_reader(self, fd, callback, *args):
+        """ register """
+        self.readers[fd] = (callback, args)
+
+
+    def remove_reader(self, fd):
+        """ unregister """
+        return self.readers.pop(fd, None) is not None
+
+
+    def call_later(self, delay, callback, *args):
+        """ schedule """
+        handle = StubHandle(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, handle)
+        return handle
+
+
+    def call_soon(self, callback, *args):
+        """ schedule """
+        return self.call_later(0, callback, *args)
+
+
+    def create_task(self, coro):
+        """ used to schedule the coroutine callbacks """
+        return asyncio.Task(coro, loop=self)
+
+
+    def run_until(self, predicate, timeout):
+        """
+        Call the readers and the timers until predicate() is true, or
+        'timeout' seconds elapsed
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            while self.timers and self.timers[0].when <= now:
+                handle = heapq.heappop(self.timers)
+                if not handle.cancelled:
+                    handle.callback(*handle.args)
+            if predicate() or now >= deadline:
+                return
+            wait = deadline - now
+            if self.timers:
+                wait = max(min(wait, self.timers[0].when - now), 0)
+            readable, _, _ = select.select(self.readers.keys(), [], [], wait)
+            for fd in readable:
+                if fd in self.readers:
+                    callback, args = self.readers[fd]
+                    callback(*args)
+
+
+class RecordingCallbacks(AsyncioEventsCallbacks):
+    """
+    We keep the events, using a coroutine for the close_write ones
+    """
+    def __init__(self):
+        """ init """
+        AsyncioEventsCallbacks.__init__(self)
+        self.created = []
+        self.written = []
+
+
+    def create(self, path, is_dir):
+        """ record """
+        self.created.append(path)
+
+
+    def close_write(self, path, is_dir):
+        """ record, later """
+        return self._close_write(path)
+
+
+    if asyncio is not None:
+        @asyncio.coroutine
+        def _close_write(self, path):
+            """ coroutine callback """
+            self.written.append(path)
+
+
+class TestAsyncioMonitor(unittest.TestCase):
+    """
+    We watch a directory from a stub event loop
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        if asyncio is None:
+            self.skipTest('asyncio or trollius is needed')
+        self.test_dir = tempfile.mkdtemp()
+        self.loop = StubLoop()
+        self.callbacks = RecordingCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.monitor = AsyncioSourceTreeMonitor(self.stm, self.loop)
+        self.monitor.set_events_callbacks(self.callbacks)
+        self.stopped = False
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        if not self.stopped:
+            self.monitor.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def _start(self):
+        """
+        Start the monitor and watch test_dir
+        """
+        self.monitor.start()
+        self.monitor.add_source_dir(self.test_dir)
+
+
+    def test_register(self):
+        """
+        Test: the monitor is registered in the loop until it's stopped
+        """
+        self._start()
+        self.assertEqual(self.loop.readers.keys(), [ self.stm.fileno() ])
+        stream = self.monitor.events()
+        self.monitor.stop()
+        self.stopped = True
+        self.assertEqual(self.loop.readers, {})
+        self.assertRaises(StopIteration, stream.get().result)
+
+
+    def test_delivery(self):
+        """
+        Test: the callbacks and every stream get the events
+        """
+        self._start()
+        streams = [ self.monitor.events(), self.monitor.events() ]
+        create_files(self.test_dir, files_number=10)
+        self.loop.run_until(lambda: len(self.callbacks.written) == 10, 2)
+        self.assertEqual(len(self.callbacks.created), 10)
+        self.assertEqual(sorted(self.callbacks.written), sorted(self.callbacks.created))
+        for stream in streams:
+            events = [ stream.get().result() for _ in range(20) ]
+            self.assertEqual(sorted(path for name, path, is_dir in events if name == 'create'),
+                             sorted(self.callbacks.created))
+            self.assertFalse(stream.get().done())
+
+
+    def test_bounded_queue(self):
+        """
+        Test: the events of a full bounded queue are dispatched by the front-end
+        """
+        self.stm.set_events_queue_bound(3)
+        self._start()
+        stream = self.monitor.events()
+        create_files(self.test_dir, files_number=20)
+        self.loop.run_until(lambda: len(self.callbacks.written) == 20, 2)
+        self.assertEqual(len(self.callbacks.created), 20)
+        self.assertEqual(sorted(self.callbacks.written), sorted(self.callbacks.created))
+        events = [ stream.get().result() for _ in range(40) ]
+        self.assertEqual(sorted(path for name, path, is_dir in events if name == 'close_write'),
+                         sorted(self.callbacks.created))
+        self.assertTrue(self.stm.queue_counters['blocked'] > 0)
+
+
+    def test_waiting_stream(self):
+        """
+        Test: a future waiting for an event gets the next one
+        """
+        self._start()
+        future = self.monitor.events().get()
+        path = os.path.join(self.test_dir, 'file')
+        os.mkdir(path)
+        self.loop.run_until(future.done, 2)
+        self.assertEqual(future.result(), ('create', path, True))
+
+
+
+    def test_coalescing(self):
+        """
+        Test: the events held by the coalescing stage are reported once the path is quiet
+        """
+        self.stm.set_events_coalescing(0.1)
+        self._start()
+        path = os.path.join(self.test_dir, 'file')
+        with open(path, 'w') as myfile:
+            myfile.write('data')
+        start = time.time()
+        self.loop.run_until(lambda: self.callbacks.written, 2)
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(self.callbacks.created, [ path ])
+        self.assertEqual(self.callbacks.written, [ path ])
+        self.assertEqual(self.stm.stats()['coalescing']['pending'], 0)
+
+
+
+    def test_add_source_dir_crawl(self):
+        """
+        Test: an existing tree is crawled incrementally from the event loop
+        """
+        create_files_tree(self.test_dir, files_number=2, dirs_number=5, sublevels=3)
+        self.stm.set_crawl_step(1)
+        self.monitor.start()
+        # nothing to do yet
+        self.loop.run_until(lambda: False, 0.1)
+        self.monitor.add_source_dir(self.test_dir)
+        self.assertEqual(len(self.stm.watches), 1)
+        self.loop.run_until(lambda: not self.stm.pending_crawls, 2)
+        self.assertEqual(len(self.stm.watches), 1 + 3 * 6)
+
+
+    def test_new_tree_crawl(self):
+        """
+        Test: the content of a tree moved in is reported, even if it's crawled incrementally
+        """
+        self.stm.set_crawl_step(1)
+        self._start()
+        # the crawl of test_dir reports nothing
+        self.loop.run_until(lambda: not self.stm.pending_crawls, 2)
+        tree = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tree, 'a/b/c'))
+        open(os.path.join(tree, 'a/b/c/file'), 'w').close()
+        os.rename(tree, os.path.join(self.test_dir, 'tree'))
+        path = os.path.join(self.test_dir, 'tree/a/b/c/file')
+        self.loop.run_until(lambda: self.callbacks.written, 2)
+        self.assertEqual(self.callbacks.written, [ path ])
+        self.assertEqual(self.callbacks.created, [ os.path.join(self.test_dir, 'tree/a'),
+                                                   os.path.join(self.test_dir, 'tree/a/b'),
+                                                   os.path.join(self.test_dir, 'tree/a/b/c'),
+                                                   path ])
+        self.assertEqual(len(self.stm.watches), 5)
+
+
+    def test_overflow_resync(self):
+        """
+        Test: the trees are rescanned from the event loop after an overflow
+        """
+        self.stm.set_overflow_resync()
+        self._start()
+        path = os.path.join(self.test_dir, 'file')
+        open(path, 'w').close()
+        # the events are lost, and the next read tells it
+        _inotify.get_events(self.stm.inotify_fd, 0)
+        self.stm._process_event(_inotify.InotifyEvent(-1, _inotify.IN_Q_OVERFLOW, 0, None))
+        self.monitor._on_readable()
+        self.loop.run_until(lambda: self.callbacks.written, 2)
+        self.assertEqual(self.callbacks.created, [ path ])
+        self.assertEqual(self.callbacks.written, [ path ])
+        self.assertEqual(list(self.stm.pending_rescans), [])
+
+
+    def test_budget_poll(self):
+        """
+        Test: the subtrees over the watches budget are polled from the event loop
+        """
+        os.mkdir(os.path.join(self.test_dir, 'sub'))
+        self.stm.set_watch_budget(max_watches=1, policy=BUDGET_POLL, poll_interval=0.1)
+        self._start()
+        self.assertEqual(self.stm.polled_dirs, set([ os.path.join(self.test_dir, 'sub') ]))
+        path = os.path.join(self.test_dir, 'sub/file')
+        open(path, 'w').close()
+        self.loop.run_until(lambda: self.callbacks.written, 2)
+        self.assertEqual(self.callbacks.created, [ path ])
+        self.assertEqual(self.callbacks.written, [ path ])
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestAsyncioMonitor" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the inotify watches budget.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, WatchBudgetExhausted
+from treewatcher.budget import BUDGET_SKIP, BUDGET_POLL, read_inotify_limits, count_user_watches
+from test_snapshot import RecordingEventsCallbacks
+
+
+class TestWatchBudget(unittest.TestCase):
+    """
+    We add a tree of 1 + 2 + 4 directories to a monitor
+    with a small budget.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        for path in ('a/c', 'a/d', 'b/e', 'b/build'):
+            os.makedirs(os.path.join(self.test_dir, path))
+        self.callbacks = RecordingEventsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.start()
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_limits(self):
+        """
+        Test: the kernel limits are known, and our watches are counted
+        """
+        self.assertTrue(read_inotify_limits()['max_user_watches'] > 0)
+        headroom = self.stm.watch_headroom()
+        self.stm.add_source_dir(self.test_dir)
+        self.assertEqual(self.stm.watch_headroom(), headroom - 7)
+        self.assertTrue(count_user_watches() >= 7)
+
+
+    def test_raise(self):
+        """
+        Test: the default policy raises WatchBudgetExhausted
+        """
+        self.stm.set_watch_budget(max_watches=3)
+        self.assertRaises(WatchBudgetExhausted, self.stm.add_source_dir, self.test_dir)
+        self.assertEqual(self.stm.watch_headroom(), 0)
+
+
+    def test_skip(self):
+        """
+        Test: the shallow directories are watched first
+        """
+        self.stm.set_watch_budget(max_watches=3, policy=BUDGET_SKIP)
+        self.stm.add_source_dir(self.test_dir)
+        self.assertEqual(sorted(self.stm.watches.paths()),
+                         [ self.test_dir ] + [ os.path.join(self.test_dir, name) for name in ('a', 'b') ])
+        self.assertEqual(self.stm.unwatched_dirs, 4)
+
+
+    def test_skip_patterns(self):
+        """
+        Test: the skipped directories do not use the budget
+        """
+        self.stm.set_watch_budget(max_watches=6, skip_patterns=('build',))
+        self.stm.add_source_dir(self.test_dir)
+        self.assertEqual(len(self.stm.watches), 6)
+        self.assertFalse(os.path.join(self.test_dir, 'b/build') in self.stm.watches)
+
+
+    def test_poll(self):
+        """
+        Test: the subtrees which cannot be watched are polled
+        """
+        self.stm.set_watch_budget(max_watches=3, policy=BUDGET_POLL, poll_interval=0.1)
+        self.stm.add_source_dir(self.test_dir)
+        self.assertEqual(len(self.stm.polled_dirs), 4)
+        self.stm.process_events(timeout=0.2)
+        self.assertEqual(self.callbacks.created, [])
+
+        path = os.path.join(self.test_dir, 'a/c/file')
+        open(path, 'w').close()
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.written)
+        self.assertEqual(self.callbacks.created, [ path ])
+        self.assertEqual(self.callbacks.written, [ path ])
+
+
+    def test_slow_poll(self):
+        """
+        Test: a polled subtree is not rescanned again while its rescan is pending
+        """
+        self.stm.set_watch_budget(max_watches=3, policy=BUDGET_POLL, poll_interval=0)
+        self.stm.add_source_dir(self.test_dir)
+        for _ in range(3):
+            self.stm._poll_due()
+        self.assertEqual(len(self.stm.pending_rescans), 4)
+        self.stm._continue_rescans()
+        self.assertEqual(len(self.stm.pending_rescans), 0)
+        self.stm._poll_due()
+        self.assertEqual(len(self.stm.pending_rescans), 4)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestWatchBudget", ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the events coalescing stage.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, EVENTS_NAMES, EVENT_CREATE, EVENT_DELETE, \
+                        EVENT_CLOSE_WRITE, EVENT_MODIFY, EVENT_ATTRIB, EVENT_MOVED
+from treewatcher.coalescing import EventsCoalescer
+from test_events_mask import AttribEventsCallbacks
+
+
+class TestMerge(unittest.TestCase):
+    """
+    We feed a coalescer and check the merged events
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.events = []
+        self.coalescer = EventsCoalescer(0, self._emit)
+
+
+    def _emit(self, code, path, is_dir):
+        """ record the events as (name, path) """
+        self.events.append((EVENTS_NAMES[code], path))
+
+
+    def _merged(self, codes, path='/a'):
+        """
+        Returns the events reported for the 'codes' events of 'path'
+        """
+        for code in codes:
+            self.coalescer.add(code, path, False)
+        self.coalescer.report_all()
+        return self.events
+
+
+    def test_copy(self):
+        """
+        Test: a copied file is created and written once
+        """
+        self.assertEqual(self._merged([ EVENT_CREATE, EVENT_ATTRIB, EVENT_MODIFY, EVENT_MODIFY,
+                                        EVENT_CLOSE_WRITE ]),
+                         [ ('create', '/a'), ('close_write', '/a') ])
+
+
+    def test_temporary(self):
+        """
+        Test: nothing for a file created and deleted
+        """
+        self.assertEqual(self._merged([ EVENT_CREATE, EVENT_CLOSE_WRITE, EVENT_DELETE ]), [])
+        self.assertEqual(len(self.coalescer), 0)
+
+
+    def test_existing(self):
+        """
+        Test: the events of an existing file
+        """
+        self.assertEqual(self._merged([ EVENT_MODIFY, EVENT_ATTRIB, EVENT_MODIFY, EVENT_CLOSE_WRITE,
+                                        EVENT_ATTRIB ]),
+                         [ ('attrib', '/a'), ('close_write', '/a') ])
+        self.events = []
+        self.assertEqual(self._merged([ EVENT_MODIFY, EVENT_CLOSE_WRITE, EVENT_DELETE ]), [ ('delete', '/a') ])
+
+
+    def test_ready(self):
+        """
+        Test: a replaced file is deleted then ready
+        """
+        self.coalescer.ready = True
+        self.assertEqual(self._merged([ EVENT_DELETE, EVENT_CREATE, EVENT_MODIFY, EVENT_CLOSE_WRITE ]),
+                         [ ('delete', '/a'), ('ready', '/a') ])
+
+
+    def test_moved(self):
+        """
+        Test: the pending events of a moved path are reported before the move
+        """
+        self.coalescer.add(EVENT_CREATE, '/a', False)
+        self.coalescer.add(EVENT_CREATE, '/c', False)
+        self.coalescer.add(EVENT_MOVED, ('/a', '/b'), False)
+        self.assertEqual(self.events, [ ('create', '/a'), ('moved', ('/a', '/b')) ])
+        self.assertEqual(list(self.coalescer.pending), [ '/c' ])
+
+
+    def test_moved_dir(self):
+        """
+        Test: the pending events under a moved directory are kept under its new path
+        """
+        self.coalescer.quiet = 60
+        self.coalescer.add(EVENT_CREATE, '/tmp/f', False)
+        self.coalescer.add(EVENT_CLOSE_WRITE, '/tmp/f', False)
+        self.coalescer.add(EVENT_CREATE, '/tmpfile', False)
+        self.coalescer.add(EVENT_MODIFY, '/pub/old', False)
+        self.coalescer.add(EVENT_MOVED, ('/tmp', '/pub'), True)
+        self.assertEqual(self.events, [ ('modify', '/pub/old'), ('moved', ('/tmp', '/pub')) ])
+        self.assertEqual(list(self.coalescer.pending), [ '/pub/f', '/tmpfile' ])
+        self.events = []
+        self.coalescer.report_all()
+        self.assertEqual(self.events, [ ('create', '/pub/f'), ('close_write', '/pub/f'),
+                                        ('create', '/tmpfile') ])
+
+
+    def test_deadlines(self):
+        """
+        Test: the paths are kept in deadline order
+        """
+        self.coalescer.quiet = 60
+        for path in ('/a', '/b', '/a'):
+            self.coalescer.add(EVENT_MODIFY, path, False)
+        self.assertEqual(list(self.coalescer.pending), [ '/b', '/a' ])
+        self.coalescer.report_due()
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.coalescer.merged, 1)
+
+
+class TestCoalescedTreeWatcher(unittest.TestCase):
+    """
+    We write a file several times and check the callbacks calls
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'file')
+        self.stm = choose_source_tree_monitor()
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def _write(self, callbacks, until_predicate):
+        """
+        Write a file in 3 times, then process the events
+        """
+        self.stm.set_events_callbacks(callbacks)
+        self.stm.set_events_coalescing(0.1)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        with open(self.path, 'w') as myfile:
+            for _ in range(3):
+                myfile.write('data')
+                myfile.flush()
+        os.chmod(self.path, 0600)
+        with open(self.path, 'a') as myfile:
+            myfile.write('more data')
+        self.stm.process_events(timeout=2, until_predicate=until_predicate)
+
+
+    def test_write(self):
+        """
+        Test: one create and one close_write
+        """
+        callbacks = CoalescedEventsCallbacks()
+        self._write(callbacks, lambda: callbacks.written)
+        self.assertEqual(callbacks.created, [ self.path ])
+        self.assertEqual(callbacks.written, [ self.path ])
+        self.assertEqual(callbacks.modified, [])
+        self.assertEqual(callbacks.attributes, [])
+        self.assertEqual(self.stm.stats()['coalescing']['pending'], 0)
+
+
+    def test_ready(self):
+        """
+        Test: a single ready event
+        """
+        callbacks = ReadyEventsCallbacks()
+        self._write(callbacks, lambda: callbacks.ready_paths)
+        self.assertEqual(callbacks.ready_paths, [ self.path ])
+        self.assertEqual(callbacks.created, [])
+        self.assertEqual(callbacks.written, [])
+
+
+    def test_publish(self):
+        """
+        Test: a file written in a directory published by a rename is ready under its new path
+        """
+        callbacks = ReadyEventsCallbacks()
+        self.stm.set_events_callbacks(callbacks)
+        self.stm.set_events_coalescing(0.3)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        os.mkdir(os.path.join(self.test_dir, 'tmp'))
+        self.stm.process_events(timeout=0.5, until_predicate=lambda: callbacks.created)
+        with open(os.path.join(self.test_dir, 'tmp/f'), 'w') as myfile:
+            myfile.write('data')
+        os.rename(os.path.join(self.test_dir, 'tmp'), os.path.join(self.test_dir, 'pub'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: callbacks.ready_paths)
+        self.assertEqual(callbacks.moves, [ (os.path.join(self.test_dir, 'tmp'),
+                                             os.path.join(self.test_dir, 'pub')) ])
+        self.assertEqual(callbacks.ready_paths, [ os.path.join(self.test_dir, 'pub/f') ])
+
+
+class CoalescedEventsCallbacks(AttribEventsCallbacks):
+    """
+    We also keep the create and close_write events
+    """
+    def __init__(self):
+        """ init """
+        AttribEventsCallbacks.__init__(self)
+        self.created = []
+        self.written = []
+
+
+    def create(self, path, is_dir):
+        """ record """
+        self.created.append(path)
+
+
+    def close_write(self, path, is_dir):
+        """ record """
+        self.written.append(path)
+
+
+class ReadyEventsCallbacks(CoalescedEventsCallbacks):
+    """
+    We ask for the ready events
+    """
+    def __init__(self):
+        """ init """
+        CoalescedEventsCallbacks.__init__(self)
+        self.ready_paths = []
+        self.moves = []
+
+
+    def ready(self, path, is_dir):
+        """ record """
+        self.ready_paths.append(path)
+
+
+    def moved(self, src, dst, is_dir):
+        """ record """
+        self.moves.append((src, dst))
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestMerge", "TestCoalescedTreeWatcher" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
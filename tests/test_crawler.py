@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the tree crawler used by add_source_dir.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, EventsCallbacks
+from treewatcher.crawler import TreeCrawler
+from scenarios import create_files_tree, create_files
+
+
+class TestTreeCrawler(unittest.TestCase):
+    """
+    We crawl an existing tree and check that every directory
+    and every entry has been seen.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create a tree of 1 + 3 * (1 + 20) directories and 3 * 20 * 5 files
+        """
+        self.test_dir = tempfile.mkdtemp()
+        create_files_tree(self.test_dir, files_number=5, dirs_number=20, sublevels=3)
+        self.watched = []
+        self.entries = []
+        self.progress = []
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        shutil.rmtree(self.test_dir)
+
+
+    def _watch_dir(self, path):
+        """
+        watch_dir callback
+        """
+        self.watched.append(path)
+        return True
+
+
+    def _on_entry(self, path, is_dir):
+        """
+        on_entry callback
+        """
+        self.entries.append((path, is_dir))
+
+
+    def _check(self, crawler):
+        """
+        Crawl our tree and check what we've got
+        """
+        crawler.progress_callback = lambda *args: self.progress.append(args)
+        crawler.progress_every = 10
+        dirs = crawler.crawl(self.test_dir, self._watch_dir, self._on_entry)
+        crawler.close()
+
+        self.assertEqual(dirs, 64)
+        self.assertEqual(len(self.watched), 64)
+        self.assertEqual(len(set(self.watched)), 64)
+        self.assertEqual(len([ e for e in self.entries if e[1] ]), 63)
+        self.assertEqual(len([ e for e in self.entries if not e[1] ]), 300)
+        # a directory is always reported before being watched
+        reported = [ path for path, is_dir in self.entries if is_dir ]
+        self.assertEqual(reported, self.watched[1:])
+        self.assertEqual(self.progress[-1], (self.test_dir, 64, 363, True))
+        self.assertEqual(len(self.progress), 7)
+
+
+    def test_serial(self):
+        """
+        Test: crawl using the calling thread only
+        """
+        self._check(TreeCrawler())
+
+
+    def test_parallel(self):
+        """
+        Test: crawl using 4 threads
+        """
+        self._check(TreeCrawler(workers=4))
+
+
+    def test_step(self):
+        """
+        Test: crawl 10 directories at a time
+        """
+        crawl = TreeCrawler().start_crawl(self.test_dir, self._watch_dir, self._on_entry)
+        steps = 1
+        while not crawl.step(10):
+            self.assertEqual(crawl.dirs, 10 * steps)
+            steps += 1
+        self.assertEqual(steps, 7)
+        self.assertEqual(len(self.watched), 64)
+        self.assertEqual(len(self.entries), 363)
+
+
+    def test_small_frontier(self):
+        """
+        Test: the frontier stays small when we go depth first
+        """
+        for i in range(30):
+            create_files(tempfile.mkdtemp(dir=self.test_dir), dirs_number=30)
+        biggest = {}
+        for max_frontier in (5, 100000):
+            crawl = TreeCrawler(max_frontier=max_frontier).start_crawl(self.test_dir, self._watch_dir)
+            biggest[max_frontier] = 0
+            while not crawl.step(1):
+                biggest[max_frontier] = max(biggest[max_frontier], len(crawl.frontier))
+        # breadth first, we hold the 900 directories of the second level at some point
+        self.assertTrue(biggest[100000] > 900, biggest)
+        self.assertEqual(biggest[5], 5)
+
+
+    def test_wide_tree(self):
+        """
+        Test: the frontier never holds more than max_frontier directories,
+        even when a single directory has many more subdirs
+        """
+        wide = os.path.join(self.test_dir, 'wide')
+        os.mkdir(wide)
+        for i in range(20):
+            create_files(tempfile.mkdtemp(dir=wide), dirs_number=100)
+        for workers in (1, 4):
+            self.watched = []
+            self.entries = []
+            crawler = TreeCrawler(workers=workers, max_frontier=10)
+            crawl = crawler.start_crawl(self.test_dir, self._watch_dir, self._on_entry)
+            biggest = biggest_listings = 0
+            while not crawl.step(1):
+                biggest = max(biggest, len(crawl.frontier))
+                biggest_listings = max(biggest_listings, len(crawl.listings))
+            crawler.close()
+            self.assertTrue(biggest <= 10, biggest)
+            # one listing kept aside per level of the tree, at most
+            self.assertTrue(biggest_listings <= 4, biggest_listings)
+            self.assertEqual(len(self.watched), 64 + 1 + 20 * 101)
+            self.assertEqual(len(set(self.watched)), len(self.watched))
+            self.assertEqual(len(self.entries), 363 + 1 + 20 * 101)
+            reported = [ path for path, is_dir in self.entries if is_dir ]
+            self.assertEqual(reported, self.watched[1:])
+
+
+    def test_deep_tree(self):
+        """
+        Test: a tree deeper than the python recursion limit
+        """
+        path = self.test_dir
+        for _ in range(sys.getrecursionlimit() + 100):
+            path = os.path.join(path, 'd')
+            os.mkdir(path)
+        try:
+            TreeCrawler().crawl(self.test_dir, self._watch_dir, self._on_entry)
+            self.assertEqual(len(self.watched), 64 + sys.getrecursionlimit() + 100)
+        finally:
+            # shutil.rmtree is recursive too
+            while path != self.test_dir:
+                os.rmdir(path)
+                path = os.path.dirname(path)
+
+
+    def test_not_watched(self):
+        """
+        Test: a directory which cannot be watched is not crawled
+        """
+        crawler = TreeCrawler()
+        self.assertEqual(crawler.crawl(self.test_dir, lambda path: False, self._on_entry), 0)
+        self.assertEqual(self.entries, [])
+
+
+class TestIncrementalCrawl(unittest.TestCase):
+    """
+    We add an existing tree to a monitor crawling 10 directories
+    per iteration of process_events.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        create_files_tree(self.test_dir, files_number=5, dirs_number=20, sublevels=3)
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(EventsCallbacks())
+        self.stm.set_crawl_step(10)
+        self.stm.start()
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_incremental_crawl(self):
+        """
+        Test: the crawl is done by process_events
+        """
+        self.stm.add_source_dir(self.test_dir)
+        self.assertEqual(len(self.stm.watches), 1)
+        self.stm.process_events(timeout=5, until_predicate=lambda: not self.stm.pending_crawls)
+        self.assertEqual(len(self.stm.watches), 64)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestTreeCrawler", "TestIncrementalCrawl" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
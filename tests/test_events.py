@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the events objects.
+"""
+
+import os
+import sys
+import shutil
+import cPickle
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, EventsCallbacks, Event, \
+                        EVENT_CREATE, EVENT_MOVED_FROM, EVENT_MOVED_TO
+from treewatcher import _inotify
+from treewatcher import inotifyx_
+
+
+class RawEventsCallbacks(EventsCallbacks):
+    """
+    We keep the Event objects
+    """
+    raw_events = True
+
+    def __init__(self):
+        """ init """
+        EventsCallbacks.__init__(self)
+        self.events = []
+
+
+    def create(self, event):
+        """ record """
+        self.events.append(event)
+
+
+    def moved_from(self, event):
+        """ record """
+        self.events.append(event)
+
+
+    def moved_to(self, event):
+        """ record """
+        self.events.append(event)
+
+
+class TestEvent(unittest.TestCase):
+    """
+    We build some events by hand
+    """
+    def test_lazy_path(self):
+        """
+        Test: the path is built when it's asked for, once
+        """
+        event = Event(EVENT_CREATE, '/tmp', 'foo', False)
+        self.assertEqual(event._path, None)
+        self.assertEqual(event.path, '/tmp/foo')
+        self.assertTrue(event.path is event.path)
+        self.assertEqual(Event(EVENT_CREATE, '/tmp/foo', None, False).path, '/tmp/foo')
+
+
+    def test_pickle(self):
+        """
+        Test: an event is pickled with its full path
+        """
+        event = Event(EVENT_CREATE, '/tmp', 'foo', True, 12, 0x100, 1.5)
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            copy = cPickle.loads(cPickle.dumps(event, protocol))
+            self.assertEqual((copy.code, copy.path, copy.is_dir, copy.cookie, copy.mask, copy.read_time),
+                             (EVENT_CREATE, '/tmp/foo', True, 12, 0x100, 1.5))
+            self.assertEqual(copy.name, None)
+
+
+    def test_no_attributes(self):
+        """
+        Test: the events have no __dict__
+        """
+        self.assertRaises(AttributeError, setattr, Event(EVENT_CREATE, '/tmp', 'foo', False), 'other', 1)
+
+
+class TestRawEvents(unittest.TestCase):
+    """
+    We ask for the Event objects in the callbacks
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.stm = choose_source_tree_monitor()
+        self.callbacks = RawEventsCallbacks()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_cookie(self):
+        """
+        Test: the two events of a rename share their inotify cookie
+        """
+        path = os.path.join(self.test_dir, 'foo')
+        open(path, 'w').close()
+        os.rename(path, path + '.new')
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.events) == 3)
+        created, moved_from, moved_to = self.callbacks.events
+        self.assertEqual((created.code, created.path, created.is_dir), (EVENT_CREATE, path, False))
+        self.assertTrue(created.mask & _inotify.IN_CREATE)
+        self.assertEqual((moved_from.code, moved_from.path), (EVENT_MOVED_FROM, path))
+        self.assertEqual((moved_to.code, moved_to.path), (EVENT_MOVED_TO, path + '.new'))
+        self.assertNotEqual(moved_from.cookie, 0)
+        self.assertEqual(moved_from.cookie, moved_to.cookie)
+
+
+    def test_no_callback(self):
+        """
+        Test: no Event is built for the events without callback
+        """
+        built = []
+        def counting_event(*args):
+            """ count the events built """
+            event = Event(*args)
+            built.append(event)
+            return event
+        path = os.path.join(self.test_dir, 'foo')
+        inotifyx_.Event = counting_event
+        try:
+            # IN_DELETE is always watched, to follow the subtrees (see tree_mask)
+            open(path, 'w').close()
+            os.remove(path)
+            self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.events)
+        finally:
+            inotifyx_.Event = Event
+        self.assertEqual([ (event.code, event.path) for event in built ], [ (EVENT_CREATE, path) ])
+        self.assertEqual(self.callbacks.events, built)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestEvent", "TestRawEvents" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
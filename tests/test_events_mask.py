@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the inotify events mask.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, EventsCallbacks
+from test_snapshot import RecordingEventsCallbacks
+
+
+class AttribEventsCallbacks(EventsCallbacks):
+    """
+    We keep the paths of the modify and attrib events
+    """
+    def __init__(self):
+        """ init """
+        EventsCallbacks.__init__(self)
+        self.modified = []
+        self.attributes = []
+
+
+    def modify(self, path, is_dir):
+        """ record """
+        self.modified.append(path)
+
+
+    def attrib(self, path, is_dir):
+        """ record """
+        self.attributes.append(path)
+
+
+class TestEventsMask(unittest.TestCase):
+    """
+    We check the masks of the watches, as seen by the kernel
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        for name in ('quiet', 'loud'):
+            os.mkdir(os.path.join(self.test_dir, name))
+            open(os.path.join(self.test_dir, name, 'file'), 'w').close()
+        self.stm = choose_source_tree_monitor()
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def _kernel_masks(self):
+        """
+        Returns the masks of our watches, read from /proc/self/fdinfo
+        """
+        masks = []
+        with open('/proc/self/fdinfo/%d' % self.stm.inotify_fd) as fdinfo:
+            for line in fdinfo:
+                if line.startswith('inotify wd:'):
+                    fields = dict(field.split(':', 1) for field in line.split()[1:])
+                    masks.append(int(fields['mask'], 16))
+        return masks
+
+
+    def test_from_callbacks(self):
+        """
+        Test: only the events with a callback are asked for
+        """
+        self.stm.set_events_callbacks(RecordingEventsCallbacks())
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        inotify = self.stm.inotifyx
+        expected = self.stm.tree_mask | inotify.IN_CLOSE_WRITE
+        self.assertEqual(self.stm.event_mask, expected)
+        self.assertFalse(self.stm.event_mask & inotify.IN_ATTRIB)
+        self.assertEqual(self._kernel_masks(), [ expected ] * 3)
+
+
+    def test_modify(self):
+        """
+        Test: a modify callback gets the modify events
+        """
+        callbacks = AttribEventsCallbacks()
+        self.stm.set_events_callbacks(callbacks)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        path = os.path.join(self.test_dir, 'loud', 'file')
+        with open(path, 'w') as myfile:
+            myfile.write('data')
+        self.stm.process_events(timeout=2, until_predicate=lambda: callbacks.modified)
+        self.assertEqual(callbacks.modified, [ path ])
+
+
+    def test_root_override(self):
+        """
+        Test: no attrib events under a root which does not want them
+        """
+        callbacks = AttribEventsCallbacks()
+        self.stm.set_events_callbacks(callbacks)
+        self.stm.set_watched_events(['modify'], root=os.path.join(self.test_dir, 'quiet'))
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        for name in ('quiet', 'loud'):
+            os.chmod(os.path.join(self.test_dir, name, 'file'), 0600)
+        self.stm.process_events(timeout=2, until_predicate=lambda: callbacks.attributes)
+        self.stm.process_events(timeout=0.2)
+        self.assertEqual(callbacks.attributes, [ os.path.join(self.test_dir, 'loud', 'file') ])
+
+
+    def test_unknown_event(self):
+        """
+        Test: the events names are checked
+        """
+        self.stm.start()
+        self.assertRaises(ValueError, self.stm.set_watched_events, ['open'])
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestEventsMask", ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the include/exclude path filters.
+"""
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor
+from treewatcher.filters import PathFilter
+from test_moves import MovesEventsCallbacks
+
+
+class TestPathFilter(unittest.TestCase):
+    """
+    We check the rules of a filter
+    """
+    def test_exclude(self):
+        """
+        Test: names globs, paths globs and regexes
+        """
+        path_filter = PathFilter(exclude=('.git', '*.tmp', '/data/*/scratch', re.compile(r'\.o$')))
+        self.assertFalse(path_filter.accepts('/data/.git', True))
+        self.assertFalse(path_filter.accepts('/data/a.tmp', False))
+        self.assertFalse(path_filter.accepts('/data/a/scratch', True))
+        self.assertFalse(path_filter.accepts('/data/main.o', False))
+        self.assertTrue(path_filter.accepts('/data/a.tmp.txt', False))
+        self.assertTrue(path_filter.accepts('/data/scratch', True))
+        self.assertTrue(path_filter.accepts('/data/.gitignore', False))
+
+
+    def test_include(self):
+        """
+        Test: the include rules only apply to the files
+        """
+        path_filter = PathFilter(include=('*.py',), exclude=('build',))
+        self.assertTrue(path_filter.accepts('/src/a.py', False))
+        self.assertFalse(path_filter.accepts('/src/a.pyc', False))
+        self.assertTrue(path_filter.accepts('/src/pkg', True))
+        self.assertFalse(path_filter.accepts('/src/build', True))
+
+
+class TestFilteredTreeWatcher(unittest.TestCase):
+    """
+    We monitor a tree with excluded directories and files
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        for path in ('src/.git/objects', 'node_modules/pkg', 'scratch'):
+            os.makedirs(os.path.join(self.test_dir, path))
+        self.callbacks = MovesEventsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.set_path_filters(exclude=('.git', 'node_modules', '*.tmp', re.compile(r'/scratch$')))
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def _path(self, *names):
+        """ path in test_dir """
+        return os.path.join(self.test_dir, *names)
+
+
+    def test_watches(self):
+        """
+        Test: the excluded directories are not watched
+        """
+        self.assertEqual(sorted(self.stm.watches.paths()), [ self.test_dir, self._path('src') ])
+
+
+    def test_events(self):
+        """
+        Test: the events of the excluded entries are not emitted
+        """
+        for path in ('src/a.tmp', 'src/.git/HEAD', 'src/a'):
+            open(self._path(path), 'w').close()
+        os.makedirs(self._path('src/node_modules/other'))
+        os.mkdir(self._path('src/sub'))
+        open(self._path('src/sub/b'), 'w').close()
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.written) >= 2)
+        self.stm.process_events(timeout=0.2)
+        self.assertEqual(sorted(self.callbacks.created),
+                         [ self._path('src/a'), self._path('src/sub'), self._path('src/sub/b') ])
+        self.assertEqual(sorted(self.callbacks.written), [ self._path('src/a'), self._path('src/sub/b') ])
+        self.assertFalse(self._path('src/node_modules') in self.stm.watches)
+
+
+    def test_renamed_out_of_filter(self):
+        """
+        Test: a directory renamed to an excluded name leaves the trees
+        """
+        os.rename(self._path('src'), self._path('scratch2.tmp'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.left)
+        self.assertEqual(self.callbacks.left, [ self._path('src') ])
+        self.assertEqual(self.callbacks.entered, [])
+        self.assertEqual(sorted(self.stm.watches.paths()), [ self.test_dir ])
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestPathFilter", "TestFilteredTreeWatcher" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
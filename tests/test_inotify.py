@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the ctypes inotify bindings and of
+the wait for the events in process_events.
+"""
+
+import os
+import sys
+import time
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import _inotify, choose_source_tree_monitor, EventsCallbacks
+
+
+def pack_event(wd, mask, cookie=0, name=None, length=None):
+    """
+    Build the bytes of an inotify event, like the kernel does : the name is
+    null terminated and padded with null bytes up to 'length' bytes (by
+    default the next multiple of 16)
+    """
+    if name is None:
+        name = ''
+    elif length is None:
+        length = (len(name) // 16 + 1) * 16
+    if length is None:
+        length = 0
+    return struct.pack('iIII', wd, mask, cookie, length) + name.ljust(length, '\0')
+
+
+class TestParseEvents(unittest.TestCase):
+    """
+    We decode buffers built by hand
+    """
+    def test_empty(self):
+        """
+        Test: nothing to decode
+        """
+        self.assertEqual(_inotify.parse_events(''), [])
+
+
+    def test_no_name(self):
+        """
+        Test: an event on the watched directory itself has no name
+        """
+        events = _inotify.parse_events(pack_event(3, _inotify.IN_IGNORED))
+        self.assertEqual(len(events), 1)
+        event = events[0]
+        self.assertEqual((event.wd, event.mask, event.cookie, event.name), (3, _inotify.IN_IGNORED, 0, None))
+
+
+    def test_several_events(self):
+        """
+        Test: the events of one read are decoded in order, without their padding
+        """
+        data = pack_event(1, _inotify.IN_CREATE, name='foo') + \
+               pack_event(1, _inotify.IN_MOVED_FROM, 42, 'a' * 16) + \
+               pack_event(2, _inotify.IN_MOVED_TO | _inotify.IN_ISDIR, 42, 'bar', length=64) + \
+               pack_event(2, _inotify.IN_DELETE_SELF)
+        events = _inotify.parse_events(data)
+        self.assertEqual([ (event.wd, event.mask, event.cookie, event.name) for event in events ],
+                         [ (1, _inotify.IN_CREATE, 0, 'foo'),
+                           (1, _inotify.IN_MOVED_FROM, 42, 'a' * 16),
+                           (2, _inotify.IN_MOVED_TO | _inotify.IN_ISDIR, 42, 'bar'),
+                           (2, _inotify.IN_DELETE_SELF, 0, None) ])
+        self.assertEqual(events[2].get_mask_description(), 'IN_MOVED_TO|IN_ISDIR')
+
+
+    def test_unterminated_name(self):
+        """
+        Test: a name filling its whole length has no null byte
+        """
+        events = _inotify.parse_events(pack_event(1, _inotify.IN_CREATE, name='0123456789abcdef', length=16) +
+                                       pack_event(1, _inotify.IN_DELETE, name='next'))
+        self.assertEqual([ event.name for event in events ], [ '0123456789abcdef', 'next' ])
+
+
+    def test_truncated(self):
+        """
+        Test: a truncated event at the end of the buffer is ignored
+        """
+        first = pack_event(1, _inotify.IN_CREATE, name='foo')
+        second = pack_event(1, _inotify.IN_CLOSE_WRITE, name='foo')
+        for size in (1, 15, 16, 17, len(second) - 1):
+            events = _inotify.parse_events(first + second[:size])
+            self.assertEqual([ (event.mask, event.name) for event in events ], [ (_inotify.IN_CREATE, 'foo') ])
+
+
+class TestGetEvents(unittest.TestCase):
+    """
+    We read the events of a real inotify instance
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.inotify_fd = _inotify.init()
+        self.watch_fd = _inotify.add_watch(self.inotify_fd, self.test_dir,
+                                           _inotify.IN_CREATE | _inotify.IN_CLOSE_WRITE)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        os.close(self.inotify_fd)
+        shutil.rmtree(self.test_dir)
+
+
+    def test_nothing_pending(self):
+        """
+        Test: get_events doesn't block with a timeout of 0
+        """
+        self.assertEqual(_inotify.get_events(self.inotify_fd, 0), [])
+
+
+    def test_events(self):
+        """
+        Test: the events pending are read at once
+        """
+        names = [ 'file%d' % i for i in range(50) ]
+        for name in names:
+            open(os.path.join(self.test_dir, name), 'w').close()
+        events = _inotify.get_events(self.inotify_fd, 1)
+        self.assertEqual(len(events), 100)
+        self.assertEqual(set(event.wd for event in events), set([ self.watch_fd ]))
+        self.assertEqual([ event.name for event in events if event.mask & _inotify.IN_CREATE ], names)
+        self.assertEqual([ event.name for event in events if event.mask & _inotify.IN_CLOSE_WRITE ], names)
+        self.assertEqual(_inotify.get_events(self.inotify_fd, 0), [])
+
+
+class TestInterrupt(unittest.TestCase):
+    """
+    We block process_events in a thread and interrupt it from another one
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(EventsCallbacks())
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def _check_interrupt(self):
+        """
+        process_events without timeout nor predicate returns soon after interrupt()
+        """
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        thread = threading.Thread(target=self.stm.process_events)
+        thread.daemon = True
+        thread.start()
+        # let it block in poll
+        time.sleep(0.3)
+        self.assertTrue(thread.is_alive())
+        start = time.time()
+        self.stm.interrupt()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'process_events has not been interrupted')
+        self.assertTrue(time.time() - start < 1)
+
+
+    def test_interrupt(self):
+        """
+        Test: interrupt() wakes up process_events blocked on the inotify fd
+        """
+        self._check_interrupt()
+
+
+    def test_interrupt_reader_thread(self):
+        """
+        Test: same thing when the events are read by a reader thread
+        """
+        self.stm.set_reader_thread()
+        self._check_interrupt()
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestParseEvents", "TestGetEvents", "TestInterrupt" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the monitor metrics.
+"""
+
+import os
+import sys
+import shutil
+import urllib2
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, MultiProcessingEventsCallbacks
+from treewatcher.metrics import Histogram, PrometheusExporter, format_prometheus
+from test_snapshot import RecordingEventsCallbacks
+from scenarios import create_files
+
+
+class CreateEventsCallbacks(MultiProcessingEventsCallbacks):
+    """
+    Nothing to do but be called
+    """
+    def create(self, path, is_dir):
+        """ nothing """
+        pass
+
+
+class TestHistogram(unittest.TestCase):
+    """
+    We fill a histogram
+    """
+    def test_read(self):
+        """
+        Test: the buckets are cumulative
+        """
+        histogram = Histogram(bounds=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.read(), {'buckets': [ (0.1, 2), (1.0, 3), (float('inf'), 4) ],
+                                            'sum': 2.65, 'count': 4})
+
+
+class TestStats(unittest.TestCase):
+    """
+    We check the stats of a monitor after some events
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.stm = choose_source_tree_monitor()
+        self.stm.start()
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_serial(self):
+        """
+        Test: each event is counted and timed
+        """
+        callbacks = RecordingEventsCallbacks()
+        self.stm.set_events_callbacks(callbacks)
+        self.stm.set_stats()
+        self.stm.add_source_dir(self.test_dir)
+        create_files(self.test_dir, files_number=10)
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(callbacks.written) == 10)
+
+        stats = self.stm.stats()
+        self.assertEqual(stats['events']['create'], 10)
+        self.assertEqual(stats['events']['close_write'], 10)
+        self.assertEqual(stats['events']['attrib'], 0)
+        self.assertEqual(stats['watches'], 1)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertTrue(stats['max_queue_depth'] >= 1)
+        self.assertEqual(stats['latency']['count'], 20)
+        self.assertEqual(stats['duration']['count'], 20)
+        self.assertEqual(stats['duration']['buckets'][-1][1], 20)
+
+
+    def test_multiprocessing(self):
+        """
+        Test: the callbacks of the worker processes are timed
+        """
+        self.stm.set_events_callbacks(CreateEventsCallbacks())
+        self.stm.set_workers_number(2)
+        self.stm.set_stats()
+        self.stm.add_source_dir(self.test_dir)
+        create_files(self.test_dir, files_number=10)
+        self.stm.process_events(timeout=1)
+        stats = self.stm.stats()
+        self.assertEqual(stats['events']['create'], 10)
+        self.assertEqual(stats['duration']['count'], 10)
+
+
+    def test_disabled(self):
+        """
+        Test: only the basic stats without set_stats
+        """
+        self.stm.set_events_callbacks(RecordingEventsCallbacks())
+        self.assertEqual(sorted(self.stm.stats()),
+                         [ 'overflows', 'queue', 'queue_depth', 'read_buffer', 'registry_bytes', 'watches' ])
+
+
+    def test_exporter(self):
+        """
+        Test: the stats are served in the Prometheus text format
+        """
+        self.stm.set_events_callbacks(RecordingEventsCallbacks())
+        self.stm.set_stats()
+        self.stm.add_source_dir(self.test_dir)
+        exporter = PrometheusExporter(self.stm, port=0)
+        exporter.start()
+        try:
+            body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % exporter.port).read()
+        finally:
+            exporter.stop()
+        self.assertEqual(body, format_prometheus(self.stm.stats()))
+        self.assertTrue('treewatcher_events_total{event="create"} 0.0\n' in body)
+        self.assertTrue('treewatcher_watches 1.0\n' in body)
+        self.assertTrue('treewatcher_registry_bytes ' in body)
+        self.assertTrue('treewatcher_callback_latency_seconds_bucket{le="+Inf"} 0.0\n' in body)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestHistogram", "TestStats" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
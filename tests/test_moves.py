@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the moves pairing.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor
+from test_snapshot import RecordingEventsCallbacks
+
+
+class MovesEventsCallbacks(RecordingEventsCallbacks):
+    """
+    We also keep the moves
+    """
+    def __init__(self):
+        """ init """
+        RecordingEventsCallbacks.__init__(self)
+        self.left = []
+        self.entered = []
+
+
+    def moved_from(self, path, is_dir):
+        """ record """
+        self.left.append(path)
+
+
+    def moved_to(self, path, is_dir):
+        """ record """
+        self.entered.append(path)
+
+
+class PairedEventsCallbacks(MovesEventsCallbacks):
+    """
+    We ask for the moved events
+    """
+    def __init__(self):
+        """ init """
+        MovesEventsCallbacks.__init__(self)
+        self.moves = []
+
+
+    def moved(self, src, dst, is_dir):
+        """ record """
+        self.moves.append((src, dst, is_dir))
+
+
+class TestMoves(unittest.TestCase):
+    """
+    We move directories inside, into and out of a watched tree
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.outside_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.test_dir, 'src/sub'))
+        os.mkdir(os.path.join(self.test_dir, 'dst'))
+        self.stm = None
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+        shutil.rmtree(self.outside_dir)
+
+
+    def _start(self, callbacks):
+        """
+        Start a monitor of test_dir
+        """
+        self.callbacks = callbacks
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(callbacks)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def _path(self, *names):
+        """ path in test_dir """
+        return os.path.join(self.test_dir, *names)
+
+
+    def test_rename(self):
+        """
+        Test: a renamed directory is reported once and keeps its watches
+        """
+        self._start(PairedEventsCallbacks())
+        watches = len(self.stm.watches)
+        os.rename(self._path('src'), self._path('dst/renamed'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.moves)
+        self.assertEqual(self.callbacks.moves, [ (self._path('src'), self._path('dst/renamed'), True) ])
+        self.assertEqual(self.callbacks.left, [])
+        self.assertEqual(self.callbacks.entered, [])
+        self.assertEqual(len(self.stm.watches), watches)
+        self.assertTrue(self._path('dst/renamed/sub') in self.stm.watches)
+        self.assertFalse(self._path('src/sub') in self.stm.watches)
+
+        path = self._path('dst/renamed/sub/file')
+        open(path, 'w').close()
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.written)
+        self.assertEqual(self.callbacks.created, [ path ])
+
+
+    def test_unpaired(self):
+        """
+        Test: without a moved callback, a rename is a moved_from/moved_to pair
+        """
+        self._start(MovesEventsCallbacks())
+        os.rename(self._path('src'), self._path('dst/renamed'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.entered)
+        self.assertEqual(self.callbacks.left, [ self._path('src') ])
+        self.assertEqual(self.callbacks.entered, [ self._path('dst/renamed') ])
+        self.assertTrue(self._path('dst/renamed/sub') in self.stm.watches)
+
+
+    def test_moved_out(self):
+        """
+        Test: a directory moved out of the tree is not watched anymore
+        """
+        self._start(PairedEventsCallbacks())
+        os.rename(self._path('src'), os.path.join(self.outside_dir, 'src'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.left)
+        self.assertEqual(self.callbacks.left, [ self._path('src') ])
+        self.assertEqual(self.callbacks.moves, [])
+        self.assertEqual(sorted(self.stm.watches.paths()), [ self.test_dir, self._path('dst') ])
+
+
+    def test_moved_in(self):
+        """
+        Test: a directory moved into the tree is watched, its content is reported
+        """
+        self._start(PairedEventsCallbacks())
+        os.makedirs(os.path.join(self.outside_dir, 'new/sub'))
+        os.rename(os.path.join(self.outside_dir, 'new'), self._path('dst/new'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.created)
+        self.assertEqual(self.callbacks.entered, [ self._path('dst/new') ])
+        self.assertEqual(self.callbacks.created, [ self._path('dst/new/sub') ])
+        self.assertTrue(self._path('dst/new/sub') in self.stm.watches)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestMoves", ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -10,8 +10,6 @@
 # A copy of the license has been included in the COPYING file.
 
 """
-!!! DOES NOT WORK ! That's why TESTS_TO_RUN is empty. !!!
-
 This module contains the test implementing scenarios from
 the scenarios.py files.
 
@@ -22,6 +20,9 @@ The callbacks themself can be in different processes too.
 
 import os
 import sys
+import shutil
+import tempfile
+import unittest
 import multiprocessing
 
 import helper
@@ -33,13 +34,12 @@ except ImportError:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
     import treewatcher
 
-from treewatcher import MultiProcessingEventsCallbacks
-from scenarios import TestTreeWatcher
+from treewatcher import MultiProcessingEventsCallbacks, choose_source_tree_monitor
+from scenarios import TestTreeWatcher, create_files
 
 
 class MultiProcessingTestsCallbacks(MultiProcessingEventsCallbacks):
     """
-    !!! DOES NOT WORK the way i want. TESTS_TO_RUN is empty to reflect that :)!!!
     We will count events and check if we got
     the right number
 
@@ -142,14 +142,117 @@ class TestEightProcessesTreeWatcher(TestTreeWatcher):
 
 
 
-# no tests to run for the moment
-# DOES NOT WORK THE WAY I WANT
-TESTS_TO_RUN = [
+class RoutingTestsCallbacks(MultiProcessingEventsCallbacks):
+    """
+    We record which worker handles which event
+    """
+    def __init__(self):
+        """
+        The records are sent back to the monitor process using a queue
+        """
+        MultiProcessingEventsCallbacks.__init__(self)
+        self.records = multiprocessing.Queue()
+        self.worker_index = None
+
+
+    def init_worker(self, worker_index):
+        """ Worker local state """
+        self.worker_index = worker_index
+
+
+    def create(self, path, is_dir):
+        """ Record """
+        self.records.put(('create', path, self.worker_index))
+
+
+    def close_write(self, path, is_dir):
+        """ Record """
+        self.records.put(('close_write', path, self.worker_index))
+
+
+class TestEventsRouting(unittest.TestCase):
+    """
+    We check that all the events of a file are handled by the same worker, in order
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.callbacks = RoutingTestsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.set_workers_number(4)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_routing(self):
+        """
+        Test: create and close_write of each file go to the same worker, in order
+        """
+        create_files(self.test_dir, files_number=200)
+        self.stm.process_events(timeout=2)
+        records = [ self.callbacks.records.get(timeout=5) for _ in range(400) ]
+
+        workers = {}
+        for event, path, worker_index in records:
+            workers.setdefault(path, []).append((event, worker_index))
+        self.assertEqual(len(workers), 200)
+        for path, events in workers.iteritems():
+            self.assertEqual([ event for event, _ in events ], ['create', 'close_write'])
+            self.assertEqual(events[0][1], events[1][1])
+        self.assertEqual(len(set([ events[0][1] for events in workers.itervalues() ])), 4)
+
+
+class TestWorkerQueues(unittest.TestCase):
+    """
+    We check that the queues of the worker processes don't survive the monitor
+    """
+    def test_no_leak(self):
+        """
+        Test: a stopped monitor keeps no file descriptor open
+        """
+        monitors = []
+        fds = len(os.listdir('/proc/self/fd'))
+        for _ in range(3):
+            test_dir = tempfile.mkdtemp()
+            callbacks = MultiProcessingTestsCallbacks()
+            stm = choose_source_tree_monitor()
+            stm.set_events_callbacks(callbacks)
+            stm.set_workers_number(2)
+            stm.start()
+            stm.add_source_dir(test_dir)
+            create_files(test_dir, files_number=10)
+            stm.process_events(timeout=2, until_predicate=lambda: callbacks.get_cw_counter() == 10)
+            stm.stop()
+            shutil.rmtree(test_dir)
+            self.assertEqual(callbacks.get_cw_counter(), 10)
+            # like the monitors of the other tests, kept by the test runner
+            monitors.append(stm)
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+
+# see helper.py file and the tests_runner comments
+# the scenarios take minutes for each number of processes : the other
+# classes are only run on demand (see helper.py)
+TESTS_TO_RUN = [ \
                  #"TestOneProcessTreeWatcher", \
-                 #"TestTwoProcessesTreeWatcher", \
+                 "TestTwoProcessesTreeWatcher", \
                  #"TestFourProcessesTreeWatcher", \
-                 #"TestEightProcessesTreeWatcher"
-                 ]
+                 #"TestEightProcessesTreeWatcher", \
+                 "TestEventsRouting", \
+                 "TestWorkerQueues" \
+               ]
 
 if __name__ == "__main__":
     helper.tests_runner(__file__)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module runs the scenarios of the scenarios.py file
+using the polling tree monitor, and tests its interval.
+"""
+
+import os
+import sys
+import time
+import threading
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor
+from treewatcher.polling import PollingSourceTreeMonitor
+from scenarios import TestTreeWatcher
+from test_serialevents import SerialEventsCallbacks
+from test_threadedevents import ThreadedTestsCallbacks
+from test_snapshot import RecordingEventsCallbacks
+
+
+_POLLING_STM = 'treewatcher.polling.PollingSourceTreeMonitor'
+
+
+class PollingTreeWatcher(TestTreeWatcher):
+    """
+    The scenarios, waiting for the end of the scans : process_events
+    returns on its timeout even if a scan is running (see set_poll_interval),
+    and a scan of the biggest trees takes more than a second.
+    """
+    def _test_helper(self, files_number=0, dirs_number=0, loop=1, timeout=5, sublevels=0, cleanup=False):
+        """
+        see TestTreeWatcher._test_helper
+        """
+        TestTreeWatcher._test_helper(self, files_number, dirs_number, loop, timeout, sublevels, cleanup)
+
+
+class TestSerialPollingTreeWatcher(PollingTreeWatcher):
+    """
+    The scenarios, with serial callbacks
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=SerialEventsCallbacks(), stm_name=_POLLING_STM)
+        self.stm.set_poll_interval(0.05, 0.2)
+
+
+class TestParallelPollingTreeWatcher(PollingTreeWatcher):
+    """
+    The scenarios, with four threads reading the directories
+    and four threads handling the callbacks
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=ThreadedTestsCallbacks(), workers=4, stm_name=_POLLING_STM)
+        self.stm.set_crawler_workers_number(4)
+        self.stm.set_poll_interval(0.05, 0.2)
+
+
+class TestPolling(unittest.TestCase):
+    """
+    We check the events of the changes made between two scans
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.test_dir, 'sub'))
+        open(os.path.join(self.test_dir, 'sub', 'old'), 'w').close()
+        self.callbacks = RecordingEventsCallbacks()
+        self.stm = choose_source_tree_monitor(_POLLING_STM)
+        self.assertTrue(isinstance(self.stm, PollingSourceTreeMonitor))
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.set_poll_interval(0.05, 0.4)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_changes(self):
+        """
+        Test: the existing files are not reported, the changes are
+        """
+        self.stm.process_events(timeout=0.2)
+        self.assertEqual(self.callbacks.created, [])
+
+        old = os.path.join(self.test_dir, 'sub', 'old')
+        new = os.path.join(self.test_dir, 'sub', 'new')
+        with open(old, 'w') as myfile:
+            myfile.write('data')
+        open(new, 'w').close()
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.written) == 2)
+        self.assertEqual(self.callbacks.created, [ new ])
+        self.assertEqual(sorted(self.callbacks.written), [ new, old ])
+
+        shutil.rmtree(os.path.join(self.test_dir, 'sub'))
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.deleted)
+        self.assertEqual(self.callbacks.deleted, [ os.path.join(self.test_dir, 'sub') ])
+
+
+    def test_adaptive_interval(self):
+        """
+        Test: the interval grows when nothing changes
+        """
+        self.stm.process_events(timeout=1)
+        self.assertEqual(self.stm.interval, 0.4)
+        open(os.path.join(self.test_dir, 'new'), 'w').close()
+        self.stm.read_events()
+        self.assertEqual(self.stm.interval, 0.05)
+
+
+    def test_scan_step(self):
+        """
+        Test: the trees are scanned a few directories at a time
+        """
+        names = [ 'dir%d' % index for index in range(20) ]
+        for name in names:
+            os.mkdir(os.path.join(self.test_dir, 'sub', name))
+        self.stm.set_poll_interval(0.05, 0.4, scan_step=5)
+        self.assertEqual(self.stm._periodic_work(), 0)
+        self.assertEqual(self.stm._scans[0].dirs, 5)
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.created) == 20)
+        self.assertEqual(sorted(self.callbacks.created),
+                         sorted(os.path.join(self.test_dir, 'sub', name) for name in names))
+        # read_events finishes the scan
+        self.stm.read_events()
+        self.assertEqual(len(self.stm._scans), 0)
+        self.assertEqual(len(self.callbacks.created), 20)
+
+
+    def test_interrupt(self):
+        """
+        Test: interrupt() stops process_events
+        """
+        start = time.time()
+        timer = threading.Timer(0.2, self.stm.interrupt)
+        timer.start()
+        self.stm.process_events()
+        timer.join()
+        self.assertTrue(time.time() - start < 1)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestSerialPollingTreeWatcher", "TestParallelPollingTreeWatcher", "TestPolling" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the bounded events queues policies.
+"""
+
+import os
+import sys
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import EVENT_CREATE, EVENT_MODIFY, Event
+from treewatcher.queues import BoundedEventsQueue, new_queue_counters, \
+                               QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_COALESCE
+
+
+def _get_all(events_queue):
+    """
+    Returns the queued items
+    """
+    items = []
+    while not events_queue.empty():
+        items.append(events_queue.get())
+    return items
+
+
+class TestBoundedEventsQueue(unittest.TestCase):
+    """
+    We fill a queue of 3 events and check what's left in it
+    """
+    def _fill(self, policy, events):
+        """
+        Returns a queue of 3 events filled with 'events' using 'policy'
+        """
+        self.counters = new_queue_counters()
+        events_queue = BoundedEventsQueue(3, policy, self.counters)
+        for event in events:
+            events_queue.put(event)
+        return events_queue
+
+
+    def test_drop_newest(self):
+        """
+        Test: the events put in a full queue are dropped
+        """
+        events = [ Event(EVENT_CREATE, '/tmp/%d' % i, None, False) for i in range(5) ]
+        events_queue = self._fill(QUEUE_DROP_NEWEST, events)
+        self.assertEqual(_get_all(events_queue), events[:3])
+        self.assertEqual(self.counters['dropped'], 2)
+
+
+    def test_drop_oldest(self):
+        """
+        Test: the oldest events are dropped to make some room
+        """
+        events = [ Event(EVENT_CREATE, '/tmp/%d' % i, None, False) for i in range(5) ]
+        events_queue = self._fill(QUEUE_DROP_OLDEST, events)
+        self.assertEqual(_get_all(events_queue), events[2:])
+        self.assertEqual(self.counters['dropped'], 2)
+
+
+    def test_drop_oldest_batch(self):
+        """
+        Test: a batch counts for the number of events it holds
+        """
+        events = [ Event(EVENT_CREATE, '/tmp/%d' % i, None, False) for i in range(3) ]
+        events_queue = self._fill(QUEUE_DROP_OLDEST, [ events[:2], events[2] ])
+        events_queue.put(events[0])
+        self.assertEqual(_get_all(events_queue), [ events[2], events[0] ])
+        self.assertEqual(self.counters['dropped'], 2)
+
+
+    def test_coalesce(self):
+        """
+        Test: the events already queued are not queued again when it's full
+        """
+        modify = Event(EVENT_MODIFY, '/tmp/foo', None, False)
+        events = [ Event(EVENT_CREATE, '/tmp/foo', None, False), modify, modify, modify ]
+        events_queue = self._fill(QUEUE_COALESCE, events)
+        self.assertEqual(self.counters['coalesced'], 1)
+        self.assertEqual(_get_all(events_queue), events[:3])
+        events_queue.put(modify)
+        self.assertEqual(events_queue.qsize(), 1)
+
+
+    def test_coalesce_stamped(self):
+        """
+        Test: the read time of the events (see set_stats) is not compared
+        """
+        events = [ Event(EVENT_CREATE, '/tmp/foo', None, False, 0, 0, 1.0) ] + \
+                 [ Event(EVENT_MODIFY, '/tmp/foo', None, False, 0, 0, read_time) for read_time in (2.0, 3.0, 4.0) ]
+        events_queue = self._fill(QUEUE_COALESCE, events)
+        self.assertEqual(self.counters['coalesced'], 1)
+        self.assertEqual(_get_all(events_queue), events[:3])
+
+
+    def test_coalesce_lazy_path(self):
+        """
+        Test: the events read from inotify are compared using their full path
+        """
+        events = [ Event(EVENT_CREATE, '/tmp/foo', None, False),
+                   Event(EVENT_MODIFY, '/tmp', 'foo', False, 0, 2, None),
+                   Event(EVENT_CREATE, '/tmp/bar', None, False),
+                   Event(EVENT_MODIFY, '/tmp/foo', None, False) ]
+        events_queue = self._fill(QUEUE_COALESCE, events)
+        self.assertEqual(self.counters['coalesced'], 1)
+        self.assertEqual(_get_all(events_queue), events[:3])
+
+
+    def test_block_drain(self):
+        """
+        Test: a full queue without consumer is drained instead of blocking
+        """
+        drained = []
+        def drain(events_queue):
+            """ consume the events """
+            drained.extend(_get_all(events_queue))
+        events = [ Event(EVENT_CREATE, '/tmp/%d' % i, None, False) for i in range(5) ]
+        self.counters = new_queue_counters()
+        events_queue = BoundedEventsQueue(3, QUEUE_BLOCK, self.counters)
+        events_queue.drain = drain
+        for event in events:
+            events_queue.put(event)
+        self.assertEqual(drained + _get_all(events_queue), events)
+        self.assertEqual(self.counters['blocked'], 1)
+
+
+    def test_stop_iteration(self):
+        """
+        Test: StopIteration ignores the bound
+        """
+        events = [ Event(EVENT_CREATE, '/tmp/%d' % i, None, False) for i in range(3) ]
+        events_queue = self._fill(QUEUE_DROP_NEWEST, events)
+        events_queue.put(StopIteration)
+        self.assertEqual(_get_all(events_queue), events + [ StopIteration ])
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestBoundedEventsQueue", ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
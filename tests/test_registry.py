@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the watched directories registry.
+"""
+
+import os
+import sys
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher.registry import WatchRegistry
+
+
+class TestWatchRegistry(unittest.TestCase):
+    """
+    We fill a registry and check the mappings after some removals
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.registry = WatchRegistry()
+        for wd, path in enumerate(['/data', '/data/a', '/data/a/b', '/data/ab', '/other']):
+            self.registry.add(path, wd + 1)
+
+
+    def test_mappings(self):
+        """
+        Test: wd -> path and path -> wd
+        """
+        self.assertEqual(len(self.registry), 5)
+        self.assertEqual(self.registry.get_path(3), '/data/a/b')
+        self.assertEqual(self.registry.get_wd('/data/ab'), 4)
+        self.assertTrue('/data/a/b' in self.registry)
+        self.assertFalse('/data/a/c' in self.registry)
+        self.assertRaises(KeyError, self.registry.get_wd, '/')
+
+
+    def test_remove_subtree(self):
+        """
+        Test: removing /data/a does not remove /data/ab
+        """
+        self.assertEqual(sorted(self.registry.remove_subtree('/data/a')), [2, 3])
+        self.assertEqual(sorted(self.registry.paths()), ['/data', '/data/ab', '/other'])
+        self.assertRaises(KeyError, self.registry.get_path, 3)
+        self.assertEqual(self.registry.remove_subtree('/data/a'), [])
+
+
+    def test_remove_everything(self):
+        """
+        Test: removing all the roots empties the registry
+        """
+        self.registry.remove_subtree('/data/')
+        self.registry.remove_subtree('/other')
+        self.assertEqual(len(self.registry), 0)
+        self.assertEqual(self.registry._children, {})
+        self.assertEqual(self.registry._recent_paths, {})
+
+
+    def test_same_wd(self):
+        """
+        Test: the same directory watched through another path
+        """
+        self.registry.add('/link', 2)
+        self.assertEqual(self.registry.get_path(2), '/link')
+        self.assertFalse('/data/a' in self.registry)
+        self.assertTrue('/data/a/b' in self.registry)
+
+
+    def test_rename(self):
+        """
+        Test: a renamed subtree keeps its watch descriptors
+        """
+        self.assertTrue(self.registry.rename('/data/a', '/other/x/a'))
+        self.assertEqual(sorted(self.registry.paths()),
+                         ['/data', '/data/ab', '/other', '/other/x/a', '/other/x/a/b'])
+        self.assertEqual(self.registry.get_path(3), '/other/x/a/b')
+        self.assertEqual(self.registry.get_wd('/other/x/a'), 2)
+        self.assertFalse(self.registry.rename('/data/a', '/data/c'))
+
+
+    def test_relative(self):
+        """
+        Test: the relative paths and '/' are kept apart from the others
+        """
+        self.registry.add('data/a', 6)
+        self.registry.add('/', 7)
+        self.assertEqual(self.registry.get_path(6), 'data/a')
+        self.assertEqual(self.registry.get_path(7), '/')
+        self.assertEqual(self.registry.get_path(2), '/data/a')
+        self.assertEqual(sorted(self.registry.remove_subtree('/')), [1, 2, 3, 4, 5, 7])
+        self.assertEqual(self.registry.paths(), ['data/a'])
+
+
+    def test_paths_cache(self):
+        """
+        Test: only the recently used paths are cached
+        """
+        self.registry.cache_size = 4
+        for wd in (1, 2, 3, 2, 4):
+            self.registry.get_path(wd)
+        cached = self.registry._recent_paths.values() + self.registry._older_paths.values()
+        self.assertEqual(sorted(cached), [ '/data/a', '/data/a/b', '/data/ab' ])
+        self.registry.rename('/data/a', '/data/c')
+        self.assertEqual(self.registry.get_path(3), '/data/c/b')
+
+
+    def test_nodes_reused(self):
+        """
+        Test: the nodes of the removed directories are reused
+        """
+        nodes = len(self.registry._names)
+        self.registry.remove_subtree('/data/a')
+        self.registry.add('/data/x/y', 2)
+        self.assertEqual(len(self.registry._names), nodes)
+        self.assertEqual(self.registry.get_path(2), '/data/x/y')
+
+
+    def test_memory_usage(self):
+        """
+        Test: the memory usage follows the number of directories
+        """
+        empty = WatchRegistry().memory_usage()
+        used = self.registry.memory_usage()
+        self.assertTrue(used > empty)
+        for wd in xrange(100, 1100):
+            self.registry.add('/data/a/b/%d' % wd, wd)
+        self.assertTrue(self.registry.memory_usage() > used)
+
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestWatchRegistry", ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
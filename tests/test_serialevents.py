@@ -97,8 +97,34 @@ class TestSerialTreeWatcher(TestTreeWatcher):
         self.setup_helper(callbacks=SerialEventsCallbacks())
 
 
+class TestSerialBatchedTreeWatcher(TestTreeWatcher):
+    """
+    Same as TestSerialTreeWatcher, but the events are put
+    in the events queue by batches.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=SerialEventsCallbacks(), batching=True)
+
+
+class TestSerialBoundedTreeWatcher(TestTreeWatcher):
+    """
+    Same as TestSerialTreeWatcher, but with a small bounded events
+    queue : the callbacks are called each time it's full.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=SerialEventsCallbacks(), queue_bound=3)
+
+
 # see helper.py file and the tests_runner comments
-TESTS_TO_RUN = [ "TestSerialTreeWatcher", ]
+TESTS_TO_RUN = [ "TestSerialTreeWatcher", "TestSerialBatchedTreeWatcher", "TestSerialBoundedTreeWatcher" ]
 
 if __name__ == "__main__":
     helper.tests_runner(__file__)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the sharded inotify instances
+and of the reader threads.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor
+from treewatcher import _inotify
+from test_moves import MovesEventsCallbacks
+from test_snapshot import RecordingEventsCallbacks
+from scenarios import create_files
+
+
+def _watches_number(inotify_fd):
+    """
+    Returns the number of watches of an inotify instance, read from /proc/self/fdinfo
+    """
+    with open('/proc/self/fdinfo/%d' % inotify_fd) as fdinfo:
+        return len([ line for line in fdinfo if line.startswith('inotify wd:') ])
+
+
+class TestShards(unittest.TestCase):
+    """
+    We watch two trees with two inotify instances
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.roots = [ tempfile.mkdtemp(), tempfile.mkdtemp() ]
+        for root in self.roots:
+            os.mkdir(os.path.join(root, 'sub'))
+        self.callbacks = MovesEventsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.set_inotify_shards(2)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        for root in self.roots:
+            shutil.rmtree(root)
+
+
+    def _start(self):
+        """
+        Start the monitor of both roots
+        """
+        self.stm.start()
+        for root in self.roots:
+            self.stm.add_source_dir(root)
+
+
+    def test_roots(self):
+        """
+        Test: one root per instance, the events of both are reported
+        """
+        self._start()
+        self.assertEqual([ _watches_number(fd) for fd in self.stm.inotify_fds ], [ 2, 2 ])
+        self.assertEqual(len(self.stm.watches), 4)
+        for root in self.roots:
+            create_files(root, files_number=10)
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.written) == 20)
+        self.assertEqual(len(set(self.callbacks.created)), 20)
+
+        self.stm.remove_source_dir(self.roots[0])
+        self.assertEqual([ _watches_number(fd) for fd in self.stm.inotify_fds ], [ 0, 2 ])
+
+
+    def test_move_between_shards(self):
+        """
+        Test: a directory moved to the tree of another instance is watched there
+        """
+        self._start()
+        src = os.path.join(self.roots[0], 'sub')
+        dst = os.path.join(self.roots[1], 'moved')
+        os.rename(src, dst)
+        # the two events come from two instances, in any order
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.left and self.callbacks.entered)
+        self.assertEqual(self.callbacks.left, [ src ])
+        self.assertEqual(self.callbacks.entered, [ dst ])
+        self.assertEqual([ _watches_number(fd) for fd in self.stm.inotify_fds ], [ 1, 3 ])
+
+        path = os.path.join(dst, 'file')
+        open(path, 'w').close()
+        self.stm.process_events(timeout=2, until_predicate=lambda: self.callbacks.written)
+        self.assertEqual(self.callbacks.created, [ path ])
+
+
+    def test_top_directories(self):
+        """
+        Test: with level 1, the directories at the top of a root are spread too
+        """
+        self.stm.set_inotify_shards(2, level=1)
+        os.mkdir(os.path.join(self.roots[0], 'other'))
+        self.stm.start()
+        self.stm.add_source_dir(self.roots[0])
+        self.assertEqual(sorted(_watches_number(fd) for fd in self.stm.inotify_fds), [ 1, 2 ])
+        self.assertEqual(len(self.stm._shard_keys), 3)
+
+
+    def test_overflow(self):
+        """
+        Test: only the trees of the overflowed instance are rescanned
+        """
+        self.stm.set_overflow_resync()
+        self._start()
+        self.stm._process_event(_inotify.InotifyEvent(-1, _inotify.IN_Q_OVERFLOW, 0, None), 1)
+        self.assertEqual(self.stm.overflows, 1)
+        self.assertEqual([ rescan.root for rescan in self.stm.pending_rescans ], [ self.roots[1] ])
+
+
+    def test_overflow_removed_root(self):
+        """
+        Test: a removed root is not rescanned when its instance overflows
+        """
+        self.stm.set_overflow_resync()
+        self._start()
+        self.stm.remove_source_dir(self.roots[0])
+        self.assertEqual(self.stm._shard_keys.keys(), [ self.roots[1] ])
+        self.stm._process_event(_inotify.InotifyEvent(-1, _inotify.IN_Q_OVERFLOW, 0, None), 0)
+        self.assertEqual(list(self.stm.pending_rescans), [])
+        open(os.path.join(self.roots[0], 'file'), 'w').close()
+        self.stm.process_events(timeout=0.3)
+        self.assertFalse(self.roots[0] in self.stm.watches)
+        self.assertEqual(self.callbacks.created, [])
+
+
+class TestReaderThread(unittest.TestCase):
+    """
+    We let a reader thread drain the kernel events queue while
+    process_events is not running
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.callbacks = RecordingEventsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def _buffered(self, events_number):
+        """
+        Wait until the reader has buffered 'events_number' events at least,
+        returns the number of buffered events
+        """
+        deadline = time.time() + 2
+        while self.stm.stats()['read_buffer'] < events_number and time.time() < deadline:
+            time.sleep(0.01)
+        return self.stm.stats()['read_buffer']
+
+
+    def test_buffered(self):
+        """
+        Test: the events are read without process_events
+        """
+        self.stm.set_reader_thread()
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        self.assertEqual(self.stm.fileno(), self.stm._wakeup_fds[0])
+        create_files(self.test_dir, files_number=20)
+        self.assertEqual(self._buffered(40), 40)
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.written) == 20)
+        self.assertEqual(len(self.callbacks.created), 20)
+        self.assertEqual(self.stm.stats()['read_buffer'], 0)
+
+
+    def test_bounded(self):
+        """
+        Test: a full buffer leaves the next events in the kernel queue
+        """
+        self.stm.set_reader_thread(buffer_size=10)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+        create_files(self.test_dir, files_number=10)
+        buffered = self._buffered(10)
+        self.assertTrue(buffered >= 10)
+        create_files(self.test_dir, files_number=10)
+        time.sleep(0.1)
+        self.assertEqual(self.stm.stats()['read_buffer'], buffered)
+        self.assertTrue(_inotify._pending_bytes(self.stm.inotify_fd) > 0)
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.written) == 20)
+        self.assertEqual(len(set(self.callbacks.created)), 20)
+        self.assertEqual(self.stm.overflows, 0)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestShards", "TestReaderThread" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
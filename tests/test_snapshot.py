@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+This module contains the tests of the trees snapshot used to recover
+from an inotify queue overflow.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import multiprocessing
+
+import helper
+
+# see scenerios.py file for comments on this block
+try:
+    import treewatcher
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+    import treewatcher
+
+from treewatcher import choose_source_tree_monitor, EventsCallbacks, MultiProcessingEventsCallbacks, \
+                        EVENTS_NAMES
+from treewatcher.snapshot import TreeSnapshot, Rescan, SnapshotFileError
+from scenarios import create_files
+
+
+class RecordingEventsCallbacks(EventsCallbacks):
+    """
+    We keep the paths of the create, delete and close_write events
+    """
+    def __init__(self):
+        """ init """
+        EventsCallbacks.__init__(self)
+        self.created = []
+        self.deleted = []
+        self.written = []
+
+
+    def create(self, path, is_dir):
+        """ record """
+        self.created.append(path)
+
+
+    def delete(self, path, is_dir):
+        """ record """
+        self.deleted.append(path)
+
+
+    def close_write(self, path, is_dir):
+        """ record """
+        self.written.append(path)
+
+
+class CountingEventsCallbacks(MultiProcessingEventsCallbacks):
+    """
+    We count the create and close_write events handled by the worker processes
+    """
+    def __init__(self):
+        """ init """
+        MultiProcessingEventsCallbacks.__init__(self)
+        self.created = multiprocessing.Value('I', 0)
+        self.written = multiprocessing.Value('I', 0)
+
+
+    def create(self, path, is_dir):
+        """ count """
+        with self.created.get_lock():
+            self.created.value += 1
+
+
+    def close_write(self, path, is_dir):
+        """ count """
+        with self.written.get_lock():
+            self.written.value += 1
+
+
+class TestRescan(unittest.TestCase):
+    """
+    We take a snapshot of a small tree, change it and check
+    the events reported by a rescan.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.test_dir, 'sub'))
+        for name in ('a', 'b', 'sub/c'):
+            open(os.path.join(self.test_dir, name), 'w').close()
+        self.snapshot = TreeSnapshot()
+        self.events = []
+        self._rescan()
+        self.events = []
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        shutil.rmtree(self.test_dir)
+
+
+    def _on_event(self, code, path, is_dir):
+        """
+        Record the events as (name, path relative to test_dir)
+        """
+        self.events.append((EVENTS_NAMES[code], os.path.relpath(path, self.test_dir)))
+
+
+    def _rescan(self, step=None):
+        """
+        Rescan test_dir, 'step' directories at a time
+        """
+        rescan = Rescan(self.snapshot, self.test_dir, self._on_event)
+        while not rescan.step(step):
+            pass
+
+
+    def test_first_scan(self):
+        """
+        Test: everything is new for an empty snapshot
+        """
+        self.snapshot = TreeSnapshot()
+        self._rescan(step=1)
+        self.assertEqual(sorted(self.events), [ ('close_write', 'a'), ('close_write', 'b'),
+                                                ('close_write', 'sub/c'), ('create', 'a'),
+                                                ('create', 'b'), ('create', 'sub'),
+                                                ('create', 'sub/c') ])
+        self.assertEqual(len(self.snapshot), 2)
+
+
+    def test_no_change(self):
+        """
+        Test: nothing to report
+        """
+        self._rescan()
+        self.assertEqual(self.events, [])
+
+
+    def test_changes(self):
+        """
+        Test: a new file, a removed file and a written file
+        """
+        open(os.path.join(self.test_dir, 'sub/d'), 'w').close()
+        os.remove(os.path.join(self.test_dir, 'a'))
+        with open(os.path.join(self.test_dir, 'b'), 'w') as myfile:
+            myfile.write('more data')
+        self._rescan()
+        self.assertEqual(sorted(self.events), [ ('close_write', 'b'), ('close_write', 'sub/d'),
+                                                ('create', 'sub/d'), ('delete', 'a') ])
+
+
+    def test_removed_dir(self):
+        """
+        Test: only the top of a removed tree is reported, and forgotten
+        """
+        shutil.rmtree(os.path.join(self.test_dir, 'sub'))
+        self._rescan()
+        self.assertEqual(self.events, [ ('delete', 'sub') ])
+        self.assertEqual(len(self.snapshot), 1)
+
+
+    def test_save_load(self):
+        """
+        Test: a loaded snapshot is the saved one
+        """
+        filename = os.path.join(self.test_dir, 'snapshot')
+        self.snapshot.save(filename, [ self.test_dir ])
+        loaded = TreeSnapshot()
+        loaded.load(filename)
+        self.assertEqual(loaded.dirs, self.snapshot.dirs)
+        self.assertEqual(loaded.mtimes, self.snapshot.mtimes)
+        with open(filename, 'r+b') as snapshot_file:
+            snapshot_file.truncate(os.path.getsize(filename) - 1)
+        self.assertRaises(SnapshotFileError, TreeSnapshot().load, filename)
+
+
+    def test_trust_mtime(self):
+        """
+        Test: the directories whose mtime didn't change are not listed again
+        """
+        # the rescan would see it if it listed test_dir
+        del self.snapshot.dirs[self.test_dir]['a']
+        open(os.path.join(self.test_dir, 'sub/d'), 'w').close()
+        rescan = Rescan(self.snapshot, self.test_dir, self._on_event, trust_mtime=True)
+        rescan.step()
+        self.assertEqual(sorted(self.events), [ ('close_write', 'sub/d'), ('create', 'sub/d') ])
+
+
+    def test_replaced(self):
+        """
+        Test: a file replaced by a directory
+        """
+        os.remove(os.path.join(self.test_dir, 'a'))
+        os.mkdir(os.path.join(self.test_dir, 'a'))
+        self._rescan()
+        self.assertEqual(self.events, [ ('delete', 'a'), ('create', 'a') ])
+
+
+    def test_rename(self):
+        """
+        Test: a renamed directory is not reported by the next rescan
+        """
+        os.rename(os.path.join(self.test_dir, 'sub'), os.path.join(self.test_dir, 'moved'))
+        self.snapshot.rename(os.path.join(self.test_dir, 'sub'), os.path.join(self.test_dir, 'moved'))
+        self.assertEqual(self.snapshot.entries(os.path.join(self.test_dir, 'moved')).keys(), [ 'c' ])
+        self._rescan()
+        self.assertEqual(self.events, [])
+
+
+
+class TestOverflowResync(unittest.TestCase):
+    """
+    We overflow the kernel events queue and check that every
+    file is reported once anyway.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.callbacks = RecordingEventsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.set_overflow_resync(dirs_per_second=100)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_overflow(self):
+        """
+        Test: a create event for each file, even if the queue overflowed
+        """
+        with open('/proc/sys/fs/inotify/max_queued_events') as max_file:
+            max_queued_events = int(max_file.read())
+        if max_queued_events > 50000:
+            self.skipTest('max_queued_events is too big')
+        # 2 events per file
+        files_number = max_queued_events // 2 + 1000
+        create_files(self.test_dir, files_number=files_number)
+        self.stm.process_events(timeout=30, until_predicate=lambda: len(self.callbacks.created) >= files_number
+                                                                    and not self.stm.pending_rescans)
+        self.assertEqual(len(self.callbacks.created), files_number)
+        self.assertEqual(len(set(self.callbacks.created)), files_number)
+        self.assertEqual(self.callbacks.deleted, [])
+
+
+class TestSnapshotFile(unittest.TestCase):
+    """
+    We stop a monitor, change the tree and check the events
+    reported when a new monitor is started.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.snapshot_dir, 'snapshot')
+        create_files(self.test_dir, files_number=5, dirs_number=5)
+        self.stm = None
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+        shutil.rmtree(self.snapshot_dir)
+
+
+    def _start(self, callbacks=None, queue_bound=None):
+        """
+        Start a new monitor using the snapshot file
+        """
+        self.callbacks = callbacks or RecordingEventsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        if queue_bound is not None:
+            self.stm.set_events_queue_bound(queue_bound)
+        self.stm.set_snapshot_file(self.snapshot_file)
+        self.stm.start()
+        # nothing consumes the events yet in multiprocessing mode : it
+        # must not wait for the room of a full bounded queue
+        thread = threading.Thread(target=self.stm.add_source_dir, args=(self.test_dir,))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'add_source_dir is blocked')
+        if callbacks is None:
+            self.stm.process_events(timeout=0.2)
+
+
+    def test_restart(self):
+        """
+        Test: only the changes made while we were down are reported
+        """
+        self._start()
+        self.assertEqual(self.callbacks.created, [])
+        self.stm.stop()
+
+        subdir = sorted(os.listdir(self.test_dir))[0]
+        removed = os.path.join(self.test_dir, subdir, sorted(os.listdir(os.path.join(self.test_dir, subdir)))[0])
+        os.remove(removed)
+        os.mkdir(os.path.join(self.test_dir, 'new'))
+        create_files(os.path.join(self.test_dir, 'new'), files_number=2)
+
+        self._start()
+        self.assertEqual(len(self.callbacks.created), 3)
+        self.assertEqual(len(self.callbacks.written), 2)
+        self.assertEqual(self.callbacks.deleted, [ removed ])
+        self.assertEqual(len(self.stm.watches), 7)
+
+
+    def test_restart_rewritten(self):
+        """
+        Test: the files written in place while we were down are reported,
+        even if their directory mtime didn't change
+        """
+        self._start()
+        self.stm.stop()
+
+        subdir = os.path.join(self.test_dir, sorted(os.listdir(self.test_dir))[0])
+        path = os.path.join(subdir, sorted(os.listdir(subdir))[0])
+        mtime = os.stat(subdir).st_mtime
+        with open(path, 'a') as myfile:
+            myfile.write('more data')
+        self.assertEqual(os.stat(subdir).st_mtime, mtime)
+
+        self._start()
+        self.assertEqual(self.callbacks.created, [])
+        self.assertEqual(self.callbacks.written, [ path ])
+
+
+    def test_restart_bounded_multiprocessing(self):
+        """
+        Test: the changes overflowing a bounded multiprocessing queue are
+        reported once the worker processes are started
+        """
+        self._start()
+        self.stm.stop()
+
+        os.mkdir(os.path.join(self.test_dir, 'new'))
+        create_files(os.path.join(self.test_dir, 'new'), files_number=10)
+
+        callbacks = CountingEventsCallbacks()
+        self._start(callbacks=callbacks, queue_bound=2)
+        self.stm.process_events(timeout=5, until_predicate=lambda: callbacks.written.value == 10)
+        self.assertEqual(callbacks.created.value, 11)
+        self.assertEqual(callbacks.written.value, 10)
+        self.assertEqual(len(self.stm.watches), 7)
+
+
+# see helper.py file and the tests_runner comments
+TESTS_TO_RUN = [ "TestRescan", "TestOverflowResync", "TestSnapshotFile" ]
+
+if __name__ == "__main__":
+    helper.tests_runner(__file__)
@@ -20,6 +20,9 @@ The callbacks themself can be in different threads too.
 
 import os
 import sys
+import shutil
+import tempfile
+import unittest
 import threading
 
 import helper
@@ -31,8 +34,8 @@ except ImportError:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
     import treewatcher
 
-from treewatcher import ThreadedEventsCallbacks
-from scenarios import TestTreeWatcher
+from treewatcher import ThreadedEventsCallbacks, choose_source_tree_monitor
+from scenarios import TestTreeWatcher, create_files
 
 
 class ThreadedTestsCallbacks(ThreadedEventsCallbacks):
@@ -148,12 +151,121 @@ class TestEightThreadsTreeWatcher(TestTreeWatcher):
         self.setup_helper(callbacks=ThreadedTestsCallbacks(), workers=8)
 
 
+class TestFourThreadsBatchedTreeWatcher(TestTreeWatcher):
+    """
+    Same as TestFourThreadsTreeWatcher, but the events are put
+    in the events queue by batches.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=ThreadedTestsCallbacks(), workers=4, batching=True)
+
+
+class TestFourThreadsPartitionedTreeWatcher(TestTreeWatcher):
+    """
+    Same as TestFourThreadsTreeWatcher, but each thread
+    has its own queue.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=ThreadedTestsCallbacks(), workers=4, partitioned=True)
+
+
+class TestFourThreadsBoundedTreeWatcher(TestTreeWatcher):
+    """
+    Same as TestFourThreadsTreeWatcher, but the events queue
+    is bounded : the monitor waits for the threads when it's full.
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.setup_helper(callbacks=ThreadedTestsCallbacks(), workers=4, queue_bound=3)
+
+
+class OrderingTestsCallbacks(ThreadedEventsCallbacks):
+    """
+    We record which thread handles which event
+    """
+    def __init__(self):
+        """
+        list.append is thread safe
+        """
+        ThreadedEventsCallbacks.__init__(self)
+        self.records = []
+
+
+    def create(self, path, is_dir):
+        """ Record """
+        self.records.append(('create', path, threading.current_thread().name))
+
+
+    def close_write(self, path, is_dir):
+        """ Record """
+        self.records.append(('close_write', path, threading.current_thread().name))
+
+
+class TestPartitionedOrdering(unittest.TestCase):
+    """
+    We check that all the events of a file are handled by the same thread, in order
+    """
+    def setUp(self):
+        """
+        This function is called before each test
+        We create and start our tree watcher
+        """
+        self.test_dir = tempfile.mkdtemp()
+        self.callbacks = OrderingTestsCallbacks()
+        self.stm = choose_source_tree_monitor()
+        self.stm.set_events_callbacks(self.callbacks)
+        self.stm.set_workers_number(4)
+        self.stm.set_events_partitioning(True)
+        self.stm.start()
+        self.stm.add_source_dir(self.test_dir)
+
+
+    def tearDown(self):
+        """
+        This function is called after each test
+        """
+        self.stm.stop()
+        shutil.rmtree(self.test_dir)
+
+
+    def test_ordering(self):
+        """
+        Test: create and close_write of each file go to the same thread, in order
+        """
+        create_files(self.test_dir, files_number=200)
+        self.stm.process_events(timeout=2, until_predicate=lambda: len(self.callbacks.records) == 400)
+
+        threads = {}
+        for event, path, thread_name in self.callbacks.records:
+            threads.setdefault(path, []).append((event, thread_name))
+        self.assertEqual(len(threads), 200)
+        for path, events in threads.iteritems():
+            self.assertEqual([ event for event, _ in events ], ['create', 'close_write'])
+            self.assertEqual(events[0][1], events[1][1])
+        self.assertEqual(len(set([ events[0][1] for events in threads.itervalues() ])), 4)
+
+
 # see helper.py file and the tests_runner comments
 TESTS_TO_RUN = [ \
                  "TestOneThreadTreeWatcher", \
                  "TestTwoThreadsTreeWatcher", \
                  "TestFourThreadsTreeWatcher", \
-                 "TestEightThreadsTreeWatcher" \
+                 "TestEightThreadsTreeWatcher", \
+                 "TestFourThreadsBatchedTreeWatcher", \
+                 "TestFourThreadsPartitionedTreeWatcher", \
+                 "TestFourThreadsBoundedTreeWatcher", \
+                 "TestPartitionedOrdering" \
                ]
 
 if __name__ == "__main__":
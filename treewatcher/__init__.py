@@ -21,11 +21,23 @@ EventsCallbacks
 
 import os
 import sys
+import math
+import time
+import errno
+import fcntl
+import select
+import signal
 import logging
 import threading
 import multiprocessing
 import Queue
 
+from treewatcher.crawler import TreeCrawler
+from treewatcher.events import Event
+from treewatcher.filters import PathFilter
+from treewatcher.metrics import Metrics
+from treewatcher.queues import QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_COALESCE, \
+                               QUEUE_POLICIES, BoundedEventsQueue, new_queue_counters, put_in_process_queue
 
 _SOURCETREEMON_LOGGER = logging.getLogger('_SOURCETREEMON_LOGGER')
 _SOURCETREEMON_LOGGER.setLevel(logging.INFO)
@@ -33,9 +45,40 @@ _SOURCETREEMON_LOGGER.addHandler(logging.StreamHandler())
 
 
 SOURCE_TREE_MONITORS = (
+  'treewatcher.inotify_.InotifySourceTreeMonitor',
   'treewatcher.inotifyx_.InotifyxSourceTreeMonitor',
+  # does not rely on inotify, see polling.py
+  'treewatcher.polling.PollingSourceTreeMonitor',
 )
 
+# the events put in the events queue are Event objects (see events.py).
+# The code of an event is its index in EVENTS_NAMES.
+# The path of a 'moved' event is a (source path, destination path) pair, its
+# callback is called as moved(src, dst, is_dir).
+# 'ready' is only reported by the coalescing stage (see set_events_coalescing).
+EVENTS_NAMES = ( 'create', \
+                 'delete', \
+                 'close_write', \
+                 'moved_from', \
+                 'moved_to', \
+                 'modify', \
+                 'attrib', \
+                 'unmount', \
+                 'moved', \
+                 'ready' )
+
+( EVENT_CREATE, \
+  EVENT_DELETE, \
+  EVENT_CLOSE_WRITE, \
+  EVENT_MOVED_FROM, \
+  EVENT_MOVED_TO, \
+  EVENT_MODIFY, \
+  EVENT_ATTRIB, \
+  EVENT_UNMOUNT, \
+  EVENT_MOVED, \
+  EVENT_READY ) = range(len(EVENTS_NAMES))
+
+
 class MissingDependency(Exception):
     """
     Give an explicit exception name in the context
@@ -44,6 +87,14 @@ class MissingDependency(Exception):
     pass
 
 
+class WatchBudgetExhausted(Exception):
+    """
+    A directory cannot be watched : the watches budget of the monitor,
+    or the max_user_watches kernel limit, is exhausted (see budget.py)
+    """
+    pass
+
+
 def _import_name(name):
     """
     Imports a Python module referred to by name, and returns that module.
@@ -102,34 +153,44 @@ def choose_source_tree_monitor(stm_dotted_name = None):
     raise AssertionError('unable to find a usable source tree monitor')
 
 
+def _no_callback(*args):
+    """
+    Callback used for the events without callback, when they are kept anyway
+    """
+    pass
+
+
+def _moved_callback(moved):
+    """
+    Adapt a moved(src, dst, is_dir) callback to the (path, is_dir) calling
+    convention of the events queue consumers
+    """
+    def callback(paths, is_dir):
+        """ (src, dst), is_dir -> src, dst, is_dir """
+        return moved(paths[0], paths[1], is_dir)
+    return callback
+
+
 class _EventsCallbacks(object):
     """
     Internal base class for defining events callback.
 
-    The implementation is quite tricky, but quite pretty i think.
+    The tree monitor looks for the callbacks once, when the callbacks object is set
+    (see SourceTreeMonitor.set_events_callbacks), and build a table giving the
+    callback of each event code (see EVENTS_NAMES). Events without callback are
+    dropped before being put in the events queue.
 
-    The main idea is that the tree monitor will internally call _create, _close_write, etc..
-    (underscore + event name) and that we use some __getattribute__ magic to put the event is
-    the events queue.
+    The callbacks are called as callback(path, is_dir). If raw_events is True,
+    they are called as callback(event) with the Event object instead, to get
+    the inotify cookie and mask of the events (see events.py).
     """
+    raw_events = False
 
     def __init__(self, _serial=True, _threaded=False, _multiprocesses=False):
         """
-        This is an internal class with dirty hacks.
+        Internal init
         """
         self._stm = None
-        # _valid_events_internal needs to be defined here because of the test
-        # in __getattribute__
-        self._valid_events_internal = []
-        valid_events = [ 'create', \
-                              'delete', \
-                              'close_write', \
-                              'moved_from', \
-                              'moved_to', \
-                              'modify', \
-                              'attrib', \
-                              'unmount' ]
-        self._valid_events_internal = [ '_' + value for value in valid_events ]
         self._serial = _serial
         self._threaded = _threaded
         self._multiprocessing = _multiprocesses
@@ -138,23 +199,10 @@ class _EventsCallbacks(object):
                 "A events callbacks object must be serial OR threaded OR multiprocessing"
 
 
-    def __getattribute__(self, attr):
-        """
-        __getattribute__ with some lambda : dirty and magic.
-        """
-        if attr in object.__getattribute__(self, '_valid_events_internal'):
-            # we return a lambda which is bind to a function that will put a triplet (event, path, is_dir)
-            # on the event queue. We removed the first char '_' of attr to match the actual name in the 
-            # child class
-            return lambda path, is_dir: object.__getattribute__(self, '_stm').events_queue.put((attr[1:], path, is_dir))
-        else:
-            return object.__getattribute__(self, attr)
-
-
 class EventsCallbacks(_EventsCallbacks):
     """
     Easy to use : inherit from it and implement a create, delete, close_write... function
-    (see valid_events for a complete list), that's all.
+    (see EVENTS_NAMES for a complete list), that's all.
 
     This class is for events that will be treated in the same process as the monitor
     """
@@ -176,15 +224,41 @@ class ThreadedEventsCallbacks(_EventsCallbacks):
 
 class MultiProcessingEventsCallbacks(_EventsCallbacks):
     """
-    !!! DOES NOT WORK the way i want. DO NOT USE !!!
-    Just like EventsCallbacks, but since each function can be eventually called
-    from different processes, you have to protect the shared state, if you've got one.
+    Just like EventsCallbacks, but the callbacks are called from a pool of worker
+    processes (see set_workers_number).
+
+    The worker processes are started by the first process_events call and are
+    kept until the monitor is stopped. Each worker has its own queue and the
+    events are routed using the hash of their path : all the events of a given
+    path are handled by the same worker, in order.
+
+    Each worker gets a copy of the callbacks object. Attributes set in init_worker
+    are local to the worker (open files, connections to a database ...). State
+    shared between workers and with the monitor process must be stored in
+    multiprocessing objects (Value, Lock, Manager ...) created in __init__.
+
+    An exception raised by a callback is logged, the worker goes on with the next event.
     """
     def __init__(self):
         """ init """
         _EventsCallbacks.__init__(self, _serial=False, _multiprocesses=True)
 
 
+    def init_worker(self, worker_index):
+        """
+        Called in each worker process before it handles its first event.
+        worker_index goes from 0 to the number of workers - 1.
+        """
+        pass
+
+
+    def finish_worker(self, worker_index):
+        """
+        Called in each worker process when the monitor is stopped
+        """
+        pass
+
+
 class SourceTreeMonitor(object):
     """
     Source tree monitors need to implement this interface
@@ -196,9 +270,80 @@ class SourceTreeMonitor(object):
         self.events_callbacks = None
         # the events queue type depends on the type of self.events_callbacks
         self.events_queue = None
+        # one queue per worker in multiprocessing mode and in partitioned
+        # threaded mode, only self.events_queue otherwise
+        self.events_queues = []
+        # callback of each event code, None if not implemented
+        self._callbacks_table = [ None ] * len(EVENTS_NAMES)
+        # keep the events without callback (see _build_callbacks_table)
+        self._all_events = False
+        # report the moves as moved events (see _build_callbacks_table)
+        self._pair_moves = False
+        # see set_events_partitioning
+        self._partitioned = False
+        self._partition_key = None
+        # threads/processes handling the callbacks
+        self._worker_threads = []
+        self._worker_processes = []
+        # the queues of the worker processes have been closed
+        self._queues_closed = False
         # represents the number of threads/processes that will be use
         # to handle the callbacks
         self.workers = 1
+        # used to add the watches on a whole tree
+        self.crawler = TreeCrawler()
+        # events waiting to be put in the events queue as a single
+        # list, None if batching is disabled (see set_events_batching)
+        self._events_batch = None
+        # maximum number of directories crawled between two reads
+        # of the events, None means crawl new trees at once
+        self.crawl_step = None
+        # see set_path_filters
+        self.path_filter = None
+        # see set_events_queue_bound
+        self._queue_bound = None
+        self._queue_policy = QUEUE_BLOCK
+        self.queue_counters = new_queue_counters()
+        # called instead of _call_callbacks to drain a full bounded queue,
+        # by the front-ends dispatching the events themselves (see asyncio_.py)
+        self._drain_hook = None
+        # see set_stats
+        self.metrics = None
+        # time of the current read of the events, None means now (see _emit)
+        self._read_time = None
+        # kernel events queue overflows
+        self.overflows = 0
+        # see set_events_coalescing
+        self.coalescer = None
+        # self-pipe used to wake up process_events (see interrupt)
+        self._wakeup_fds = None
+        self._interrupted = False
+
+
+    def _new_queue(self):
+        """
+        Returns a new in-process events queue, bounded or not
+        """
+        if self._queue_bound is None:
+            return Queue.Queue()
+        events_queue = BoundedEventsQueue(self._queue_bound, self._queue_policy, self.queue_counters)
+        # no thread is consuming it yet (see _start_workers)
+        events_queue.drain = self._drain_events_queue
+        return events_queue
+
+
+    def _drain_events_queue(self, events_queue):
+        """
+        Called by a full bounded queue when nobody else is consuming it
+        (serial mode, or threaded mode outside process_events) : instead of
+        waiting forever, we call the callbacks of its events ourself, or let
+        the front-end dispatch them (see _drain_hook).
+        """
+        if self._drain_hook is not None:
+            self._drain_hook()
+            return
+        events_queue.put(StopIteration)
+        self._call_callbacks(events_queue)
 
 
     def reset_queue(self):
@@ -207,16 +352,208 @@ class SourceTreeMonitor(object):
         callbacks type (serial, threaded, etc ...)
         """
         if self.events_callbacks._multiprocessing:
-            self.events_queue = multiprocessing.JoinableQueue()
+            self.events_queues = [ multiprocessing.JoinableQueue(self._queue_bound or 0) \
+                                   for _ in range(self.workers) ]
+        elif self.events_callbacks._threaded and self._partitioned:
+            self.events_queues = [ self._new_queue() for _ in range(self.workers) ]
         else:
-            self.events_queue = Queue.Queue()
+            self.events_queues = [ self._new_queue() ]
+        self.events_queue = self.events_queues[0]
+        self._queues_closed = False
 
 
     def set_events_callbacks(self, events_obj):
         """ set the callbacks object for this monitor (see class EventsCallbacks) """
+        assert not self._worker_processes, "Cannot change the callbacks while the worker processes are running"
+        if events_obj._multiprocessing and self._queue_bound is not None and self._queue_policy == QUEUE_COALESCE:
+            raise ValueError('QUEUE_COALESCE is not available in multiprocessing mode')
         self.events_callbacks = events_obj
         self.events_callbacks._stm = self
+        self._build_callbacks_table()
         self.reset_queue()
+        if self.metrics is not None:
+            # the histograms have to be shared with the worker processes
+            self.set_stats()
+
+
+    def _build_callbacks_table(self):
+        """
+        Look for the callback of each event. If _all_events is True, the
+        events without callbacks are put in the events queue anyway (they are
+        used by the asyncio front-end streams) : we use a no-op callback.
+
+        The moved_from/moved_to pairs are reported as a single moved event
+        only if the callbacks object implements moved.
+        """
+        self._callbacks_table = []
+        for name in EVENTS_NAMES:
+            callback = getattr(self.events_callbacks, name, None)
+            if callback is not None and name == 'moved' and not self.events_callbacks.raw_events:
+                callback = _moved_callback(callback)
+            elif callback is None and self._all_events:
+                callback = _no_callback
+            self._callbacks_table.append(callback)
+        self._pair_moves = getattr(self.events_callbacks, 'moved', None) is not None
+        if self.coalescer is not None:
+            self.coalescer.ready = self._report_ready()
+
+
+    def set_events_batching(self, batching):
+        """
+        If batching is True, the events decoded from one read of the
+        kernel events are put in the events queue as a single list instead
+        of one by one. In threaded and multiprocessing mode, the list is
+        split in one chunk per worker.
+        """
+        if batching:
+            self._events_batch = []
+        else:
+            self._events_batch = None
+
+
+    def set_events_partitioning(self, partitioned=True, key=None):
+        """
+        In threaded mode, give each worker thread its own queue and route the
+        events using the hash of key(path) (the path itself if key is None).
+        All the events with the same key are handled by the same thread, in
+        order, while the others are still handled in parallel.
+        Use key=os.path.dirname to keep the order per directory.
+
+        The multiprocessing mode is always partitioned, key is used there too.
+        """
+        self._partitioned = partitioned
+        self._partition_key = key
+        if self.events_callbacks is not None:
+            self.reset_queue()
+
+
+    def set_events_queue_bound(self, bound, policy=QUEUE_BLOCK):
+        """
+        Hold at most 'bound' events in each events queue (None means no bound).
+        When a queue is full, 'policy' is applied (see queues.py) :
+        QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST or QUEUE_COALESCE.
+        The dropped, coalesced and blocked events are counted in queue_counters.
+
+        In multiprocessing mode, the bound is a number of queue items (batches
+        count for one) and QUEUE_COALESCE is not available.
+        """
+        assert not self._worker_processes, "Cannot change the queue bound while the worker processes are running"
+        if policy not in QUEUE_POLICIES:
+            raise ValueError('unknown queue policy %r' % (policy,))
+        if bound is not None and bound < 1:
+            raise ValueError('the queue bound must be at least 1')
+        if policy == QUEUE_COALESCE and self.events_callbacks is not None and \
+           self.events_callbacks._multiprocessing:
+            raise ValueError('QUEUE_COALESCE is not available in multiprocessing mode')
+        self._queue_bound = bound
+        self._queue_policy = policy
+        if self.events_callbacks is not None:
+            self.reset_queue()
+
+
+    def _queue_put(self, events_queue, item):
+        """
+        Put 'item' in 'events_queue', applying the policy of the bound if needed
+        """
+        if self._queue_bound is not None and self.events_callbacks._multiprocessing:
+            put_in_process_queue(events_queue, item, self._queue_policy, self.queue_counters)
+        else:
+            events_queue.put(item)
+        if self.metrics is not None:
+            depth = events_queue.qsize()
+            if depth > self.metrics.max_queue_depth:
+                self.metrics.max_queue_depth = depth
+
+
+    def _partition(self, event):
+        """
+        Returns the index of the queue of 'event' when there is one queue per worker.
+        A moved event is routed like the events of its destination path.
+        """
+        path = event.path
+        if event.code == EVENT_MOVED:
+            path = path[1]
+        if self._partition_key is None:
+            return hash(path) % len(self.events_queues)
+        return hash(self._partition_key(path)) % len(self.events_queues)
+
+
+    def _emit(self, code, path, is_dir):
+        """
+        Put an event in the events queue, through the coalescing stage if enabled.
+        Nothing is built for the events without callback.
+        """
+        if self.coalescer is not None:
+            self.coalescer.add(code, path, is_dir)
+        elif self._callbacks_table[code] is not None:
+            self._queue_event(Event(code, path, None, is_dir, 0, 0, self._read_time))
+
+
+    def _emit_event(self, event):
+        """
+        Same as _emit for an Event built by the monitor : its path is
+        only built if the coalescing stage or the callback needs it
+        """
+        if self.coalescer is not None:
+            self.coalescer.add(event.code, event.path, event.is_dir)
+        elif self._callbacks_table[event.code] is not None:
+            self._queue_event(event)
+
+
+    def _queue_coalesced(self, code, path, is_dir):
+        """
+        Put an event reported by the coalescing stage in the events queue
+        """
+        if self._callbacks_table[code] is not None:
+            self._queue_event(Event(code, path, None, is_dir, 0, 0, self._read_time))
+
+
+    def _queue_event(self, event):
+        """
+        Put an event having a callback in the events queue
+        """
+        if self.metrics is not None:
+            self.metrics.events[event.code] += 1
+            if event.read_time is None:
+                event.read_time = time.time()
+        self._put_event(event)
+
+
+    def _put_event(self, event):
+        """
+        Put an event in the events queue, or in the current batch
+        """
+        if self._events_batch is not None:
+            self._events_batch.append(event)
+        elif len(self.events_queues) == 1:
+            self._queue_put(self.events_queue, event)
+        else:
+            self._queue_put(self.events_queues[self._partition(event)], event)
+
+
+    def _flush_events_batch(self):
+        """
+        Put the current batch of events in the events queue
+        """
+        batch = self._events_batch
+        if not batch:
+            return
+        self._events_batch = []
+        if len(self.events_queues) > 1:
+            # each worker gets the events of its own queue
+            chunks = [ [] for _ in self.events_queues ]
+            for event in batch:
+                chunks[self._partition(event)].append(event)
+            for events_queue, chunk in zip(self.events_queues, chunks):
+                if chunk:
+                    self._queue_put(events_queue, chunk)
+        elif self.events_callbacks._serial or self.workers == 1 or len(batch) < 2 * self.workers:
+            self._queue_put(self.events_queue, batch)
+        else:
+            # each worker gets a chunk
+            size = (len(batch) + self.workers - 1) // self.workers
+            for start in xrange(0, len(batch), size):
+                self._queue_put(self.events_queue, batch[start:start + size])
 
 
     def set_workers_number(self, workers):
@@ -224,7 +561,387 @@ class SourceTreeMonitor(object):
         Set the number of threads/processes that will be use to handle
         the callbacks
         """
+        assert not self._worker_processes, "Cannot change the number of workers while the worker processes are running"
         self.workers = workers
+        if self.events_callbacks is not None:
+            self.reset_queue()
+
+
+    def _open_wakeup_pipe(self):
+        """
+        Create the self-pipe used to wake up process_events (see _wakeup).
+        Called by start.
+        """
+        self._wakeup_fds = os.pipe()
+        for fd in self._wakeup_fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+    def _close_wakeup_pipe(self):
+        """
+        Close the self-pipe. Called by stop.
+        """
+        map(os.close, self._wakeup_fds)
+
+
+    def _drain_wakeup(self):
+        """
+        Empty the wakeup pipe
+        """
+        try:
+            while os.read(self._wakeup_fds[0], 4096):
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+
+    def _wakeup(self):
+        """
+        Wake up process_events if it is waiting. The workers call it when
+        they have emptied their queue, so that the predicate is reevaluated.
+        It's safe to call it from any thread or worker process.
+        """
+        try:
+            os.write(self._wakeup_fds[1], 'x')
+        except OSError, err:
+            # EAGAIN : the pipe is full, process_events will wake up anyway
+            if err.errno != errno.EAGAIN:
+                raise
+
+
+    def _call_callbacks(self, events_queue, safe=False):
+        """
+        Get the events from 'events_queue' and call the callbacks until we get StopIteration.
+        If 'safe' is True, the exceptions raised by the callbacks are logged and ignored.
+        """
+        events_callbacks = self.events_callbacks
+        callbacks_table = self._callbacks_table
+        joinable = events_callbacks._multiprocessing
+        timed = self.metrics is not None
+        raw = events_callbacks.raw_events
+        while True:
+            item = events_queue.get()
+            try:
+                if item is StopIteration:
+                    break
+                # in batching mode, we retrieve a list of events
+                if type(item) is list:
+                    events = item
+                else:
+                    events = (item,)
+                for event in events:
+                    # we call the adequate function of the events_callbacks object
+                    if timed:
+                        self._timed_call(callbacks_table[event.code], event, safe, raw)
+                        continue
+                    try:
+                        if raw:
+                            callbacks_table[event.code](event)
+                        else:
+                            callbacks_table[event.code](event.path, event.is_dir)
+                    except Exception:
+                        if not safe:
+                            raise
+                        _SOURCETREEMON_LOGGER.exception('callback %s failed on %s' % \
+                                                        (EVENTS_NAMES[event.code], event.path))
+            finally:
+                if joinable:
+                    events_queue.task_done()
+            # if we were the last one to work, let the monitor
+            # reevaluate its predicate
+            if not events_callbacks._serial and events_queue.empty():
+                self._wakeup()
+
+
+    def _timed_call(self, callback, event, safe, raw=False):
+        """
+        Call 'callback' for 'event', feeding the histograms of the metrics.
+        The events carry the time they were read (see _queue_event).
+        """
+        metrics = self.metrics
+        start = time.time()
+        if event.read_time is not None:
+            metrics.latency.observe(start - event.read_time)
+        try:
+            if raw:
+                callback(event)
+            else:
+                callback(event.path, event.is_dir)
+        except Exception:
+            if not safe:
+                raise
+            _SOURCETREEMON_LOGGER.exception('callback %s failed on %s' % \
+                                            (EVENTS_NAMES[event.code], event.path))
+        finally:
+            metrics.duration.observe(time.time() - start)
+
+
+    def _start_events_queue_processing(self, ev_queue=None, worker_index=None):
+        """
+        This internal function encapsulate the logic around the events_queue
+        depending on the type of the callback.
+
+        This function is used in serial, threaded an multiprocessing mode.
+        In the last two mode, this function is the target argument of the
+        Thread/Process constructor
+        """
+        if ev_queue is None:
+            events_queue = self.events_queue
+        else:
+            events_queue = ev_queue
+
+        if self.events_callbacks._multiprocessing:
+            # the monitor process handles SIGINT and stops us using StopIteration
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.events_callbacks.init_worker(worker_index)
+            try:
+                self._call_callbacks(events_queue, safe=True)
+            finally:
+                self.events_callbacks.finish_worker(worker_index)
+            return
+
+        self._call_callbacks(events_queue)
+        # need to put StopIteration here to handle threads join
+        # when they share the same queue !
+        if self.events_callbacks._threaded and len(self.events_queues) == 1:
+            events_queue.put(StopIteration)
+
+
+    def _dispatch_events(self):
+        """
+        In serial mode, call the callbacks of the queued events.
+        Nothing to do in the other modes.
+        """
+        if self.events_callbacks._serial:
+            self.events_queue.put(StopIteration)
+            self._start_events_queue_processing()
+
+
+    def _start_workers(self):
+        """
+        Start the threads/processes handling the callbacks.
+
+        Threads are started for each process_events call, they share the same
+        queue unless the partitioning is enabled. Worker processes are started
+        once, with their own queue, and kept until stop().
+        """
+        if self.events_callbacks._threaded:
+            for events_queue in self.events_queues:
+                if isinstance(events_queue, BoundedEventsQueue):
+                    # the worker threads will make some room
+                    events_queue.drain = None
+            for worker_index in range(self.workers):
+                events_queue = self.events_queues[worker_index % len(self.events_queues)]
+                thread = threading.Thread(target=self._start_events_queue_processing,
+                                          args=(events_queue, worker_index))
+                thread.start()
+                self._worker_threads.append(thread)
+        elif self.events_callbacks._multiprocessing and not self._worker_processes:
+            if self._queues_closed:
+                # see _stop_worker_processes
+                self.reset_queue()
+            for worker_index, events_queue in enumerate(self.events_queues):
+                process = multiprocessing.Process(target=self._start_events_queue_processing,
+                                                  args=(events_queue, worker_index))
+                # we don't want them to survive the monitor process
+                process.daemon = True
+                process.start()
+                self._worker_processes.append(process)
+
+
+    def _finish_workers(self):
+        """
+        Wait until the queued events have been handled.
+        Threads are stopped, worker processes are kept.
+        """
+        if self.events_callbacks._multiprocessing:
+            for events_queue in self.events_queues:
+                events_queue.join()
+            return
+
+        if self.events_callbacks._threaded:
+            # we tell the threads to stop
+            for events_queue in self.events_queues:
+                events_queue.put(StopIteration)
+            for thread in self._worker_threads:
+                thread.join()
+            self._worker_threads = []
+        # we replace the current queue by an empty one
+        self.reset_queue()
+
+
+    def _stop_worker_processes(self):
+        """
+        Tell the worker processes to stop and wait for them
+        """
+        if not self._worker_processes:
+            return
+        for events_queue in self.events_queues:
+            events_queue.put(StopIteration)
+        for process in self._worker_processes:
+            process.join()
+        self._worker_processes = []
+        # their pipes and feeder threads would survive the monitor. New
+        # queues are created if the workers are started again.
+        for events_queue in self.events_queues:
+            events_queue.close()
+            events_queue.join_thread()
+        self._queues_closed = True
+
+
+    def set_crawler_workers_number(self, workers):
+        """
+        Set the number of threads listing the directories when a tree
+        is added (see crawler.py). The watches are always added from
+        the monitor thread.
+        """
+        self.crawler.workers = workers
+
+
+    def set_crawl_progress_callback(self, callback, every=1000):
+        """
+        callback(root, dirs, entries, done) will be called every 'every'
+        directories while a tree is added, and when it's done.
+        """
+        self.crawler.progress_callback = callback
+        self.crawler.progress_every = every
+
+
+    def set_crawler_max_frontier(self, size):
+        """
+        Set the most directories waiting to be listed a crawl holds.
+        When it's reached, the crawler goes depth first to bound its memory.
+        """
+        if size < 1:
+            raise ValueError('the frontier must hold at least 1 directory')
+        self.crawler.max_frontier = size
+
+
+    def set_crawl_step(self, dirs):
+        """
+        Crawl the new trees incrementally : at most 'dirs' directories are
+        listed between two reads of the events in process_events.
+        add_source_dir returns as soon as the root directory is watched.
+        None (default) means that the new trees are crawled at once.
+        """
+        self.crawl_step = dirs
+
+
+    def set_stats(self, enabled=True):
+        """
+        Count the events and measure the callbacks latency and duration
+        (see metrics.py and stats). It's disabled by default : each event
+        carries its read time when it's enabled.
+        """
+        assert not self._worker_processes, "Cannot change the stats while the worker processes are running"
+        if not enabled:
+            self.metrics = None
+            return
+        shared = self.events_callbacks is not None and self.events_callbacks._multiprocessing
+        self.metrics = Metrics(len(EVENTS_NAMES), shared=shared)
+
+
+    def stats(self):
+        """
+        Returns a dict of statistics :
+         - 'watches' : number of watched directories (None if not relevant),
+         - 'registry_bytes' : approximate memory used by the registry of the
+           watched directories (None if not relevant),
+         - 'read_buffer' : number of events read by the reader threads and
+           not processed yet (None without reader threads),
+         - 'queue_depth' : number of items in the events queues,
+         - 'overflows' : number of kernel events queue overflows,
+         - 'queue' : see queue_counters.
+        If the coalescing stage is enabled (see set_events_coalescing) :
+         - 'coalescing' : {'pending': number of paths holding events,
+                           'merged': number of events merged}.
+        And if the stats are enabled (see set_stats) :
+         - 'events' : {event name: number of events queued},
+         - 'max_queue_depth' : most items seen in an events queue,
+         - 'latency' : histogram of the time between the read of the events
+           and the start of their callbacks, in seconds (see Histogram.read),
+         - 'duration' : histogram of the duration of the callbacks.
+        """
+        stats = {
+          'watches': None,
+          'registry_bytes': None,
+          'read_buffer': None,
+          'queue_depth': sum(events_queue.qsize() for events_queue in self.events_queues),
+          'overflows': self.overflows,
+          'queue': dict(self.queue_counters),
+        }
+        if self.coalescer is not None:
+            stats['coalescing'] = {'pending': len(self.coalescer), 'merged': self.coalescer.merged}
+        if self.metrics is not None:
+            stats['events'] = dict(zip(EVENTS_NAMES, self.metrics.events))
+            stats['max_queue_depth'] = self.metrics.max_queue_depth
+            stats['latency'] = self.metrics.latency.read()
+            stats['duration'] = self.metrics.duration.read()
+        return stats
+
+
+    def set_events_coalescing(self, quiet=None):
+        """
+        Hold the events of each path until it has been quiet for 'quiet'
+        seconds, and merge them (see coalescing.py) : a file copy is reported
+        as a create and a close_write, or as a single ready event if the
+        callbacks implement ready(path, is_dir). None disables it.
+
+        The held events are reported by process_events (see _periodic_work).
+        """
+        if quiet is None:
+            if self.coalescer is not None:
+                self.coalescer.report_all()
+                self._flush_events_batch()
+            self.coalescer = None
+            return
+        # coalescing.py needs the events codes defined here
+        from treewatcher.coalescing import EventsCoalescer
+        self.coalescer = EventsCoalescer(quiet, self._queue_coalesced, self._report_ready())
+
+
+    def _report_ready(self):
+        """
+        Returns True if the callbacks object implements ready
+        """
+        return getattr(self.events_callbacks, 'ready', None) is not None
+
+
+    def _periodic_work(self):
+        """
+        Do the work which doesn't wait for new events : report the events of
+        the coalescing stage whose path is quiet. Returns the time at which it
+        has to be done again, None if nothing is scheduled.
+        It's done by process_events, or by the event loop (see asyncio_.py).
+        """
+        if self.coalescer is None:
+            return None
+        if self.coalescer.due():
+            self._report_coalesced()
+        return self.coalescer.next_deadline()
+
+
+    def _report_coalesced(self):
+        """
+        Put the events of the quiet paths in the events queue
+        """
+        if self.coalescer is not None:
+            self.coalescer.report_due()
+            self._flush_events_batch()
+
+
+    def set_path_filters(self, include=(), exclude=()):
+        """
+        Ignore the entries matching one of the 'exclude' rules, and the files
+        matching none of the 'include' rules if any (see filters.py).
+        The excluded directories are neither watched nor crawled.
+        It applies to the source dirs added afterwards.
+        """
+        if include or exclude:
+            self.path_filter = PathFilter(include, exclude)
+        else:
+            self.path_filter = None
 
 
     def start(self, debug = False):
@@ -233,12 +950,126 @@ class SourceTreeMonitor(object):
     def stop(self):
         """Stop monitoring the source tree; clean up."""
 
-    def process_events(self):
-        """Process pending events.  Do not block."""
+    def _new_poller(self):
+        """
+        Returns the select.poll object process_events waits on : the wakeup
+        pipe, and the file descriptors of the monitor giving the events.
+        """
+        poller = select.poll()
+        poller.register(self._wakeup_fds[0], select.POLLIN)
+        return poller
+
+
+    def _wait_for_events(self, poller, wait):
+        """
+        Block until events are available, someone called _wakeup or 'wait'
+        seconds elapsed (forever if wait is None).
+        Returns True if events are available (see read_events).
+        """
+        if wait is not None:
+            # poll wants milliseconds. Rounding up prevents a busy loop
+            # when less than a millisecond remains.
+            wait = int(math.ceil(wait * 1000))
+        try:
+            ready = poller.poll(wait)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return False
+            raise
+
+        events_ready = False
+        for fd, _ in ready:
+            if fd == self._wakeup_fds[0]:
+                self._drain_wakeup()
+            else:
+                events_ready = True
+        return events_ready
+
+
+    def process_events(self, timeout=None, until_predicate=None, sleep_delay=0.1):
+        """
+        Event process loop during timeout seconds at most or when the predicate became true
+
+        We block on the file descriptors of the monitor using poll (see _new_poller),
+        with the remaining time as timeout, so events are handled as soon as they are
+        available. The periodic work (see _periodic_work) is done between the reads.
+
+        If the user specify an until_predicate callable, it is evaluated each time events
+        have been handled. In threaded and multiprocessing mode, the workers wake us up
+        when they have emptied the events queue, so the predicate sees the result of the
+        callbacks right away. Since the predicate may depend on anything, it is also
+        evaluated at least every sleep_delay seconds.
+
+        If the user didn't provide a timeout and a predicate function, we block until
+        interrupt() is called.
+        """
+
+        if not timeout:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+
+        self._start_workers()
+
+        # hack to make the while loop work even if no predicate function is given
+        if until_predicate:
+            max_wait = sleep_delay
+        else:
+            until_predicate = lambda: False
+            max_wait = None
+
+        poller = self._new_poller()
+        self._interrupted = False
+
+        try:
+            while True:
+                next_work = self._periodic_work()
+                # with the events queued outside process_events (see add_source_dir)
+                self._dispatch_events()
+                if self._interrupted or until_predicate():
+                    break
+
+                wait = max_wait
+                if next_work is not None:
+                    work_wait = max(next_work - time.time(), 0)
+                    if wait is None or work_wait < wait:
+                        wait = work_wait
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    if wait is None or remaining < wait:
+                        wait = remaining
+
+                if self._wait_for_events(poller, wait):
+                    self.read_events()
+
+        finally:
+            self._finish_workers()
 
     def process_events_timeout(self, timeout):
         """Process pending events.  Timeout block."""
 
+    def fileno(self):
+        """
+        Returns a file descriptor which is readable when events are pending.
+        Useful to integrate the monitor in an event loop (see asyncio_.py).
+        """
+
+    def read_events(self):
+        """
+        Read the pending events without blocking and put them in the events queue.
+        The events are not dispatched to the callbacks : it's up to the caller.
+        """
+
+    def interrupt(self):
+        """
+        Make the current process_events call return as soon as possible.
+        Can be called from another thread or from a callback.
+        """
+        self._interrupted = True
+        self._wakeup()
+
     def add_source_dir(self, real_path):
         """
         Monitor source directory ``real_path``.  Fail silently if:
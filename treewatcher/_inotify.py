@@ -0,0 +1,252 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+ctypes bindings for the inotify syscalls.
+
+This module mimics the inotifyx interface (init, add_watch, rm_watch,
+get_events and the IN_* constants) so it can be used as a drop-in
+replacement by the tree monitors.
+
+The main difference is how events are read : we ask the kernel how many bytes
+are pending (FIONREAD), read them in one go and decode the whole buffer using
+struct.unpack_from over a memoryview.
+"""
+
+import os
+import sys
+import errno
+import array
+import fcntl
+import select
+import struct
+import termios
+import ctypes
+import ctypes.util
+
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+IN_ONESHOT = 0x80000000
+
+IN_CLOSE = IN_CLOSE_WRITE | IN_CLOSE_NOWRITE
+IN_MOVE = IN_MOVED_FROM | IN_MOVED_TO
+IN_ALL_EVENTS = (
+  IN_ACCESS | IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CLOSE_NOWRITE |
+  IN_OPEN | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+  IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+IN_CLOEXEC = 0x80000
+
+# used for get_mask_description
+_MASK_NAMES = sorted([ (value, name) for name, value in globals().items() \
+                       if name.startswith('IN_') and name not in ('IN_CLOSE', 'IN_MOVE', \
+                                                                  'IN_ALL_EVENTS', 'IN_CLOEXEC') ])
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_HEADER = struct.Struct('iIII')
+
+# used when the kernel has nothing pending yet and we are doing a blocking read.
+# It is large enough to hold any single event (header + NAME_MAX + 1).
+_DEFAULT_READ_SIZE = 64 * 1024
+
+
+def _load_libc():
+    """
+    Load the C library and check that it exposes the inotify functions.
+    Returns None if it's not the case.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    for func in ('inotify_init', 'inotify_add_watch', 'inotify_rm_watch'):
+        if not hasattr(libc, func):
+            return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+_LIBC = _load_libc()
+AVAILABLE = _LIBC is not None
+
+
+class InotifyEvent(object):
+    """
+    One inotify event, as returned by get_events
+    """
+    __slots__ = ('wd', 'mask', 'cookie', 'name')
+
+    def __init__(self, wd, mask, cookie, name):
+        """ init """
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+
+    def get_mask_description(self):
+        """
+        Returns a textual description of the event mask (ie: 'IN_CREATE|IN_ISDIR')
+        """
+        return '|'.join([ name for value, name in _MASK_NAMES if self.mask & value ])
+
+
+    def __str__(self):
+        """ str """
+        return 'wd=%d mask=%s cookie=%d name=%s' % \
+               (self.wd, self.get_mask_description(), self.cookie, self.name)
+
+
+    def __repr__(self):
+        """ repr """
+        return 'InotifyEvent(%r, %r, %r, %r)' % (self.wd, self.mask, self.cookie, self.name)
+
+
+def _raise_errno(*args):
+    """
+    Raise an IOError built from the ctypes errno, like inotifyx does
+    """
+    err = ctypes.get_errno()
+    raise IOError(err, os.strerror(err), *args)
+
+
+def init():
+    """
+    Create an inotify instance and return its file descriptor
+    """
+    if hasattr(_LIBC, 'inotify_init1'):
+        inotify_fd = _LIBC.inotify_init1(IN_CLOEXEC)
+    else:
+        inotify_fd = _LIBC.inotify_init()
+    if inotify_fd < 0:
+        _raise_errno()
+    return inotify_fd
+
+
+def add_watch(inotify_fd, path, mask=IN_ALL_EVENTS):
+    """
+    Add a watch on 'path' and return the watch descriptor
+    """
+    if isinstance(path, unicode):
+        path = path.encode(sys.getfilesystemencoding())
+    watch_fd = _LIBC.inotify_add_watch(inotify_fd, path, mask)
+    if watch_fd < 0:
+        _raise_errno(path)
+    return watch_fd
+
+
+def rm_watch(inotify_fd, watch_fd):
+    """
+    Remove the watch 'watch_fd'
+    """
+    if _LIBC.inotify_rm_watch(inotify_fd, watch_fd) < 0:
+        _raise_errno()
+
+
+def _pending_bytes(inotify_fd):
+    """
+    Returns the number of bytes ready to be read on the inotify file descriptor
+    """
+    buf = array.array('i', [0])
+    fcntl.ioctl(inotify_fd, termios.FIONREAD, buf, True)
+    return buf[0]
+
+
+def parse_events(data):
+    """
+    Decode a buffer read from an inotify file descriptor.
+
+    The whole buffer is decoded in one pass. The header of each event is
+    unpacked in place and only the name is copied out of the buffer.
+    A truncated event at the end of the buffer is ignored.
+    """
+    events = []
+    append = events.append
+    view = memoryview(data)
+    unpack_from = _EVENT_HEADER.unpack_from
+    header_size = _EVENT_HEADER.size
+    offset = 0
+    end = len(data)
+    while offset + header_size <= end:
+        watch_fd, mask, cookie, length = unpack_from(data, offset)
+        offset += header_size
+        if offset + length > end:
+            break
+        if length:
+            # the name is padded with null bytes
+            name_end = data.find('\0', offset, offset + length)
+            if name_end < 0:
+                name_end = offset + length
+            name = view[offset:name_end].tobytes()
+            offset += length
+        else:
+            name = None
+        append(InotifyEvent(watch_fd, mask, cookie, name))
+    return events
+
+
+def read_events(inotify_fd):
+    """
+    Read all the pending events. Block if nothing is pending.
+    """
+    size = _pending_bytes(inotify_fd)
+    if size <= 0:
+        size = _DEFAULT_READ_SIZE
+    while True:
+        try:
+            data = os.read(inotify_fd, size)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        return parse_events(data)
+
+
+def get_events(inotify_fd, timeout=None):
+    """
+    Returns the list of pending events.
+
+    If timeout is None, block until some events are available.
+    Otherwise, wait at most 'timeout' seconds (0 means do not block at all)
+    and return an empty list if nothing happened.
+    """
+    if timeout is not None:
+        try:
+            readable, _, _ = select.select([inotify_fd], [], [], timeout)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+    return read_events(inotify_fd)
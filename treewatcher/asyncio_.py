@@ -0,0 +1,290 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+asyncio front-end for the source tree monitors.
+
+Instead of running process_events in a thread, the inotify file descriptor of the
+monitor is registered in the asyncio event loop. When it is readable, the pending
+events are decoded by the monitor (see SourceTreeMonitor.read_events) and are
+dispatched from the event loop thread. What process_events does between the
+reads (coalescing stage, incremental crawls, rescans...) is scheduled on the
+event loop too (see SourceTreeMonitor._periodic_work). The events go :
+
+ - to the callbacks object, whose callbacks can be coroutine functions
+   (see AsyncioEventsCallbacks),
+ - to every stream returned by AsyncioSourceTreeMonitor.events().
+
+With trollius :
+
+    import trollius
+    from trollius import From
+
+    @trollius.coroutine
+    def print_events(monitor):
+        stream = monitor.events()
+        while True:
+            event, path, is_dir = yield From(stream.get())
+            print event, path, is_dir
+
+    monitor = AsyncioSourceTreeMonitor(choose_source_tree_monitor())
+    monitor.start()
+    monitor.add_source_dir('/tmp')
+    monitor.loop.run_until_complete(print_events(monitor))
+"""
+
+import time
+import Queue
+import collections
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from treewatcher import MissingDependency, EventsCallbacks, EVENTS_NAMES
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # python 2 : streams can only be consumed using get()
+    _StopAsyncIteration = StopIteration
+
+
+def _ensure_future(coro, loop):
+    """
+    Schedule a coroutine, whatever the asyncio flavour is
+    """
+    ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+    return ensure_future(coro, loop=loop)
+
+
+class AsyncioEventsCallbacks(EventsCallbacks):
+    """
+    Just like EventsCallbacks, but the callbacks can also be coroutine functions.
+    They are scheduled on the event loop of the AsyncioSourceTreeMonitor, in the
+    order of the events, but they can run concurrently.
+    """
+    def __init__(self):
+        """ init """
+        EventsCallbacks.__init__(self)
+
+
+class EventsStream(object):
+    """
+    Stream of (event, path, is_dir) triplets, like ('create', '/tmp/foo', False).
+    Use it with 'yield From(stream.get())' (see the example above).
+    """
+
+    def __init__(self, loop):
+        """ init """
+        self._loop = loop
+        self._events = collections.deque()
+        self._waiter = None
+        self._closed = False
+
+
+    def _push(self, event):
+        """
+        Called by the monitor for each new event
+        """
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(event)
+        else:
+            self._events.append(event)
+        self._waiter = None
+
+
+    def close(self):
+        """
+        End the stream. Pending events can still be retrieved.
+        """
+        self._closed = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_exception(_StopAsyncIteration())
+        self._waiter = None
+
+
+    def get(self):
+        """
+        Returns a future which will hold the next event.
+        The future raises StopAsyncIteration (StopIteration with python 2)
+        when the stream is closed and empty.
+        """
+        future = asyncio.Future(loop=self._loop)
+        if self._events:
+            future.set_result(self._events.popleft())
+        elif self._closed:
+            future.set_exception(_StopAsyncIteration())
+        else:
+            self._waiter = future
+        return future
+
+
+    def __aiter__(self):
+        """ async iterator protocol """
+        return self
+
+
+    def __anext__(self):
+        """ async iterator protocol """
+        return self.get()
+
+
+class AsyncioSourceTreeMonitor(object):
+    """
+    Wrap a source tree monitor to process its events from an asyncio event loop.
+    The callbacks object has to be a serial one (EventsCallbacks or
+    AsyncioEventsCallbacks) : the callbacks are called from the event loop.
+    """
+
+    def __init__(self, stm, loop=None):
+        """
+        'stm' is a source tree monitor (see choose_source_tree_monitor)
+        """
+        if asyncio is None:
+            raise MissingDependency('asyncio or trollius')
+        self.stm = stm
+        # the streams need every event, even without callback
+        self.stm._all_events = True
+        # a full bounded queue (see set_events_queue_bound) is drained by us
+        self.stm._drain_hook = self._dispatch_events
+        self.loop = loop or asyncio.get_event_loop()
+        self.streams = []
+        self._reading = False
+        # next call of _run_periodic_work
+        self._periodic_handle = None
+        if self.stm.events_callbacks is None:
+            # only streams will be used
+            self.set_events_callbacks(AsyncioEventsCallbacks())
+        else:
+            self.stm._build_callbacks_table()
+
+
+    def set_events_callbacks(self, events_obj):
+        """ see SourceTreeMonitor.set_events_callbacks """
+        assert events_obj._serial, "The callbacks are called from the event loop, they must be serial"
+        self.stm.set_events_callbacks(events_obj)
+
+
+    def add_source_dir(self, path):
+        """ see SourceTreeMonitor.add_source_dir """
+        self.stm.add_source_dir(path)
+        if self._reading:
+            # its crawl (see set_crawl_step) or its rescan (see set_snapshot_file)
+            # is continued by _run_periodic_work
+            self._schedule_periodic_work(0)
+
+
+    def remove_source_dir(self, path):
+        """ see SourceTreeMonitor.remove_source_dir """
+        self.stm.remove_source_dir(path)
+
+
+    def start(self):
+        """
+        Start the monitor and register it in the event loop
+        """
+        self.stm.start()
+        self.loop.add_reader(self.stm.fileno(), self._on_readable)
+        self._reading = True
+        self._schedule_periodic_work(0)
+
+
+    def stop(self):
+        """
+        Unregister the monitor from the event loop, close the streams and
+        stop the monitor.
+        """
+        if self._reading:
+            self.loop.remove_reader(self.stm.fileno())
+            self._reading = False
+        if self._periodic_handle is not None:
+            self._periodic_handle.cancel()
+            self._periodic_handle = None
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
+        self.stm.stop()
+
+
+    def events(self):
+        """
+        Returns a new EventsStream. Every stream receives every event happening
+        after its creation.
+        """
+        stream = EventsStream(self.loop)
+        self.streams.append(stream)
+        return stream
+
+
+    def _on_readable(self):
+        """
+        Called by the event loop when the monitor file descriptor is readable
+        """
+        self.stm.read_events()
+        self._run_periodic_work()
+
+
+    def _run_periodic_work(self):
+        """
+        Do the periodic work of the monitor, dispatch the queued events and
+        schedule the next call
+        """
+        if self._periodic_handle is not None:
+            self._periodic_handle.cancel()
+            self._periodic_handle = None
+        deadline = self.stm._periodic_work()
+        self._dispatch_events()
+        if deadline is not None:
+            self._schedule_periodic_work(max(deadline - time.time(), 0))
+
+
+    def _schedule_periodic_work(self, delay):
+        """
+        Call _run_periodic_work in 'delay' seconds, instead of the scheduled call if any
+        """
+        if self._periodic_handle is not None:
+            self._periodic_handle.cancel()
+        self._periodic_handle = self.loop.call_later(delay, self._run_periodic_work)
+
+
+    def _dispatch_events(self):
+        """
+        Call the callbacks of the queued events and feed the streams
+        """
+        events_queue = self.stm.events_queue
+        callbacks_table = self.stm._callbacks_table
+        raw = self.stm.events_callbacks.raw_events
+        while True:
+            try:
+                item = events_queue.get_nowait()
+            except Queue.Empty:
+                break
+            # see SourceTreeMonitor.set_events_batching
+            if type(item) is list:
+                events = item
+            else:
+                events = (item,)
+            for event in events:
+                if self.streams:
+                    named_event = (EVENTS_NAMES[event.code], event.path, event.is_dir)
+                    for stream in self.streams:
+                        stream._push(named_event)
+                if raw:
+                    result = callbacks_table[event.code](event)
+                else:
+                    result = callbacks_table[event.code](event.path, event.is_dir)
+                if asyncio.iscoroutine(result):
+                    _ensure_future(result, self.loop)
@@ -0,0 +1,79 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+inotify watches budget (see InotifyxSourceTreeMonitor.set_watch_budget)
+
+The kernel limits the number of watches per user (fs.inotify.max_user_watches),
+whatever the number of inotify instances and processes. When the budget of a
+monitor is exhausted, one of the following policies is applied to the
+directories which cannot be watched :
+
+ - BUDGET_RAISE : raise WatchBudgetExhausted
+ - BUDGET_SKIP : log a warning, the subtree is not monitored
+ - BUDGET_POLL : the subtree is monitored by polling it (see snapshot.py)
+
+The trees are crawled breadth first, so the shallow directories get the
+watches first.
+"""
+
+import os
+
+
+BUDGET_RAISE = 'raise'
+BUDGET_SKIP = 'skip'
+BUDGET_POLL = 'poll'
+
+BUDGET_POLICIES = (BUDGET_RAISE, BUDGET_SKIP, BUDGET_POLL)
+
+_PROC_INOTIFY = '/proc/sys/fs/inotify'
+
+
+def read_inotify_limits():
+    """
+    Returns the {'max_user_watches', 'max_user_instances', 'max_queued_events'}
+    dict of the kernel limits. A limit is None if it cannot be read.
+    """
+    limits = {}
+    for name in ('max_user_watches', 'max_user_instances', 'max_queued_events'):
+        try:
+            with open(os.path.join(_PROC_INOTIFY, name)) as limit_file:
+                limits[name] = int(limit_file.read())
+        except (IOError, ValueError):
+            limits[name] = None
+    return limits
+
+
+def count_user_watches():
+    """
+    Returns the number of inotify watches used by the processes we can
+    inspect (all the processes of the user, usually), using /proc/*/fdinfo.
+    Useful to plan capacity when many monitors run on the same host.
+    """
+    watches = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) != 'anon_inode:inotify':
+                    continue
+                with open(os.path.join('/proc', pid, 'fdinfo', fd)) as fdinfo:
+                    watches += sum(1 for line in fdinfo if line.startswith('inotify wd:'))
+            except (OSError, IOError):
+                # closed meanwhile
+                continue
+    return watches
@@ -0,0 +1,214 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Events coalescing stage (see SourceTreeMonitor.set_events_coalescing)
+
+The events of a path are held until the path has been quiet for 'quiet'
+seconds, and merged :
+
+ - create then delete : nothing,
+ - the modify and attrib events of a created entry are dropped,
+ - a close_write replaces the previous modify events,
+ - the same attrib, modify or close_write event is reported once,
+ - a delete replaces the previous events of an entry which existed before.
+
+If the callbacks implement ready(path, is_dir), the create and close_write
+events of a file whose writes are over are reported as a single ready event.
+
+The moves and unmount events are not held : the pending events of their
+paths are reported first, then them. When a directory is moved, the pending
+events of the paths under its destination are reported too, and those of
+the paths under its source are kept, under the destination : a tree written
+then published by a rename is reported with its new paths.
+
+The pending paths are kept in an OrderedDict, in deadline order : a path
+seeing a new event is moved to the end. Adding an event and reporting the
+due paths are O(1) per event, whatever the number of pending paths, except
+for the directory moves which are O(number of pending paths).
+"""
+
+import os
+import time
+import collections
+
+from treewatcher import EVENT_CREATE, EVENT_DELETE, EVENT_CLOSE_WRITE, EVENT_MODIFY, EVENT_ATTRIB, \
+                        EVENT_MOVED, EVENT_READY
+
+# the events held by the coalescer
+_HELD = frozenset((EVENT_CREATE, EVENT_DELETE, EVENT_CLOSE_WRITE, EVENT_MODIFY, EVENT_ATTRIB))
+
+
+def _merge(codes, code):
+    """
+    Merge the event 'code' in the 'codes' list of the pending events of a path
+    """
+    if code == EVENT_DELETE:
+        if EVENT_CREATE in codes:
+            # it was created in the window : only the delete of the entry
+            # it replaced, if any, is left
+            del codes[codes.index(EVENT_CREATE):]
+        else:
+            del codes[:]
+            codes.append(code)
+    elif code == EVENT_CREATE:
+        codes.append(code)
+    elif code == EVENT_CLOSE_WRITE:
+        if EVENT_MODIFY in codes:
+            codes.remove(EVENT_MODIFY)
+        if code in codes:
+            codes.remove(code)
+        codes.append(code)
+    elif code in (EVENT_MODIFY, EVENT_ATTRIB):
+        if code not in codes and EVENT_CREATE not in codes:
+            codes.append(code)
+    else:
+        codes.append(code)
+
+
+class EventsCoalescer(object):
+    """
+    Hold and merge the events of each path until it's quiet.
+    emit(code, path, is_dir) is called for the merged events.
+    """
+
+    def __init__(self, quiet, emit, ready=False):
+        """
+        'ready' is True if the create and close_write events of
+        the files have to be reported as a ready event
+        """
+        self.quiet = quiet
+        self.emit = emit
+        self.ready = ready
+        # path -> [deadline, is_dir, events codes], in deadline order
+        self.pending = collections.OrderedDict()
+        # number of events merged with the pending events of their path
+        self.merged = 0
+
+
+    def __len__(self):
+        """ number of pending paths """
+        return len(self.pending)
+
+
+    def add(self, code, path, is_dir):
+        """
+        Hold the event 'code' of 'path'
+        """
+        if code == EVENT_MOVED:
+            # path is a (src, dst) pair
+            self._report_path(path[0])
+            self._report_path(path[1])
+            if is_dir and self.pending:
+                self._move_subtree(path[0], path[1])
+            self.emit(code, path, is_dir)
+            return
+        if code not in _HELD:
+            self._report_path(path)
+            self.emit(code, path, is_dir)
+            return
+
+        entry = self.pending.pop(path, None)
+        if entry is None:
+            entry = [ 0, is_dir, [] ]
+        else:
+            self.merged += 1
+        entry[0] = time.time() + self.quiet
+        entry[1] = is_dir
+        _merge(entry[2], code)
+        if entry[2]:
+            self.pending[path] = entry
+
+
+    def next_deadline(self):
+        """
+        Returns the time the first pending path will be reported, None if there is none
+        """
+        if not self.pending:
+            return None
+        return self.pending[next(iter(self.pending))][0]
+
+
+    def due(self):
+        """
+        Returns True if some pending paths have to be reported now
+        """
+        deadline = self.next_deadline()
+        return deadline is not None and deadline <= time.time()
+
+
+    def report_due(self):
+        """
+        Report the paths which have been quiet long enough
+        """
+        pending = self.pending
+        now = time.time()
+        while pending:
+            path = next(iter(pending))
+            entry = pending[path]
+            if entry[0] > now:
+                break
+            del pending[path]
+            self._report(path, entry[1], entry[2])
+
+
+    def report_all(self):
+        """
+        Report every pending path
+        """
+        pending = self.pending
+        while pending:
+            path, entry = pending.popitem(last=False)
+            self._report(path, entry[1], entry[2])
+
+
+    def _report_path(self, path):
+        """
+        Report the pending events of 'path' now
+        """
+        entry = self.pending.pop(path, None)
+        if entry is not None:
+            self._report(path, entry[1], entry[2])
+
+
+    def _move_subtree(self, src, dst):
+        """
+        The directory 'src' has been moved to 'dst' : report the pending
+        events under 'dst' now, and move those under 'src' under 'dst',
+        keeping their deadlines
+        """
+        src_prefix = src + os.sep
+        dst_prefix = dst + os.sep
+        pending = collections.OrderedDict()
+        for path, entry in self.pending.iteritems():
+            if path.startswith(src_prefix):
+                pending[dst_prefix + path[len(src_prefix):]] = entry
+            elif path.startswith(dst_prefix):
+                self._report(path, entry[1], entry[2])
+            else:
+                pending[path] = entry
+        self.pending = pending
+
+
+    def _report(self, path, is_dir, codes):
+        """
+        Emit the merged events of a path
+        """
+        emit = self.emit
+        if self.ready and not is_dir and codes[-1] == EVENT_CLOSE_WRITE:
+            for code in codes[:-1]:
+                if code != EVENT_CREATE:
+                    emit(code, path, is_dir)
+            emit(EVENT_READY, path, is_dir)
+            return
+        for code in codes:
+            emit(code, path, is_dir)
+
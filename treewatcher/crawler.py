@@ -0,0 +1,292 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Directory tree crawler used to add the watches on a whole tree.
+
+The directories are listed using the scandir package when it's installed
+(pip install scandir, or the 'scandir' extra of setup.py) : the type of each
+entry comes from the directory listing itself, so we don't need an extra
+stat per entry. Without it, os.listdir is used, with one stat per entry.
+
+The listings can be spread over a pool of threads, which helps a lot on
+network filesystems, while the watches are always added from the crawling
+thread.
+"""
+
+import os
+import Queue
+import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def _list_dir_scandir(path):
+    """
+    scandir version of list_dir
+    """
+    entries = []
+    for entry in scandir(path):
+        try:
+            # d_type is enough, unless the entry is a symlink
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        entries.append((entry.name, is_dir))
+    return entries
+
+
+def _list_dir_listdir(path):
+    """
+    os.listdir version of list_dir
+    """
+    return [ (name, os.path.isdir(os.path.join(path, name))) for name in os.listdir(path) ]
+
+
+if scandir is not None:
+    _list_dir = _list_dir_scandir
+else:
+    _list_dir = _list_dir_listdir
+
+
+def list_dir(path):
+    """
+    Returns the list of the (name, is_dir) pairs of the entries of 'path'.
+    Symlinks to directories are considered as directories.
+    Returns an empty list if the directory cannot be read.
+    """
+    try:
+        return _list_dir(path)
+    except (OSError, IOError):
+        return []
+
+
+def _list_dir_job(path):
+    """
+    Job submitted to the threads pool
+    """
+    return path, list_dir(path)
+
+
+class Crawl(object):
+    """
+    State of the crawl of one tree (see TreeCrawler.start_crawl).
+
+    The directories waiting to be listed are kept in a frontier, consumed
+    breadth first, which keeps the threads busy. The frontier holds at most
+    the max_frontier of the crawler : when it's full, the rest of the
+    current listing is kept aside and we go depth first, listing the newest
+    directories of the frontier. The listings kept aside are continued,
+    newest first, as soon as there is room again : we hold about one of
+    them per level of the tree.
+    """
+
+    def __init__(self, crawler, root, watch_dir, on_entry, path_filter=None):
+        """ see TreeCrawler.start_crawl """
+        self.crawler = crawler
+        self.root = root
+        self.watch_dir = watch_dir
+        self.on_entry = on_entry
+        self.path_filter = path_filter
+        self.frontier = collections.deque()
+        # [path, entries, index of the next entry] of the listings
+        # stopped because the frontier was full
+        self.listings = []
+        self.dirs = 0
+        self.entries = 0
+        self._results = Queue.Queue()
+        self._in_flight = 0
+        self._finished = False
+        if watch_dir(root):
+            self.frontier.append(root)
+
+
+    def done(self):
+        """
+        Returns True if every directory has been crawled
+        """
+        return not self.frontier and not self.listings and not self._in_flight
+
+
+    def _next_dir(self):
+        """
+        Returns the next directory to list, None if there is none
+        """
+        listings = self.listings
+        while listings and len(self.frontier) < self.crawler.max_frontier:
+            if self._expand(listings[-1]):
+                listings.pop()
+        if not self.frontier:
+            return None
+        if listings:
+            # the frontier is full
+            return self.frontier.pop()
+        return self.frontier.popleft()
+
+
+    def _expand(self, listing):
+        """
+        Report the entries of a [path, entries, index] listing and add its
+        subdirs to the frontier, until the frontier is full.
+        Returns True if the whole listing has been handled.
+        """
+        path, entries, index = listing
+        frontier = self.frontier
+        max_frontier = self.crawler.max_frontier
+        watch_dir = self.watch_dir
+        on_entry = self.on_entry
+        path_filter = self.path_filter
+        for index in xrange(index, len(entries)):
+            name, is_dir = entries[index]
+            if is_dir and len(frontier) >= max_frontier:
+                listing[2] = index
+                return False
+            sub_path = os.path.join(path, name)
+            if path_filter is not None and not path_filter.accepts(sub_path, is_dir):
+                continue
+            if on_entry is not None:
+                on_entry(sub_path, is_dir)
+            if is_dir and watch_dir(sub_path):
+                frontier.append(sub_path)
+        return True
+
+
+    def _handle_listing(self, path, entries):
+        """
+        Report the entries of 'path' and add its subdirs to the frontier
+        """
+        self.dirs += 1
+        self.entries += len(entries)
+        listing = [path, entries, 0]
+        if not self._expand(listing):
+            self.listings.append(listing)
+
+        if self.dirs % self.crawler.progress_every == 0:
+            self.crawler._progress(self.root, self.dirs, self.entries, False)
+
+
+    def step(self, max_dirs=None):
+        """
+        List at most 'max_dirs' directories (all of them if None).
+        Returns True when the crawl is over.
+        """
+        workers = self.crawler.workers
+        listed = 0
+        while True:
+            if workers > 1:
+                # keep every thread busy, with a small backlog
+                while self._in_flight < 2 * workers and \
+                      (max_dirs is None or listed + self._in_flight < max_dirs):
+                    path = self._next_dir()
+                    if path is None:
+                        break
+                    self.crawler._get_pool().apply_async(_list_dir_job, (path,),
+                                                         callback=self._results.put)
+                    self._in_flight += 1
+                if not self._in_flight:
+                    break
+                path, entries = self._results.get()
+                self._in_flight -= 1
+            else:
+                if max_dirs is not None and listed >= max_dirs:
+                    break
+                path = self._next_dir()
+                if path is None:
+                    break
+                entries = list_dir(path)
+
+            listed += 1
+            self._handle_listing(path, entries)
+
+        if self.done() and not self._finished:
+            self._finished = True
+            self.crawler._progress(self.root, self.dirs, self.entries, True)
+        return self.done()
+
+
+class TreeCrawler(object):
+    """
+    Crawl directory trees, calling watch_dir for each directory before
+    listing it, and on_entry for each entry found.
+    """
+
+    def __init__(self, workers=1, progress_callback=None, progress_every=1000, max_frontier=100000):
+        """
+        'workers' is the number of threads listing the directories.
+        'progress_callback(root, dirs, entries, done)' is called every
+        'progress_every' directories and at the end of each crawl.
+        'max_frontier' is the most directories waiting to be listed a
+        crawl holds : above, it goes depth first (see Crawl).
+        """
+        if max_frontier < 1:
+            raise ValueError('the frontier must hold at least 1 directory')
+        self.workers = workers
+        self.progress_callback = progress_callback
+        self.progress_every = progress_every
+        self.max_frontier = max_frontier
+        self._pool = None
+
+
+    def _get_pool(self):
+        """
+        The pool is created on first use and kept until close()
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+
+    def close(self):
+        """
+        Stop the threads of the pool, if any
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+    def _progress(self, root, dirs, entries, done):
+        """
+        Report the progress of a crawl
+        """
+        if self.progress_callback is not None:
+            self.progress_callback(root, dirs, entries, done)
+
+
+    def start_crawl(self, root, watch_dir, on_entry=None, path_filter=None):
+        """
+        Returns a Crawl of 'root', to be run using Crawl.step.
+
+        watch_dir(path) is called for each directory (root included) before
+        listing it. If it returns False, the directory is not crawled.
+        on_entry(path, is_dir) is called for each entry found under root,
+        a directory is always reported before its content.
+        The entries rejected by 'path_filter' (see filters.py) are skipped.
+        """
+        return Crawl(self, root, watch_dir, on_entry, path_filter)
+
+
+    def crawl(self, root, watch_dir, on_entry=None):
+        """
+        Crawl 'root' entirely (see start_crawl).
+        Returns the number of directories listed.
+        """
+        crawl = self.start_crawl(root, watch_dir, on_entry)
+        crawl.step()
+        return crawl.dirs
@@ -0,0 +1,81 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+The events put in the events queues
+
+An inotify event names an entry of a watched directory : the full path is
+only built when someone asks for it (a path filter, the snapshot, the
+coalescing stage or the callback itself), then it's kept. The events
+dropped before (no callback for them) never build it.
+
+The event keeps the directory path it was read in : renaming the directory
+afterwards doesn't change the path of the queued events.
+
+An event is pickled with its full path (multiprocessing mode).
+"""
+
+import os
+
+
+class Event(object):
+    """
+    One event : its code (see EVENTS_NAMES), its path and whether it's a
+    directory. The events read from inotify also carry the raw inotify
+    cookie and mask, 0 for the others (crawls, rescans, polling). read_time
+    is the time the event was read, set when the stats are enabled.
+    """
+    __slots__ = ('code', 'is_dir', 'basepath', 'name', 'cookie', 'mask', 'read_time', '_path')
+
+    def __init__(self, code, basepath, name, is_dir, cookie=0, mask=0, read_time=None):
+        """
+        The path of the event is basepath/name, or basepath if name is None
+        (the (src, dst) pair of a moved event for instance)
+        """
+        self.code = code
+        self.basepath = basepath
+        self.name = name
+        self.is_dir = is_dir
+        self.cookie = cookie
+        self.mask = mask
+        self.read_time = read_time
+        if name is None:
+            self._path = basepath
+        else:
+            self._path = None
+
+
+    @property
+    def path(self):
+        """
+        The full path of the event, built once
+        """
+        path = self._path
+        if path is None:
+            path = self._path = os.path.join(self.basepath, self.name)
+        return path
+
+
+    def __getstate__(self):
+        """ pickle the full path only """
+        return (self.code, self.path, self.is_dir, self.cookie, self.mask, self.read_time)
+
+
+    def __setstate__(self, state):
+        """ unpickle """
+        self.code, self._path, self.is_dir, self.cookie, self.mask, self.read_time = state
+        self.basepath = self._path
+        self.name = None
+
+
+    def __repr__(self):
+        """ repr """
+        return 'Event(%r, %r, %r)' % (self.code, self.path, self.is_dir)
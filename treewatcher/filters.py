@@ -0,0 +1,103 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Include/exclude path filters (see SourceTreeMonitor.set_path_filters)
+
+A rule is either a glob or a compiled regular expression :
+
+ - a glob without '/' is matched against the name of the entry
+   ('.git', 'node_modules', '*.tmp'),
+ - a glob with a '/' is matched against the whole path ('/data/*/scratch'),
+ - a regular expression (re.compile) is searched in the whole path.
+
+An entry matching an exclude rule is ignored, with its whole subtree for a
+directory : it's neither watched nor crawled, and its events are never
+emitted. When there are include rules, only the files matching one of them
+are reported ; the directories are not concerned, to be able to find the
+included files in their subtrees.
+
+The globs of a filter are compiled into a single regular expression.
+"""
+
+import os
+import re
+import fnmatch
+
+
+def _compile_globs(globs):
+    """
+    Returns a regular expression matching any of 'globs', None if there are none
+    """
+    if not globs:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(glob) for glob in globs))
+
+
+class PathFilter(object):
+    """
+    Compiled include/exclude rules
+    """
+
+    def __init__(self, include=(), exclude=()):
+        """ see the module documentation for the rules """
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self._include = self._compile(self.include)
+        self._exclude = self._compile(self.exclude)
+
+
+    @staticmethod
+    def _compile(rules):
+        """
+        Returns the (names regex, paths regex, regexes) triplet of 'rules',
+        None if there are no rules
+        """
+        if not rules:
+            return None
+        names = []
+        paths = []
+        regexes = []
+        for rule in rules:
+            if hasattr(rule, 'search'):
+                regexes.append(rule)
+            elif '/' in rule:
+                paths.append(rule)
+            else:
+                names.append(rule)
+        return _compile_globs(names), _compile_globs(paths), tuple(regexes)
+
+
+    @staticmethod
+    def _matches(rules, path):
+        """
+        Returns True if 'path' matches one of the compiled 'rules'
+        """
+        names, paths, regexes = rules
+        if names is not None and names.match(os.path.basename(path)):
+            return True
+        if paths is not None and paths.match(path):
+            return True
+        for regex in regexes:
+            if regex.search(path):
+                return True
+        return False
+
+
+    def accepts(self, path, is_dir):
+        """
+        Returns True if the events of 'path' have to be reported
+        """
+        if self._exclude is not None and self._matches(self._exclude, path):
+            return False
+        if self._include is not None and not is_dir:
+            return self._matches(self._include, path)
+        return True
@@ -0,0 +1,36 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Native inotify based tree monitor (no external dependency)
+"""
+
+from treewatcher import MissingDependency
+from treewatcher import _inotify
+from treewatcher.inotifyx_ import InotifyxSourceTreeMonitor
+
+
+class InotifySourceTreeMonitor(InotifyxSourceTreeMonitor):
+    """
+    Tree monitor talking to the inotify syscalls directly using ctypes.
+
+    It behaves exactly like InotifyxSourceTreeMonitor, but each read of the
+    inotify file descriptor is decoded as one buffer instead of building
+    the events one by one in inotifyx (see _inotify.py).
+    """
+
+    def _get_inotify_module(self):
+        """
+        Use our own bindings instead of inotifyx
+        """
+        if not _inotify.AVAILABLE:
+            raise MissingDependency('inotify support in the C library')
+        return _inotify
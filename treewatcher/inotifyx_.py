@@ -21,19 +21,44 @@ inotifyx based tree monitor
 
 import os
 import errno
-import inotifyx
+import fnmatch
+import collections
 import time
-import sys
-import threading
-import multiprocessing
+import select
 import logging
+import threading
 
-from treewatcher import SourceTreeMonitor
+try:
+    import inotifyx
+except ImportError:
+    # inotifyx is optional : see InotifySourceTreeMonitor in inotify_.py
+    inotifyx = None
+
+from treewatcher import SourceTreeMonitor, MissingDependency, WatchBudgetExhausted, EVENTS_NAMES
+from treewatcher import EVENT_CREATE, EVENT_DELETE, EVENT_CLOSE_WRITE, EVENT_MOVED_FROM, \
+                        EVENT_MOVED_TO, EVENT_MODIFY, EVENT_ATTRIB, EVENT_UNMOUNT, EVENT_MOVED
+from treewatcher.events import Event
+from treewatcher.registry import WatchRegistry
+from treewatcher.snapshot import TreeSnapshot, Rescan, ignore_event, SnapshotFileError
+from treewatcher.budget import BUDGET_RAISE, BUDGET_SKIP, BUDGET_POLL, BUDGET_POLICIES, read_inotify_limits
 
 _INOTIFYX_STM_LOGGER = logging.getLogger('_INOTIFYX_STM_LOGGER')
 _INOTIFYX_STM_LOGGER.setLevel(logging.INFO)
 _INOTIFYX_STM_LOGGER.addHandler(logging.StreamHandler())
 
+# interval between two steps of the overflow rescans (see set_overflow_resync)
+_RESCAN_PERIOD = 0.1
+
+
+def _event_path(basepath, name):
+    """
+    The path of an inotify event without Event object (see Event.path)
+    """
+    if name is None:
+        return basepath
+    return os.path.join(basepath, name)
+
+
 class InotifyxSourceTreeMonitor(SourceTreeMonitor):
     """
     inotifyx based tree monitor class
@@ -44,63 +69,437 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
         Init. Nothing fancy here.
         """
         SourceTreeMonitor.__init__(self)
-        self.inotifyx = inotifyx
-        self.event_mask = (
-          inotifyx.IN_DELETE |
-          inotifyx.IN_CREATE |
-          inotifyx.IN_CLOSE_WRITE |
-          inotifyx.IN_MOVED_FROM |
-          inotifyx.IN_MOVED_TO |
-          inotifyx.IN_ATTRIB
+        self.inotifyx = self._get_inotify_module()
+        # inotify events needed by each event (the kernel always reports IN_UNMOUNT)
+        self.events_masks = {
+          'create': self.inotifyx.IN_CREATE,
+          'delete': self.inotifyx.IN_DELETE,
+          'close_write': self.inotifyx.IN_CLOSE_WRITE,
+          'moved_from': self.inotifyx.IN_MOVED_FROM,
+          'moved_to': self.inotifyx.IN_MOVED_TO,
+          'modify': self.inotifyx.IN_MODIFY,
+          'attrib': self.inotifyx.IN_ATTRIB,
+          'unmount': 0,
+          'moved': self.inotifyx.IN_MOVED_FROM | self.inotifyx.IN_MOVED_TO,
+          'ready': self.inotifyx.IN_CLOSE_WRITE,
+        }
+        # needed to follow the subtrees, whatever the callbacks
+        self.tree_mask = (
+          self.inotifyx.IN_DELETE |
+          self.inotifyx.IN_CREATE |
+          self.inotifyx.IN_MOVED_FROM |
+          self.inotifyx.IN_MOVED_TO
         )
+        # used when we don't know the callbacks, or when every event is needed
+        # (see AsyncioSourceTreeMonitor)
+        self.default_mask = self.tree_mask | self.inotifyx.IN_CLOSE_WRITE | self.inotifyx.IN_ATTRIB
+        # see set_watched_events
+        self.event_mask = self.default_mask
+        self._watched_events = None
+        self.roots_masks = {}
 
-        self.wd_to_path = {}
-        self.path_to_wd = {}
+        # watched directories (wd <-> path). With several inotify instances,
+        # the registry holds wd * shards_number + shard (see _watch_dir)
+        self.watches = WatchRegistry()
         self.inotify_fd = None
+        # see set_inotify_shards
+        self.shards_number = 1
+        self.shard_level = 0
+        self.inotify_fds = []
+        # shard key (see _shard_key) -> shard
+        self._shard_keys = {}
+        # see set_reader_thread
+        self.reader_thread = False
+        self.read_buffer_size = None
+        # (shard, events, read time) put by the reader threads, the number
+        # of events it holds and the condition the readers wait for when
+        # it's full
+        self._read_buffer = collections.deque()
+        self._read_buffer_events = 0
+        self._read_buffer_room = threading.Condition()
+        self._readers = []
+        self._readers_stop_fds = None
+        self._stopping_readers = False
+        # crawls to continue in process_events (see set_crawl_step)
+        self.pending_crawls = collections.deque()
+        # Event of a IN_MOVED_FROM waiting for its IN_MOVED_TO
+        self._pending_move = None
+        # roots given to add_source_dir
+        self.source_dirs = []
+        # see set_overflow_resync
+        self.snapshot = None
+        self.resync_rate = 1000
+        # see set_snapshot_file
+        self.snapshot_file = None
+        self.snapshot_stat_files = True
+        # see set_watch_budget
+        self.inotify_limits = {}
+        self.max_watches = None
+        self.budget_policy = BUDGET_RAISE
+        self.budget_skip_patterns = ()
+        self.unwatched_dirs = 0
+        # subtrees monitored by polling (BUDGET_POLL)
+        self.polled_dirs = set()
+        self._polled_snapshot = TreeSnapshot()
+        self.poll_interval = 5.0
+        self._next_poll = 0
+        self.pending_rescans = collections.deque()
+        self._next_rescan = 0
+
+
+    def _get_inotify_module(self):
+        """
+        Returns the module implementing the inotify calls (init, add_watch,
+        rm_watch, get_events and the IN_* constants).
+        Raise MissingDependency if it's not available.
+        """
+        if inotifyx is None:
+            raise MissingDependency('inotifyx')
+        return inotifyx
 
 
     def start(self, debug = False):
         """
         start inotifyx subsystem
         """
-        self.inotify_fd = self.inotifyx.init()
+        self.inotify_fds = [ self.inotifyx.init() for _ in xrange(self.shards_number) ]
+        self.inotify_fd = self.inotify_fds[0]
+        self.inotify_limits = read_inotify_limits()
+        self._open_wakeup_pipe()
+        if self.shards_number > 1 or self.reader_thread:
+            self._start_readers()
+        if self.snapshot_file is not None and os.path.exists(self.snapshot_file):
+            try:
+                self.snapshot.load(self.snapshot_file)
+            except (SnapshotFileError, IOError), err:
+                _INOTIFYX_STM_LOGGER.warning('cannot load the snapshot, the trees will be crawled: %s' % err)
+                self.snapshot = TreeSnapshot()
 
 
-    def _watch_dir(self, real_path):
+    def _watch_dir(self, real_path, check_dir=True):
         """
-        Add an inotify watch on 'real_path'
+        Add an inotify watch on 'real_path'.
+        Use check_dir=False if you already know it's a directory.
         """
-        if real_path in self.path_to_wd or not os.path.isdir(real_path):
+        if real_path in self.watches or (check_dir and not os.path.isdir(real_path)):
             # already watching, or file
             return False
 
-        watch_fd = self.inotifyx.add_watch(self.inotify_fd, real_path, self.event_mask)
+        if self.budget_skip_patterns:
+            name = os.path.basename(real_path)
+            for pattern in self.budget_skip_patterns:
+                if fnmatch.fnmatch(name, pattern):
+                    return False
+
+        if self.max_watches is not None and len(self.watches) >= self.max_watches:
+            return self._watch_budget_exhausted(real_path)
+
+        shard = self._shard(real_path)
+        try:
+            watch_fd = self.inotifyx.add_watch(self.inotify_fds[shard], real_path, self._watch_mask(real_path))
+        except IOError, err:
+            if err.errno == errno.ENOSPC:
+                # max_user_watches reached
+                return self._watch_budget_exhausted(real_path)
+            if err.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # already gone, or not readable
+                return False
+            raise
+
+        self.watches.add(real_path, watch_fd * self.shards_number + shard)
+        return True
+
+
+    def set_inotify_shards(self, shards, level=0):
+        """
+        Spread the watches over 'shards' inotify instances, each with its own
+        kernel events queue (max_queued_events) drained by its own reader
+        thread : a busy tree can only overflow the queue of its shard, and
+        only the trees of that shard are rescanned (see set_overflow_resync).
+
+        With level 0, each root given to add_source_dir goes to a shard ; with
+        level 1, each directory at the top of a root. The shards are given in
+        turn. The events of a shard are processed in order, not the events of
+        two shards. Each instance counts in the max_user_instances limit.
+
+        With level 1, the root itself has a shard too : when that one
+        overflows, the whole root is rescanned, whatever the shards of the
+        directories under it (a directory created or removed at the top of
+        the root is only seen by that shard).
+        Call it before start.
+        """
+        assert self.inotify_fd is None, "Cannot change the shards once started"
+        if shards < 1:
+            raise ValueError('at least 1 shard is needed')
+        if level not in (0, 1):
+            raise ValueError('the shard level must be 0 or 1')
+        self.shards_number = shards
+        self.shard_level = level
+
+
+    def set_reader_thread(self, enabled=True, buffer_size=None):
+        """
+        Read the inotify events from a dedicated thread (one per instance, see
+        set_inotify_shards) which keeps draining the kernel events queue into
+        a buffer, whatever process_events is doing : running the callbacks in
+        serial mode, crawling new trees... process_events processes the
+        buffered events.
+
+        The buffer holds at most 'buffer_size' events (None means no bound,
+        plus one read). When it's full, the reader waits for some room and
+        the kernel queue fills up : it only overflows if the buffer is full too.
+        Call it before start.
+        """
+        assert self.inotify_fd is None, "Cannot change the reader thread once started"
+        if buffer_size is not None and buffer_size < 1:
+            raise ValueError('the read buffer size must be at least 1')
+        self.reader_thread = enabled
+        self.read_buffer_size = buffer_size
+
+
+    def _source_dir_of(self, path):
+        """
+        Returns the deepest source dir holding 'path', None if there is none
+        """
+        root = None
+        for source_dir in self.source_dirs:
+            if path == source_dir or path.startswith(source_dir.rstrip('/') + '/'):
+                if root is None or len(source_dir) > len(root):
+                    root = source_dir
+        return root
+
+
+    def _shard_key(self, path):
+        """
+        Returns the root, or the directory at the top of a root, of 'path'
+        (see set_inotify_shards)
+        """
+        root = self._source_dir_of(path)
+        if root is None:
+            return path
+        if self.shard_level == 0 or path == root:
+            return root
+        top = path[len(root.rstrip('/')) + 1:].split('/', 1)[0]
+        return os.path.join(root, top)
+
+
+    def _shard(self, path):
+        """
+        Returns the index of the inotify instance watching 'path'
+        """
+        if self.shards_number == 1:
+            return 0
+        key = self._shard_key(path)
+        shard = self._shard_keys.get(key)
+        if shard is None:
+            shard = self._shard_keys[key] = len(self._shard_keys) % self.shards_number
+        return shard
 
-        # FIXME: What happens if inotifyx has an error?
-        if watch_fd > 0:
-            # watch successful
-            self.path_to_wd[real_path] = watch_fd
-            self.wd_to_path[watch_fd] = real_path
-            return True
+
+    def _start_readers(self):
+        """
+        Start one reader thread per inotify instance
+        """
+        self._readers_stop_fds = os.pipe()
+        for shard, inotify_fd in enumerate(self.inotify_fds):
+            thread = threading.Thread(target=self._read_events_loop, args=(shard, inotify_fd))
+            thread.daemon = True
+            thread.start()
+            self._readers.append(thread)
+
+
+    def _read_events_loop(self, shard, inotify_fd):
+        """
+        Reader thread : put the events of 'inotify_fd' in the read buffer and
+        wake up process_events, until the monitor is stopped.
+        The events are only read here, they are processed by process_events.
+        """
+        room = self._read_buffer_room
+        poller = select.poll()
+        poller.register(inotify_fd, select.POLLIN)
+        poller.register(self._readers_stop_fds[0], select.POLLIN)
+        while True:
+            try:
+                ready = poller.poll()
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in ready:
+                if fd == self._readers_stop_fds[0]:
+                    return
+            events = self.inotifyx.get_events(inotify_fd, 0)
+            if not events:
+                continue
+            with room:
+                self._read_buffer.append((shard, events, time.time()))
+                self._read_buffer_events += len(events)
+            self._wakeup()
+            with room:
+                # the next events wait in the kernel queue
+                while self.read_buffer_size is not None and not self._stopping_readers and \
+                      self._read_buffer_events >= self.read_buffer_size:
+                    room.wait()
+
+
+    def _stop_readers(self):
+        """
+        Stop the reader threads and wait for them
+        """
+        if not self._readers:
+            return
+        with self._read_buffer_room:
+            self._stopping_readers = True
+            self._read_buffer_room.notify_all()
+        os.write(self._readers_stop_fds[1], 'x')
+        for thread in self._readers:
+            thread.join()
+        self._readers = []
+        self._stopping_readers = False
+        map(os.close, self._readers_stop_fds)
+        self._readers_stop_fds = None
+
+
+    def _events_mask(self, names):
+        """
+        Returns the inotify mask of the 'names' events (see EVENTS_NAMES)
+        """
+        mask = self.tree_mask
+        for name in names:
+            if name not in self.events_masks:
+                raise ValueError('unknown event %r' % (name,))
+            mask |= self.events_masks[name]
+        return mask
+
+
+    def _build_callbacks_table(self):
+        """
+        Only ask the kernel for the events we have a callback for
+        """
+        SourceTreeMonitor._build_callbacks_table(self)
+        if self._watched_events is not None:
+            return
+        if self._all_events:
+            self.event_mask = self.default_mask
         else:
-            # watch unsuccessful, clean up
-            self._rm_watch(watch_fd)
-            return False
+            self.event_mask = self._events_mask(name for name in EVENTS_NAMES
+                                                if getattr(self.events_callbacks, name, None) is not None)
 
 
-    def _unwatch_dir_helper(self, real_path):
+    def set_watched_events(self, events=None, root=None):
         """
-        Remove a watch on the specified path
+        Ask the kernel for the 'events' events only (names from EVENTS_NAMES).
+        By default (events=None), they are the events implemented by the
+        callbacks object. The create, delete and moves inotify events are
+        always watched to follow the subtrees.
+
+        If 'root' is given, it only applies to the directories under 'root'
+        (the deepest root wins). It applies to the watches added afterwards :
+        call it before add_source_dir.
         """
-        try:
-            watch_fd = self.path_to_wd[real_path]
-        except KeyError:
-            # not watching
+        if root is not None:
+            root = root.rstrip('/') or '/'
+            if events is None:
+                self.roots_masks.pop(root, None)
+            else:
+                self.roots_masks[root] = self._events_mask(events)
             return
+        self._watched_events = events
+        if events is not None:
+            self.event_mask = self._events_mask(events)
+        elif self.events_callbacks is not None:
+            self._build_callbacks_table()
+        else:
+            self.event_mask = self.default_mask
 
-        self._rm_watch(watch_fd)
-        del self.path_to_wd[real_path]
-        del self.wd_to_path[watch_fd]
+
+    def _watch_mask(self, path):
+        """
+        Returns the inotify mask of the watch of 'path'
+        """
+        mask = self.event_mask
+        if self.roots_masks:
+            depth = -1
+            for root, root_mask in self.roots_masks.iteritems():
+                if len(root) > depth and (path == root or path.startswith(root + '/') or root == '/'):
+                    mask = root_mask
+                    depth = len(root)
+        if self.snapshot is not None:
+            # to keep the mtimes and sizes of the snapshot up to date
+            mask |= self.inotifyx.IN_CLOSE_WRITE
+        return mask
+
+
+    def set_watch_budget(self, max_watches=None, policy=BUDGET_RAISE, skip_patterns=(), poll_interval=5.0):
+        """
+        Use at most 'max_watches' watches (the max_user_watches kernel limit
+        if None) and apply 'policy' to the directories which cannot be watched
+        (see budget.py) : BUDGET_RAISE, BUDGET_SKIP or BUDGET_POLL. The
+        subtrees monitored by polling are rescanned every 'poll_interval'
+        seconds by process_events ; their content is reported by the first
+        rescan only if it changed.
+
+        The directories whose name matches one of the fnmatch 'skip_patterns'
+        are neither watched nor crawled.
+        """
+        if policy not in BUDGET_POLICIES:
+            raise ValueError('unknown budget policy %r' % (policy,))
+        self.max_watches = max_watches
+        self.budget_policy = policy
+        self.budget_skip_patterns = tuple(skip_patterns)
+        self.poll_interval = poll_interval
+
+
+    def watch_headroom(self):
+        """
+        Returns the number of watches we can still add, None if unknown.
+        The kernel limit is shared by all the inotify instances of the user :
+        see budget.count_user_watches.
+        """
+        max_watches = self.max_watches
+        if max_watches is None:
+            max_watches = self.inotify_limits.get('max_user_watches')
+        if max_watches is None:
+            return None
+        return max(max_watches - len(self.watches), 0)
+
+
+    def _watch_budget_exhausted(self, path):
+        """
+        Apply the budget policy to 'path', which cannot be watched
+        """
+        self.unwatched_dirs += 1
+        if self.budget_policy == BUDGET_RAISE:
+            raise WatchBudgetExhausted('cannot watch %s, %d watches used' % (path, len(self.watches)))
+        if self.budget_policy == BUDGET_POLL:
+            if path not in self.polled_dirs:
+                self.polled_dirs.add(path)
+                # what's already there is not reported
+                Rescan(self._polled_snapshot, path, ignore_event, path_filter=self.path_filter).step()
+        elif self.unwatched_dirs == 1:
+            _INOTIFYX_STM_LOGGER.warning('watches budget exhausted, %s and the next ones are not monitored' % path)
+        return False
+
+
+    def _poll_due(self):
+        """
+        Start a rescan of the polled subtrees if it's time to.
+        A subtree whose previous rescan is still pending is skipped.
+        """
+        if not self.polled_dirs or time.time() < self._next_poll:
+            return
+        self._next_poll = time.time() + self.poll_interval
+        polling = set(rescan.root for rescan in self.pending_rescans
+                      if rescan.snapshot is self._polled_snapshot)
+        for path in list(self.polled_dirs):
+            if path in polling:
+                continue
+            if not os.path.isdir(path):
+                self.polled_dirs.remove(path)
+                self._polled_snapshot.remove(path)
+                continue
+            self.pending_rescans.append(Rescan(self._polled_snapshot, path, self._emit,
+                                               path_filter=self.path_filter))
 
 
     def _unwatch_dir(self, real_path):
@@ -108,19 +507,18 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
         Remove a watch on the specified path and all
         its children
         """
-        # we cannot use iterkeys here, because the dictionnary
-        # is likely to change during iteration
-        for path in self.path_to_wd.keys():
-            if path.startswith(real_path):
-                self._unwatch_dir_helper(path)
+        for watch_fd in self.watches.remove_subtree(real_path):
+            self._rm_watch(watch_fd)
 
 
     def _rm_watch(self, watch_fd):
         """
         Remove an inotify watch on the specified path
+        ('watch_fd' comes from the registry, see _watch_dir)
         """
+        shard = watch_fd % self.shards_number
         try:
-            self.inotifyx.rm_watch(self.inotify_fd, watch_fd)
+            self.inotifyx.rm_watch(self.inotify_fds[shard], watch_fd // self.shards_number)
         except IOError, err:
             if err.errno != errno.EINVAL:
                 raise
@@ -132,40 +530,243 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
         Stop inotifyx subsystem
         Call it from the same thread you've started your file monitor !
         """
-        os.close(self.inotify_fd)
+        self._stop_worker_processes()
+        self._stop_readers()
+        if self.snapshot_file is not None:
+            self.snapshot.save(self.snapshot_file, self.source_dirs)
+        map(os.close, self.inotify_fds)
+        self._close_wakeup_pipe()
+        self.crawler.close()
+
+
+    def set_overflow_resync(self, enabled=True, dirs_per_second=1000):
+        """
+        When the kernel events queue overflows, events are lost. If enabled,
+        we keep a snapshot of the watched trees (see snapshot.py) and rescan
+        them after an overflow : the differences are reported as create,
+        delete and close_write events, and the missing watches are added.
+
+        The rescan is done by process_events, 'dirs_per_second' directories
+        per second at most, between the reads of the new events.
+        Keeping the snapshot up to date costs a stat per event.
+        Call it before add_source_dir.
+        """
+        self.resync_rate = dirs_per_second
+        if enabled:
+            if self.snapshot is None:
+                self.snapshot = TreeSnapshot()
+        elif self.snapshot_file is None:
+            self.snapshot = None
+            self.pending_rescans.clear()
+
+
+    def set_snapshot_file(self, filename, stat_files=True):
+        """
+        Save the snapshot of the watched trees in 'filename' when the monitor
+        is stopped, and load it when it's started. The trees found in the
+        snapshot are then rescanned by process_events instead of being crawled
+        by add_source_dir : only the directories whose mtime changed are listed,
+        and the changes which happened while we were down are reported as events.
+
+        The files of the other directories are checked one by one, since a file
+        appended or rewritten in place doesn't change the mtime of its directory.
+        If 'stat_files' is False, they are not : the restart is faster, but
+        these changes are missed.
+
+        It enables the overflow resync (see set_overflow_resync).
+        Call it before start.
+        """
+        self.snapshot_file = filename
+        self.snapshot_stat_files = stat_files
+        if filename is not None and self.snapshot is None:
+            self.snapshot = TreeSnapshot()
+
+
+    def _start_resync(self, paths=None):
+        """
+        Rescan every root, or the 'paths' trees, from scratch if a rescan
+        was already running
+        """
+        if paths is None:
+            paths = self.source_dirs
+            self.pending_rescans.clear()
+        else:
+            # the rescans of the other trees go on
+            self.pending_rescans = collections.deque(rescan for rescan in self.pending_rescans
+                                                     if rescan.root not in paths)
+        for path in paths:
+            self.pending_rescans.append(Rescan(self.snapshot, path, self._emit_rescan_event,
+                                               self._watch_crawled_dir, path_filter=self.path_filter))
+        self._next_rescan = 0
+
+
+    def _emit_rescan_event(self, code, path, is_dir):
+        """
+        Emit an event found by a rescan
+        """
+        self._emit(code, path, is_dir)
+        if code == EVENT_DELETE and is_dir:
+            self._remove_source_dir(path)
+
+
+    def _rescan_due(self):
+        """
+        Returns True if the pending rescans have to be continued now
+        """
+        return self.pending_rescans and time.time() >= self._next_rescan
+
+
+    def _continue_rescans(self):
+        """
+        Rescan the directories allowed by resync_rate since the last call
+        """
+        now = time.time()
+        budget = max(int(self.resync_rate * _RESCAN_PERIOD), 1)
+        while self.pending_rescans and budget > 0:
+            rescan = self.pending_rescans[0]
+            dirs = rescan.dirs
+            if rescan.step(budget):
+                self.pending_rescans.popleft()
+            budget -= max(rescan.dirs - dirs, 1)
+        self._next_rescan = now + _RESCAN_PERIOD
+        self._flush_events_batch()
+
+
+    def _periodic_work(self):
+        """
+        see SourceTreeMonitor._periodic_work. We also poll the subtrees over
+        the watches budget, and continue the pending crawls and rescans.
+        """
+        self._poll_due()
+        if self.pending_crawls:
+            self._continue_crawls()
+        if self._rescan_due():
+            self._continue_rescans()
+        deadline = SourceTreeMonitor._periodic_work(self)
+        # no wait if we have some crawling to do
+        for pending, next_time in ((self.pending_crawls, 0),
+                                   (self.pending_rescans, self._next_rescan),
+                                   (self.polled_dirs, self._next_poll)):
+            if pending and (deadline is None or next_time < deadline):
+                deadline = next_time
+        return deadline
+
+
+    def _emit_crawled_entry(self, path, is_dir):
+        """
+        Emit the events of an entry found in a new directory
+        """
+        self._emit(EVENT_CREATE, path, is_dir)
+        if not is_dir:
+            # if we detect a file, we assume its ready to read.
+            # The not ready case has to handled in the callback.
+            # If the file it's not ready, we assume that a normal
+            # IN_CLOSE_WRITE event will we triggered by the inotify subsystem
+            self._emit(EVENT_CLOSE_WRITE, path, is_dir)
+
+
+    def _watch_crawled_dir(self, path):
+        """
+        Add a watch on a directory found by the crawler.
+        We already know it's a directory.
+        """
+        return self._watch_dir(path, check_dir=False)
+
+
+    def _snapshot_crawled_entry(self, path, is_dir):
+        """
+        Add an entry found in a new directory to the snapshot
+        """
+        self.snapshot.update(path)
+
+
+    def _snapshot_and_emit_crawled_entry(self, path, is_dir):
+        """
+        Add an entry found in a new directory to the snapshot and emit its events
+        """
+        self.snapshot.update(path)
+        self._emit_crawled_entry(path, is_dir)
 
 
     def _add_source_dir(self, path, do_events=True):
         """
         Add a source_dir recursively
         """
-        success = self._watch_dir(path)
-        if not success:
+        if not os.path.isdir(path):
             return
-        try:
-            names = os.listdir(path)
-        except (OSError, IOError):
+        if self.path_filter is not None and not self.path_filter.accepts(path, True):
             return
-        for name in names:
-            sub_path = os.path.join(path, name)
-            isdir = os.path.isdir(sub_path)
+        if self.snapshot is not None:
             if do_events:
-                self.events_callbacks._create(sub_path, isdir)
-            if not isdir and do_events:
-                # if we detect a file, we assume its ready to read.
-                # The not ready case has to handled in the callback.
-                # If the file it's not ready, we assume that a normal
-                # IN_CLOSE_WRITE event will we triggered by the inotify subsystem
-                self.events_callbacks._close_write(sub_path, isdir)
-            elif isdir:
-                self._add_source_dir(sub_path, do_events=do_events)
+                on_entry = self._snapshot_and_emit_crawled_entry
+            else:
+                on_entry = self._snapshot_crawled_entry
+        elif do_events:
+            on_entry = self._emit_crawled_entry
+        else:
+            on_entry = None
+        crawl = self.crawler.start_crawl(path, self._watch_crawled_dir, on_entry, self.path_filter)
+        if self.crawl_step is None:
+            crawl.step()
+        elif not crawl.done():
+            # it will be continued by process_events (see _continue_crawls)
+            self.pending_crawls.append(crawl)
+
+
+    def _continue_crawls(self):
+        """
+        List at most crawl_step directories from the pending crawls
+        (all of them if crawl_step is None)
+        """
+        budget = self.crawl_step
+        while self.pending_crawls and (budget is None or budget > 0):
+            crawl = self.pending_crawls[0]
+            dirs = crawl.dirs
+            if crawl.step(budget):
+                self.pending_crawls.popleft()
+            if budget is not None:
+                budget -= max(crawl.dirs - dirs, 1)
+        self._flush_events_batch()
 
 
     def add_source_dir(self, path):
         """
         Add a source_dir recursively
         """
-        self._add_source_dir(path, do_events=False)
+        if not os.path.isdir(path) or path in self.source_dirs:
+            return
+        self.source_dirs.append(path)
+        if self.snapshot is None:
+            self._add_source_dir(path, do_events=False)
+        elif self.snapshot.entries(path) is not None:
+            # loaded from the snapshot file : we only report the changes.
+            # Rescan.step works like Crawl.step (see _continue_crawls). It's
+            # run by process_events, once the workers consume the events queue
+            # (a full bounded multiprocessing queue would block us here).
+            self.pending_crawls.append(Rescan(self.snapshot, path, self._emit_rescan_event,
+                                              self._watch_crawled_dir, trust_mtime=True,
+                                              stat_files=self.snapshot_stat_files,
+                                              path_filter=self.path_filter))
+        else:
+            self.snapshot.add_dir(path)
+            self._add_source_dir(path, do_events=False)
+
+
+    def remove_source_dir(self, path):
+        """
+        Stop monitoring a source dir given to add_source_dir
+        """
+        if path not in self.source_dirs:
+            return
+        self.source_dirs.remove(path)
+        if self.snapshot is not None:
+            self.snapshot.remove(path)
+        # they would watch it again
+        self.pending_crawls = collections.deque(crawl for crawl in self.pending_crawls
+                                                if self._source_dir_of(crawl.root) is not None)
+        self.pending_rescans = collections.deque(rescan for rescan in self.pending_rescans
+                                                 if self._source_dir_of(rescan.root) is not None)
+        self._remove_source_dir(path)
 
 
     def _remove_source_dir(self, real_path):
@@ -173,6 +774,11 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
         Remove watch from real_path
         """
         self._unwatch_dir(real_path)
+        if self._shard_keys:
+            # an overflow of their shard would rescan them
+            prefix = real_path.rstrip('/') + '/'
+            for key in [ key for key in self._shard_keys if key == real_path or key.startswith(prefix) ]:
+                del self._shard_keys[key]
 
 
     def remove_source_file(self, real_path):
@@ -181,12 +787,87 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
         """
         pass
 
-    def _process_event(self, event):
+    def _flush_pending_move(self):
+        """
+        The pending IN_MOVED_FROM has no IN_MOVED_TO : it left the watched trees
+        """
+        source = self._pending_move
+        self._pending_move = None
+        if self.snapshot is not None:
+            self.snapshot.remove(source.path)
+        source.code = EVENT_MOVED_FROM
+        self._emit_event(source)
+        if source.is_dir:
+            self._remove_source_dir(source.path)
+
+
+    def _moved(self, source, destination):
+        """
+        The 'source' Event has been renamed 'destination', both in the watched
+        trees. A directory keeps its watches, only their paths are updated.
+        """
+        src = source.path
+        dst = destination.path
+        is_dir = destination.is_dir
+        if self._pair_moves:
+            self._emit_event(Event(EVENT_MOVED, (src, dst), None, is_dir,
+                                   destination.cookie, destination.mask, destination.read_time))
+        else:
+            source.code = EVENT_MOVED_FROM
+            self._emit_event(source)
+            destination.code = EVENT_MOVED_TO
+            self._emit_event(destination)
+        if is_dir:
+            # a directory replaced by the rename
+            self._unwatch_dir(dst)
+            if not self.watches.rename(src, dst):
+                # it was not watched (see set_watch_budget)
+                self._add_source_dir(dst, do_events=False)
+        if self.snapshot is not None:
+            self.snapshot.rename(src, dst)
+
+
+    def _moved_to(self, destination):
+        """
+        The 'destination' Event comes from outside the watched trees
         """
-        Process one inotify event
+        if self.snapshot is not None:
+            self.snapshot.update(destination.path)
+        destination.code = EVENT_MOVED_TO
+        self._emit_event(destination)
+        if destination.is_dir:
+            # we have never seen its content
+            self._add_source_dir(destination.path)
+
+
+    def _process_event(self, event, shard=0):
         """
+        Process one inotify event read from the 'shard' inotify instance
+        """
+        if self._pending_move is not None and \
+           not (event.mask & self.inotifyx.IN_MOVED_TO and event.cookie == self._pending_move.cookie):
+            # the two events of a rename are queued one after the other
+            self._flush_pending_move()
+
+        if event.mask & self.inotifyx.IN_Q_OVERFLOW:
+            # not related to a watch
+            self.overflows += 1
+            if self.snapshot is None:
+                _INOTIFYX_STM_LOGGER.warning('inotify events queue overflowed, events were lost '
+                                             '(see set_overflow_resync)')
+            elif self.shards_number == 1:
+                _INOTIFYX_STM_LOGGER.warning('inotify events queue overflowed, rescanning the source dirs')
+                self._start_resync()
+            else:
+                paths = [ key for key, key_shard in self._shard_keys.iteritems()
+                          if key_shard == shard and self._source_dir_of(key) is not None ]
+                _INOTIFYX_STM_LOGGER.warning('inotify events queue %d overflowed, rescanning %s' % \
+                                             (shard, ', '.join(sorted(paths))))
+                self._start_resync(paths)
+            return
+
         try:
-            basepath = self.wd_to_path[event.wd]
+            basepath = self.watches.get_path(event.wd * self.shards_number + shard)
         except KeyError:
             # We got an event for a path that we are no longer watching.  If
             # the event is IN_IGNORED, this is expected since we get IN_IGNORED
@@ -201,51 +882,84 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
                 )
             return
 
-        if event.name:
-            path = os.path.join(basepath, event.name)
+        inotifyx = self.inotifyx
+        mask = event.mask
+        if mask & inotifyx.IN_CREATE:
+            code = EVENT_CREATE
+        elif mask & inotifyx.IN_DELETE:
+            code = EVENT_DELETE
+        elif mask & inotifyx.IN_CLOSE_WRITE:
+            code = EVENT_CLOSE_WRITE
+        elif mask & inotifyx.IN_MOVED_FROM:
+            code = EVENT_MOVED_FROM
+        elif mask & inotifyx.IN_MOVED_TO:
+            code = EVENT_MOVED_TO
+        elif mask & inotifyx.IN_MODIFY:
+            code = EVENT_MODIFY
+        elif mask & inotifyx.IN_ATTRIB:
+            code = EVENT_ATTRIB
+        elif mask & inotifyx.IN_UNMOUNT:
+            code = EVENT_UNMOUNT
+        elif mask & inotifyx.IN_IGNORED:
+            return
         else:
-            path = basepath
+            raise ValueError(
+              'failed to match event mask: %s' % event.get_mask_description()
+            )
+
+        is_dir = bool(mask & inotifyx.IN_ISDIR)
+        name = event.name or None
+        path = None
+        if code == EVENT_MOVED_FROM or code == EVENT_MOVED_TO or self.coalescer is not None or \
+           self._callbacks_table[code] is not None:
+            # its path is built only if needed (see events.py)
+            new_event = Event(code, basepath, name, is_dir, event.cookie, mask, self._read_time)
+        else:
+            # nobody wants it : no Event is built, and its path only if needed
+            new_event = None
+            if self.path_filter is not None or self.snapshot is not None or is_dir:
+                path = _event_path(basepath, name)
+
+        if self.path_filter is not None:
+            if path is None:
+                path = new_event.path
+            if not self.path_filter.accepts(path, is_dir):
+                # a rename out of the filter is seen as a move out of the trees,
+                # and the other way round (see _flush_pending_move)
+                return
 
-        is_dir = bool(event.mask & self.inotifyx.IN_ISDIR)
-        events_cb = self.events_callbacks
+        if self.snapshot is not None:
+            if path is None:
+                path = new_event.path
+            # see _moved and _moved_to for the moves
+            if code == EVENT_DELETE:
+                self.snapshot.remove(path)
+            elif code in (EVENT_CREATE, EVENT_CLOSE_WRITE, EVENT_MODIFY, EVENT_ATTRIB):
+                self.snapshot.update(path)
 
-        if event.mask & self.inotifyx.IN_CREATE:
-            events_cb._create(path, is_dir)
-            # we manually handle any created subdir
-            if is_dir:
+        if code == EVENT_MOVED_FROM:
+            # wait for the IN_MOVED_TO with the same cookie
+            self._pending_move = new_event
+            return
+        if code == EVENT_MOVED_TO:
+            if self._pending_move is not None:
+                source = self._pending_move
+                self._pending_move = None
+                self._moved(source, new_event)
+            else:
+                self._moved_to(new_event)
+            return
+
+        if new_event is not None:
+            self._emit_event(new_event)
+        if is_dir and code in (EVENT_CREATE, EVENT_DELETE, EVENT_UNMOUNT):
+            if path is None:
+                path = new_event.path
+            # we manually handle any created, deleted or unmounted subdir
+            if code == EVENT_CREATE:
                 self._add_source_dir(path)
-        elif event.mask & self.inotifyx.IN_DELETE:
-            events_cb._delete(path, is_dir)
-            # we manually handle any deleted subdir
-            if is_dir:
-                self._remove_source_dir(path)
-        elif event.mask & self.inotifyx.IN_CLOSE_WRITE:
-            events_cb._close_write(path, is_dir)
-        elif event.mask & self.inotifyx.IN_MOVED_FROM:
-            events_cb._moved_from(path, is_dir)
-            if is_dir:
-                self._remove_source_dir(path)
-        elif event.mask & self.inotifyx.IN_MOVED_TO:
-            events_cb._moved_to(path, is_dir)
-        elif event.mask & self.inotifyx.IN_MODIFY:
-            events_cb._modify(path, is_dir)
-        elif event.mask & self.inotifyx.IN_ATTRIB:
-            events_cb._attrib(path, is_dir)
-        elif event.mask & self.inotifyx.IN_UNMOUNT:
-            events_cb._unmount(path, is_dir)
-            if is_dir:
+            else:
                 self._remove_source_dir(path)
-        elif event.mask & self.inotifyx.IN_IGNORED:
-            pass
-        elif event.mask & self.inotifyx.IN_Q_OVERFLOW:
-            logging.debug(
-              'InotifyxSourceTreeMonitor: '
-              'event queue overflowed, events were probably lost'
-            )
-        else:
-            raise ValueError(
-              'failed to match event mask: %s' % event.get_mask_description()
-            )
 
 
     def _get_events(self, block=False):
@@ -261,128 +975,86 @@ class InotifyxSourceTreeMonitor(SourceTreeMonitor):
 
     def _process_events_internal(self, block=False):
         """
-        Internal event process loop
+        Internal event process loop : process the events read by the
+        reader threads, or read them ourself
         """
-        for event in self._get_events(block=block):
-            self._process_event(event)
-
+        if self._readers:
+            room = self._read_buffer_room
+            while True:
+                with room:
+                    if not self._read_buffer:
+                        break
+                    shard, events, read_time = self._read_buffer.popleft()
+                    self._read_buffer_events -= len(events)
+                    room.notify_all()
+                self._process_read(events, shard, read_time)
+        else:
+            self._process_read(self._get_events(block=block), 0, time.time())
+        self._flush_events_batch()
 
-    def _start_events_queue_processing(self, ev_queue=None):
-        try:
-            self._start_events_queue_processing_protected(ev_queue)
-        except KeyboardInterrupt:
-            # handle gracefully the exception
-            # useful in multiprocessing mode
-            return
 
-    def _start_events_queue_processing_protected(self, ev_queue=None):
+    def _process_read(self, events, shard, read_time):
         """
-        This internal function encapsulate the logic around the events_queue
-        depending on the type of the callback.
-
-        This function is used in serial, threaded an multiprocessing mode.
-        In the last two mode, this function is the target argument of the
-        Thread/Process constructor
+        Process the events of one read of the 'shard' inotify instance
         """
-        # TODO: the multiprocessing mode does not work like i want
-        # when i've got shared state between callback. I need to figure
-        # out why
-        if self.events_callbacks._multiprocessing:
-            events_queue = ev_queue
-        else:
-            events_queue = self.events_queue
-
-        # some lambda logic function to have a "clean" while loop condition
-        if not self.events_callbacks._serial:
-            continue_condition = lambda: True
-        else:
-            # it's safe to call empty here because there is not concurrent access
-            # to the events_queue
-            continue_condition = lambda: not events_queue.empty()
+        if self.metrics is not None:
+            # the events carry the time they were read (see set_stats)
+            self._read_time = read_time
+        for event in events:
+            self._process_event(event, shard)
+        # the two events of a rename are read together
+        if self._pending_move is not None:
+            self._flush_pending_move()
+        self._read_time = None
 
-        while True:
-            event = events_queue.get()
-            if event is StopIteration:
-                break
-            # we retrieve a event triplet like ('create', '/tmp/foo', True)
-            # we call the adequate function of the events_callbacks object
-            callback = getattr(self.events_callbacks, event[0], None)
-            if callback:
-                print callback, event[1], event[2]
-                callback(event[1], event[2])
-
-        # need to put StopIteration here to handle threads/processes join !
-        if not self.events_callbacks._serial:
-            events_queue.put(StopIteration)
-
-
-    def _start_events_queue_processes(self, number):
-        """
-        This internal function handles the threads/processes creation
-        in threaded and multiprocessing mode.
-
-        It returns the list of the threads/processes created to join on them
-        when the work is finished.
-        """
-        processes = []
-        for _ in range(number):
-            if self.events_callbacks._threaded:
-                processes.append(threading.Thread(target=self._start_events_queue_processing))
-            elif self.events_callbacks._multiprocessing:
-                processes.append(multiprocessing.Process(target=self._start_events_queue_processing, args=(self.events_queue,)))
-            else:
-                assert False, "Cannot start processes or threads in serial mode."
-            processes[-1].start()
 
-        return processes
+    def stats(self):
+        """
+        see SourceTreeMonitor.stats
+        """
+        stats = SourceTreeMonitor.stats(self)
+        stats['watches'] = len(self.watches)
+        stats['registry_bytes'] = self.watches.memory_usage()
+        if self._readers:
+            stats['read_buffer'] = self._read_buffer_events
+        return stats
 
 
-    def process_events(self, timeout=None, until_predicate=None, sleep_delay=0.1):
+    def fileno(self):
+        """
+        Returns the inotify file descriptor, or the file descriptor the
+        reader threads write to when they have read some events
         """
-        Event process loop during timeout seconds at most or when the predicate became true
+        if self._readers:
+            return self._wakeup_fds[0]
+        return self.inotify_fd
 
-        If the user specify an until_predicate callable, we don't block on getting inotify
-        event. Instead, we retrieve events using non blocking mode and we sleep during sleep_delay
-        before evaluating the predicate again.
 
-        If the user didn't provide a timeout and a predicate function, we block on getting inotify
-        events.
+    def read_events(self):
         """
+        Read the pending inotify events and put them in the events queue
+        """
+        if self._readers:
+            self._drain_wakeup()
+        self._process_events_internal(block=False)
 
-        if not timeout:
-            timeout = sys.maxint
-
-        if not self.events_callbacks._serial:
-            processes = self._start_events_queue_processes(number=self.workers)
-        # we want to block if the user didn't specify any timeout and no until_predicate function
-        block = False
-        if timeout == sys.maxint and not until_predicate:
-            block = True
 
-        # hack to make the while loop work even if no predicate function is given
-        if not until_predicate:
-            until_predicate = lambda: False
+    def _new_poller(self):
+        """
+        see SourceTreeMonitor._new_poller. We wait for the inotify file
+        descriptor too, unless the reader threads read it.
+        """
+        poller = SourceTreeMonitor._new_poller(self)
+        if not self._readers:
+            poller.register(self.inotify_fd, select.POLLIN)
+        return poller
 
-        start = time.time()
-        delay = 0
 
-        try:
-            while delay < timeout and not until_predicate():
-                self._process_events_internal(block=block)
-                if self.events_callbacks._serial:
-                    self.events_queue.put(StopIteration)
-                    self._start_events_queue_processing()
-                if not block or self.events_callbacks._threaded:
-                    # why include self.events_callbacks._threaded in the previous test ?
-                    # without this sleep, the GIL does not seem to be released (inotifyx behaviour ?)
-                    # looks horrible to me
-                    time.sleep(sleep_delay)
-                delay = time.time() - start
-
-        finally:
-            # we tell the threads/processes to stop
-            if not self.events_callbacks._serial:
-                self.events_queue.put(StopIteration)
-                map(lambda p: p.join(), processes)
-            # we replace the current queue by an empty one
-            self.reset_queue()
+    def _wait_for_events(self, poller, wait):
+        """
+        see SourceTreeMonitor._wait_for_events. The events already read by
+        the reader threads are available too.
+        """
+        if self._read_buffer:
+            wait = 0
+        return SourceTreeMonitor._wait_for_events(self, poller, wait) or bool(self._read_buffer)
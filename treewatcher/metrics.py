@@ -0,0 +1,208 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Monitor metrics (see SourceTreeMonitor.set_stats and SourceTreeMonitor.stats)
+
+When the stats are enabled, each queued event carries the time it was read
+from the kernel, or found by a crawl or a scan (Event.read_time), and two
+histograms are kept :
+
+ - 'latency' : from the read of the event to the start of its callback,
+ - 'duration' : the duration of the callbacks.
+
+In multiprocessing mode, the histograms live in shared memory : they are
+updated by the worker processes.
+
+PrometheusExporter serves the stats of a monitor in the Prometheus text
+format, from a thread of the monitor process.
+"""
+
+import bisect
+import threading
+import multiprocessing
+import BaseHTTPServer
+
+
+# upper bounds of the buckets of the histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Fixed buckets histogram, safe to update from several threads,
+    or from several processes if 'shared' is True.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS, shared=False):
+        """ init """
+        self.bounds = tuple(bounds)
+        # one counter per bucket, the +Inf bucket, the sum and the count
+        size = len(self.bounds) + 3
+        if shared:
+            self._values = multiprocessing.Array('d', size)
+            self._lock = self._values.get_lock()
+        else:
+            self._values = [ 0.0 ] * size
+            self._lock = threading.Lock()
+
+
+    def observe(self, value):
+        """
+        Add 'value' to the histogram
+        """
+        index = bisect.bisect_left(self.bounds, value)
+        values = self._values
+        with self._lock:
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+
+    def read(self):
+        """
+        Returns {'buckets': [(upper bound, cumulative count)...], 'sum', 'count'},
+        the last bucket being (float('inf'), count)
+        """
+        with self._lock:
+            values = list(self._values)
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), values[:-2]):
+            total += int(count)
+            buckets.append((bound, total))
+        return {'buckets': buckets, 'sum': values[-2], 'count': int(values[-1])}
+
+
+class Metrics(object):
+    """
+    The counters and histograms of a monitor
+    """
+
+    def __init__(self, events_number, shared=False):
+        """
+        'events_number' is the number of event codes (see EVENTS_NAMES).
+        'shared' has to be True if the callbacks are called by worker processes.
+        """
+        # number of events put in the events queue, per event code
+        self.events = [ 0 ] * events_number
+        self.max_queue_depth = 0
+        self.latency = Histogram(shared=shared)
+        self.duration = Histogram(shared=shared)
+
+
+def format_prometheus(stats, prefix='treewatcher'):
+    """
+    Returns the 'stats' of a monitor (see SourceTreeMonitor.stats)
+    in the Prometheus text format
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        """ add a metric and its (labels, value) samples """
+        name = '%s_%s' % (prefix, name)
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            if labels:
+                labels = '{%s}' % ','.join('%s="%s"' % label for label in labels)
+            else:
+                labels = ''
+            lines.append('%s%s%s %s' % (name, suffix, labels, repr(float(value))))
+
+    if 'events' in stats:
+        metric('events_total', 'counter', 'Events put in the events queue.',
+               [ ('', (('event', name),), count) for name, count in sorted(stats['events'].items()) ])
+    for key, help_text in (('watches', 'Watched directories.'),
+                           ('registry_bytes', 'Approximate memory used by the watched directories registry.'),
+                           ('read_buffer', 'Events read by the reader threads, not processed yet.'),
+                           ('queue_depth', 'Items in the events queues.'),
+                           ('max_queue_depth', 'Most items seen in an events queue.')):
+        if stats.get(key) is not None:
+            metric(key, 'gauge', help_text, [ ('', (), stats[key]) ])
+    metric('overflows_total', 'counter', 'Kernel events queue overflows.', [ ('', (), stats['overflows']) ])
+    metric('queue_events_total', 'counter', 'Events dropped, coalesced or blocked by a full events queue.',
+           [ ('', (('action', name),), count) for name, count in sorted(stats['queue'].items()) ])
+    for key, help_text in (('latency', 'Seconds from the read of an event to its callback.'),
+                           ('duration', 'Seconds spent in the callbacks.')):
+        if key not in stats:
+            continue
+        histogram = stats[key]
+        samples = [ ('_bucket', (('le', '+Inf' if bound == float('inf') else repr(bound)),), count)
+                    for bound, count in histogram['buckets'] ]
+        samples.append(('_sum', (), histogram['sum']))
+        samples.append(('_count', (), histogram['count']))
+        metric('callback_%s_seconds' % key, 'histogram', help_text, samples)
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the stats of the monitor of the server, whatever the requested path
+    """
+
+    def do_GET(self):
+        """ GET handler """
+        body = format_prometheus(self.server.stm.stats(), self.server.prefix)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        """ no access log """
+        pass
+
+
+class PrometheusExporter(object):
+    """
+    Serve the stats of 'stm' over HTTP, in the Prometheus text format.
+    It listens on the loopback interface by default. Use port 0 to get a
+    free port (see the port attribute once started).
+    """
+
+    def __init__(self, stm, port=9108, address='127.0.0.1', prefix='treewatcher'):
+        """ init """
+        self.stm = stm
+        self.address = address
+        self.port = port
+        self.prefix = prefix
+        self._server = None
+        self._thread = None
+
+
+    def start(self):
+        """
+        Start serving from a daemon thread
+        """
+        self._server = BaseHTTPServer.HTTPServer((self.address, self.port), _MetricsHandler)
+        self._server.stm = self.stm
+        self._server.prefix = self.prefix
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop serving
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
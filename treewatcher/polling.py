@@ -0,0 +1,191 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Polling based tree monitor.
+
+inotify only sees the changes made through the local kernel : on NFS or
+CIFS, the changes made by the other clients are never reported. This monitor
+keeps a snapshot of the trees (see snapshot.py) and rescans them periodically,
+reporting the differences as create, delete and close_write events.
+
+A directory whose mtime didn't change is not listed again, only its files
+are stat'ed. The interval between two scans adapts itself : it's reset to
+the minimum interval when something changed, and doubled up to the maximum
+interval otherwise. The directories can be read by a pool of threads (see
+SourceTreeMonitor.set_crawler_workers_number), which helps a lot on network
+filesystems.
+
+A scan is done by process_events a few directories at a time (see
+set_poll_interval), like the overflow rescans of the inotify monitors :
+the events found so far are dispatched and the predicate is evaluated
+between two steps, whatever the size of the trees. A scan still stats
+every file of the trees : its cost grows with them, only the delay it
+adds to process_events is bounded.
+"""
+
+import os
+import time
+import logging
+import collections
+
+from treewatcher import SourceTreeMonitor
+from treewatcher.snapshot import TreeSnapshot, Rescan, ignore_event
+
+_POLLING_STM_LOGGER = logging.getLogger('_POLLING_STM_LOGGER')
+_POLLING_STM_LOGGER.setLevel(logging.INFO)
+_POLLING_STM_LOGGER.addHandler(logging.StreamHandler())
+
+
+class PollingSourceTreeMonitor(SourceTreeMonitor):
+    """
+    Polling based tree monitor class
+    """
+
+    def __init__(self):
+        """ init """
+        SourceTreeMonitor.__init__(self)
+        self.snapshot = TreeSnapshot()
+        self.source_dirs = []
+        # see set_poll_interval
+        self.min_interval = 1.0
+        self.max_interval = 30.0
+        self.interval = self.min_interval
+        self._next_poll = 0
+        self.scan_step = 1000
+        # rescans of the current scan, one per source dir
+        self._scans = collections.deque()
+        # number of events reported by the current scan
+        self._scan_events = 0
+
+
+    def set_poll_interval(self, min_interval=1.0, max_interval=30.0, scan_step=1000):
+        """
+        The trees are scanned every 'min_interval' seconds after a change,
+        and up to every 'max_interval' seconds when nothing changes.
+        process_events lists at most 'scan_step' directories between two
+        dispatches of the events (None means the trees are scanned at once) :
+        a scan can go on over several process_events calls.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.scan_step = scan_step
+
+
+    def start(self, debug = False):
+        """
+        Nothing to start but the wakeup pipe
+        """
+        self._open_wakeup_pipe()
+
+
+    def stop(self):
+        """
+        Stop the worker processes and the scanning threads
+        """
+        self._stop_worker_processes()
+        self._close_wakeup_pipe()
+        self.crawler.close()
+
+
+    def _rescan(self, root, on_event, trust_mtime=True):
+        """
+        Returns a Rescan of 'root', using the threads of the crawler if any
+        """
+        workers = self.crawler.workers
+        if workers > 1:
+            pool = self.crawler._get_pool()
+        else:
+            pool = None
+        return Rescan(self.snapshot, root, on_event, trust_mtime=trust_mtime, stat_files=True,
+                      pool=pool, workers=workers, path_filter=self.path_filter)
+
+
+    def add_source_dir(self, path):
+        """
+        Add a source dir : its current content is not reported
+        """
+        if not os.path.isdir(path) or path in self.source_dirs:
+            return
+        self.source_dirs.append(path)
+        self._rescan(path, ignore_event, trust_mtime=False).step()
+
+
+    def remove_source_dir(self, path):
+        """
+        Stop monitoring a source dir given to add_source_dir
+        """
+        if path not in self.source_dirs:
+            return
+        self.source_dirs.remove(path)
+        self._scans = collections.deque(scan for scan in self._scans if scan.root != path)
+        self.snapshot.remove(path)
+
+
+    def _emit_scan_event(self, code, path, is_dir):
+        """
+        Emit an event found by a scan
+        """
+        self._scan_events += 1
+        self._emit(code, path, is_dir)
+
+
+    def _poll(self, max_dirs=None):
+        """
+        Scan at most 'max_dirs' directories (all of them if None), starting a
+        new scan of every source dir if none is running. The next scan is
+        scheduled when the current one is over.
+        """
+        if not self._scans:
+            self._scan_events = 0
+            self._scans.extend(self._rescan(path, self._emit_scan_event) for path in self.source_dirs)
+        # see InotifyxSourceTreeMonitor._continue_rescans
+        budget = max_dirs
+        while self._scans and (budget is None or budget > 0):
+            scan = self._scans[0]
+            dirs = scan.dirs
+            if scan.step(budget):
+                self._scans.popleft()
+            if budget is not None:
+                budget -= max(scan.dirs - dirs, 1)
+        self._flush_events_batch()
+        if self._scans:
+            return
+
+        if self._scan_events:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self._next_poll = time.time() + self.interval
+
+
+    def _periodic_work(self):
+        """
+        see SourceTreeMonitor._periodic_work. We also scan the trees when
+        it's time to, and continue the current scan without waiting.
+        """
+        if self._scans or time.time() >= self._next_poll:
+            self._poll(self.scan_step)
+        deadline = SourceTreeMonitor._periodic_work(self)
+        if self._scans:
+            return 0
+        if deadline is None or self._next_poll < deadline:
+            return self._next_poll
+        return deadline
+
+
+    def read_events(self):
+        """
+        Scan the trees now, or finish the current scan, and put the events
+        in the events queue
+        """
+        self._poll()
@@ -0,0 +1,201 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Bounded events queues (see SourceTreeMonitor.set_events_queue_bound)
+
+When the bound is reached, one of the following policies is applied :
+
+ - QUEUE_BLOCK : the monitor waits for the callbacks to make some room
+   (when no worker is consuming the queue, like in serial mode, the monitor
+   calls the callbacks of the queued events right away)
+ - QUEUE_DROP_OLDEST : the oldest queued events are dropped
+ - QUEUE_DROP_NEWEST : the new event is dropped
+ - QUEUE_COALESCE : the new event is dropped if the same event (same code,
+   path and type) is already queued, otherwise we block like QUEUE_BLOCK
+
+StopIteration, used to stop the workers, is never dropped and ignores the bound.
+"""
+
+import Queue
+import collections
+
+from treewatcher.events import Event
+
+
+QUEUE_BLOCK = 'block'
+QUEUE_DROP_OLDEST = 'drop_oldest'
+QUEUE_DROP_NEWEST = 'drop_newest'
+QUEUE_COALESCE = 'coalesce'
+
+QUEUE_POLICIES = (QUEUE_BLOCK, QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_COALESCE)
+
+
+def new_queue_counters():
+    """
+    Returns the counters updated by the bounded queues
+    """
+    return {'dropped': 0, 'coalesced': 0, 'blocked': 0}
+
+
+def _coalescing_key(event):
+    """
+    The (code, path, is_dir) triplet of an event
+    """
+    return (event.code, event.path, event.is_dir)
+
+
+def _events_number(item):
+    """
+    Number of events in a queue item (see SourceTreeMonitor.set_events_batching)
+    """
+    if type(item) is list:
+        return len(item)
+    return 1
+
+
+class BoundedEventsQueue(Queue.Queue):
+    """
+    Queue.Queue holding at most 'bound' events, applying 'policy' when it's full.
+    Batches of events count for the number of events they hold.
+    """
+
+    def __init__(self, bound, policy, counters):
+        """
+        'counters' is a dict from new_queue_counters, shared by the queues
+        of a monitor.
+        """
+        self.bound = bound
+        self.policy = policy
+        self.counters = counters
+        # drain(queue) is called instead of waiting when the queue is full
+        # and nobody else is consuming it (see SourceTreeMonitor._new_queue)
+        self.drain = None
+        # the bound is handled by put, not by Queue.Queue
+        Queue.Queue.__init__(self)
+
+
+    def _init(self, maxsize):
+        """ Queue.Queue internal storage """
+        self.queue = collections.deque()
+        self.events = 0
+        # number of queued occurrences of each event, for QUEUE_COALESCE
+        self.pending = {}
+
+
+    def _qsize(self, len=len):
+        """ Number of queued events """
+        return self.events
+
+
+    def _put(self, item):
+        """ Queue.Queue internal storage """
+        self.queue.append(item)
+        self.events += _events_number(item)
+        if self.policy == QUEUE_COALESCE and type(item) is Event:
+            key = _coalescing_key(item)
+            self.pending[key] = self.pending.get(key, 0) + 1
+
+
+    def _get(self):
+        """ Queue.Queue internal storage """
+        item = self.queue.popleft()
+        self._forget(item)
+        return item
+
+
+    def _forget(self, item):
+        """
+        Update our accounting when 'item' leaves the queue
+        """
+        self.events -= _events_number(item)
+        if self.policy == QUEUE_COALESCE and type(item) is Event:
+            key = _coalescing_key(item)
+            count = self.pending[key] - 1
+            if count:
+                self.pending[key] = count
+            else:
+                del self.pending[key]
+
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put 'item' in the queue, applying the policy if the queue is full.
+        The 'block' and 'timeout' arguments are ignored.
+        """
+        if item is StopIteration:
+            return Queue.Queue.put(self, item)
+
+        self.not_full.acquire()
+        try:
+            blocked = False
+            while self.events >= self.bound:
+                if self.policy == QUEUE_DROP_NEWEST:
+                    self.counters['dropped'] += _events_number(item)
+                    return
+                if self.policy == QUEUE_DROP_OLDEST and self.queue[0] is not StopIteration:
+                    oldest = self.queue.popleft()
+                    self._forget(oldest)
+                    self.counters['dropped'] += _events_number(oldest)
+                    # get won't be called for it
+                    self.unfinished_tasks -= 1
+                    continue
+                if self.policy == QUEUE_COALESCE and type(item) is Event and \
+                   _coalescing_key(item) in self.pending:
+                    self.counters['coalesced'] += 1
+                    return
+                if not blocked:
+                    blocked = True
+                    self.counters['blocked'] += 1
+                if self.drain is None:
+                    self.not_full.wait()
+                    continue
+                self.not_full.release()
+                try:
+                    self.drain(self)
+                finally:
+                    self.not_full.acquire()
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+
+
+def put_in_process_queue(events_queue, item, policy, counters):
+    """
+    Apply the policy to a bounded multiprocessing queue.
+    The bound of a multiprocessing queue is a number of items, not events.
+    """
+    if policy == QUEUE_BLOCK:
+        events_queue.put(item)
+        return
+
+    while True:
+        try:
+            events_queue.put(item, False)
+            return
+        except Queue.Full:
+            pass
+        if policy == QUEUE_DROP_NEWEST:
+            counters['dropped'] += _events_number(item)
+            return
+        # QUEUE_DROP_OLDEST : we take the oldest item ourself
+        try:
+            oldest = events_queue.get(False)
+        except Queue.Empty:
+            continue
+        events_queue.task_done()
+        if oldest is StopIteration:
+            events_queue.put(oldest)
+            events_queue.put(item)
+            return
+        counters['dropped'] += _events_number(oldest)
@@ -0,0 +1,384 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+Registry of the watched directories
+
+The directories are stored in a node table : a node is an index in arrays
+giving its parent node, its watch descriptor and its first child and
+siblings, and in a list giving its name. The names are interned : a name
+shared by many directories ('src', '.git', '2010') is stored once. The
+full paths are not stored, they are built from the parents on demand and
+the recently used ones are cached. The cache is an approximate LRU made of
+two generations of plain dicts, cheap enough to be used for every event :
+a path found in the old generation moves to the new one, and the old
+generation is dropped when the new one is full.
+
+It takes about half the memory of mapping the watch descriptors to the
+paths and the other way round, where most of the bytes are the same
+prefixes repeated (see WatchRegistry.memory_usage).
+"""
+
+import sys
+import array
+
+
+# number of paths kept by the paths cache of a registry
+PATHS_CACHE_SIZE = 4096
+
+# no node, no watch descriptor
+_NONE = -1
+
+# approximate size of the dicts items (see WatchRegistry.memory_usage)
+_INT_SIZE = sys.getsizeof(1 << 20)
+_KEY_SIZE = sys.getsizeof((0, '')) + _INT_SIZE
+
+
+def _split(path):
+    """
+    Returns the components of 'path', the root of an absolute path being '/'
+    ('/data/a/' -> ['/', 'data', 'a'], 'data/a' -> ['data', 'a'])
+    """
+    components = [ component for component in path.split('/') if component ]
+    if path.startswith('/'):
+        components.insert(0, '/')
+    return components
+
+
+def _intern(name):
+    """
+    Share the names of the nodes (unicode paths can't be interned)
+    """
+    if type(name) is str:
+        return intern(name)
+    return name
+
+
+class WatchRegistry(object):
+    """
+    Maps watch descriptors to paths and paths to watch descriptors.
+
+    Removing a directory and its children only looks at the directories
+    of the subtree, and never mistakes '/data/ab' for a child of '/data/a'.
+    """
+
+    def __init__(self, cache_size=PATHS_CACHE_SIZE):
+        """ init """
+        self.cache_size = cache_size
+        # node 0 is above '/' and the first component of the relative paths
+        self._parents = array.array('l', [ _NONE ])
+        self._wds = array.array('l', [ _NONE ])
+        self._first_child = array.array('l', [ _NONE ])
+        self._next_sibling = array.array('l', [ _NONE ])
+        self._prev_sibling = array.array('l', [ _NONE ])
+        self._names = [ None ]
+        self._names_size = 0
+        # (parent node, name) -> node
+        self._children = {}
+        self._wd_to_node = {}
+        # nodes to reuse
+        self._free = array.array('l')
+        # node -> path, the two generations of the paths cache
+        self._recent_paths = {}
+        self._older_paths = {}
+
+
+    def __len__(self):
+        """ Number of watched directories """
+        return len(self._wd_to_node)
+
+
+    def __contains__(self, path):
+        """ Is 'path' watched ? """
+        node = self._find(path)
+        return node is not None and self._wds[node] != _NONE
+
+
+    def _find(self, path):
+        """
+        Returns the node of 'path', or None
+        """
+        node = 0
+        children = self._children
+        for component in _split(path):
+            node = children.get((node, component))
+            if node is None:
+                return None
+        return node
+
+
+    def _new_node(self, parent, name):
+        """
+        Returns a new child 'name' of the node 'parent'
+        """
+        name = _intern(name)
+        if self._free:
+            node = self._free.pop()
+            self._parents[node] = parent
+            self._names[node] = name
+        else:
+            node = len(self._names)
+            self._parents.append(parent)
+            self._wds.append(_NONE)
+            self._first_child.append(_NONE)
+            self._next_sibling.append(_NONE)
+            self._prev_sibling.append(_NONE)
+            self._names.append(name)
+        self._names_size += sys.getsizeof(name)
+        self._link(node)
+        return node
+
+
+    def _link(self, node):
+        """
+        Add 'node' to the children of its parent
+        """
+        parent = self._parents[node]
+        first = self._first_child[parent]
+        self._next_sibling[node] = first
+        self._prev_sibling[node] = _NONE
+        if first != _NONE:
+            self._prev_sibling[first] = node
+        self._first_child[parent] = node
+        self._children[(parent, self._names[node])] = node
+
+
+    def _unlink(self, node):
+        """
+        Remove 'node' from the children of its parent
+        """
+        parent = self._parents[node]
+        previous = self._prev_sibling[node]
+        following = self._next_sibling[node]
+        if previous == _NONE:
+            self._first_child[parent] = following
+        else:
+            self._next_sibling[previous] = following
+        if following != _NONE:
+            self._prev_sibling[following] = previous
+        del self._children[(parent, self._names[node])]
+
+
+    def _free_node(self, node):
+        """
+        Forget 'node', which has been unlinked
+        """
+        self._names_size -= sys.getsizeof(self._names[node])
+        self._names[node] = None
+        self._parents[node] = _NONE
+        self._wds[node] = _NONE
+        self._first_child[node] = _NONE
+        self._recent_paths.pop(node, None)
+        self._older_paths.pop(node, None)
+        self._free.append(node)
+
+
+    def _build_path(self, node):
+        """
+        Returns the path of 'node'
+        """
+        names = self._names
+        parents = self._parents
+        components = []
+        while node:
+            components.append(names[node])
+            node = parents[node]
+        components.reverse()
+        if components[0] == '/':
+            return '/' + '/'.join(components[1:])
+        return '/'.join(components)
+
+
+    def _path(self, node):
+        """
+        Returns the path of 'node', using the paths cache
+        """
+        path = self._recent_paths.get(node)
+        if path is None:
+            path = self._older_paths.get(node)
+            if path is None:
+                path = self._build_path(node)
+            if len(self._recent_paths) >= self.cache_size // 2:
+                self._older_paths = self._recent_paths
+                self._recent_paths = {}
+            self._recent_paths[node] = path
+        return path
+
+
+    def add(self, path, wd):
+        """
+        Register the watch descriptor 'wd' for 'path'
+        """
+        node = 0
+        children = self._children
+        for component in _split(path):
+            child = children.get((node, component))
+            if child is None:
+                child = self._new_node(node, component)
+            node = child
+
+        # inotify gives the same watch descriptor when the same directory is
+        # watched through two paths (symlinks). The last one wins.
+        previous = self._wd_to_node.get(wd)
+        if previous is not None and previous != node:
+            self._wds[previous] = _NONE
+            self._prune(previous)
+
+        if self._wds[node] != _NONE and self._wds[node] != wd:
+            del self._wd_to_node[self._wds[node]]
+        self._wds[node] = wd
+        self._wd_to_node[wd] = node
+
+
+    def get_path(self, wd):
+        """
+        Returns the path watched by 'wd'. Raise KeyError if unknown.
+        """
+        return self._path(self._wd_to_node[wd])
+
+
+    def get_wd(self, path):
+        """
+        Returns the watch descriptor of 'path'. Raise KeyError if unknown.
+        """
+        node = self._find(path)
+        if node is None or self._wds[node] == _NONE:
+            raise KeyError(path)
+        return self._wds[node]
+
+
+    def paths(self):
+        """
+        Returns the list of the watched paths
+        """
+        return [ self._build_path(node) for node in self._wd_to_node.itervalues() ]
+
+
+    def _prune(self, node):
+        """
+        Remove 'node' and its unwatched ancestors if they have no children anymore
+        """
+        while node and self._wds[node] == _NONE and self._first_child[node] == _NONE:
+            parent = self._parents[node]
+            self._unlink(node)
+            self._free_node(node)
+            node = parent
+
+
+    def _subtree(self, top):
+        """
+        Returns the list of the nodes of the subtree of 'top', 'top' first
+        """
+        first_child = self._first_child
+        next_sibling = self._next_sibling
+        nodes = []
+        stack = [ top ]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            child = first_child[node]
+            while child != _NONE:
+                stack.append(child)
+                child = next_sibling[child]
+        return nodes
+
+
+    def _remove(self, top):
+        """
+        Forget the subtree of 'top', without pruning its parent.
+        Returns the list of the watch descriptors removed.
+        """
+        removed = []
+        nodes = self._subtree(top)
+        for node in nodes:
+            wd = self._wds[node]
+            if wd != _NONE:
+                removed.append(wd)
+                del self._wd_to_node[wd]
+        for node in nodes[1:]:
+            del self._children[(self._parents[node], self._names[node])]
+            self._free_node(node)
+        if top:
+            self._unlink(top)
+            self._free_node(top)
+        else:
+            self._first_child[top] = _NONE
+        return removed
+
+
+    def remove_subtree(self, path):
+        """
+        Forget 'path' and every watched directory under it.
+        Returns the list of the watch descriptors removed.
+        """
+        top = self._find(path)
+        if top is None:
+            return []
+        parent = self._parents[top]
+        removed = self._remove(top)
+        if top:
+            self._prune(parent)
+        return removed
+
+
+    def rename(self, src, dst):
+        """
+        'src' has been renamed 'dst' : move its subtree, keeping the watch
+        descriptors (inotify watches follow the inodes).
+        Anything registered at 'dst' must have been removed before.
+        Returns False if 'src' is unknown.
+        """
+        node = self._find(src)
+        if not node:
+            return False
+
+        parent = self._parents[node]
+        self._unlink(node)
+        self._prune(parent)
+
+        components = _split(dst)
+        parent = 0
+        for component in components[:-1]:
+            child = self._children.get((parent, component))
+            if child is None:
+                child = self._new_node(parent, component)
+            parent = child
+        name = _intern(components[-1])
+        if (parent, name) in self._children:
+            self._remove(self._children[(parent, name)])
+        self._names_size += sys.getsizeof(name) - sys.getsizeof(self._names[node])
+        self._names[node] = name
+        self._parents[node] = parent
+        self._link(node)
+
+        # the paths of the whole subtree changed
+        self._recent_paths = {}
+        self._older_paths = {}
+        return True
+
+
+    def memory_usage(self):
+        """
+        Returns the approximate number of bytes used by the registry.
+        The interned names are counted once per node.
+        """
+        size = sys.getsizeof(self)
+        for table in (self._parents, self._wds, self._first_child, self._next_sibling,
+                      self._prev_sibling, self._free):
+            size += table.buffer_info()[1] * table.itemsize
+        size += sys.getsizeof(self._names) + self._names_size
+        size += sys.getsizeof(self._children) + len(self._children) * _KEY_SIZE
+        size += sys.getsizeof(self._wd_to_node) + len(self._wd_to_node) * 2 * _INT_SIZE
+        for cache in (self._recent_paths, self._older_paths):
+            size += sys.getsizeof(cache)
+            for path in cache.itervalues():
+                size += sys.getsizeof(path) + _INT_SIZE
+        return size
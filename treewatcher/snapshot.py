@@ -0,0 +1,493 @@
+#-*- coding: utf-8 -*-
+#
+# Copyright (c) 2010 Jean-Baptiste Denis.
+#
+# This is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 3 and superior as published by the Free
+# Software Foundation.
+#
+# A copy of the license has been included in the COPYING file.
+
+
+"""
+In-memory snapshot of the watched trees, used to find out what we missed.
+
+For each directory, the snapshot keeps the (inode, mtime, size, is_dir)
+quadruplet of its entries. A Rescan lists the directories of a tree again
+and reports the differences with the snapshot as events, updating it on
+the way : this is how the inotify monitors recover from a kernel queue
+overflow (see InotifyxSourceTreeMonitor.set_overflow_resync).
+
+The snapshot can be saved in a file and loaded at the next start (see
+InotifyxSourceTreeMonitor.set_snapshot_file). The rescan of a tree then
+only lists the directories whose mtime changed while we were down.
+
+The file is made of a header followed by one record per directory :
+
+    (mtime, path length, entries number) path
+    (inode, mtime, size, is_dir, name length) name   for each entry
+
+It is read through mmap : the records are decoded from the mapping into
+the dicts of the snapshot, without reading the whole file in a string first.
+"""
+
+import os
+import stat
+import mmap
+import Queue
+import struct
+import collections
+
+from treewatcher import EVENT_CREATE, EVENT_DELETE, EVENT_CLOSE_WRITE
+from treewatcher.crawler import scandir
+
+
+_FILE_HEADER = 'TWSNAP1\n'
+_DIR_STRUCT = struct.Struct('<dII')
+_ENTRY_STRUCT = struct.Struct('<QdQBH')
+# mtime of a directory whose listing mtime is unknown
+_NO_MTIME = -1.0
+
+
+class SnapshotFileError(Exception):
+    """
+    The snapshot file is not valid
+    """
+    pass
+
+
+def _entry(st):
+    """
+    Returns the snapshot entry of a stat result
+    """
+    return (st.st_ino, st.st_mtime, st.st_size, stat.S_ISDIR(st.st_mode))
+
+
+def stat_entry(path):
+    """
+    Returns the snapshot entry of 'path', None if it doesn't exist.
+    Symlinks are followed, like the crawler does.
+    """
+    try:
+        return _entry(os.stat(path))
+    except OSError:
+        pass
+    try:
+        # broken symlink
+        return _entry(os.lstat(path))
+    except OSError:
+        return None
+
+
+def _scan_dir_scandir(path):
+    """
+    scandir version of scan_dir
+    """
+    entries = {}
+    for dir_entry in scandir(path):
+        try:
+            st = dir_entry.stat()
+        except OSError:
+            try:
+                st = dir_entry.stat(follow_symlinks=False)
+            except OSError:
+                # already gone
+                continue
+        entries[dir_entry.name] = _entry(st)
+    return entries
+
+
+def _scan_dir_listdir(path):
+    """
+    os.listdir version of scan_dir
+    """
+    entries = {}
+    for name in os.listdir(path):
+        entry = stat_entry(os.path.join(path, name))
+        if entry is not None:
+            entries[name] = entry
+    return entries
+
+
+if scandir is not None:
+    _scan_dir = _scan_dir_scandir
+else:
+    _scan_dir = _scan_dir_listdir
+
+
+def scan_dir(path):
+    """
+    Returns the {name: entry} dict of the entries of 'path',
+    or None if the directory cannot be read.
+    """
+    try:
+        return _scan_dir(path)
+    except (OSError, IOError):
+        return None
+
+
+def ignore_event(code, path, is_dir):
+    """
+    on_event of the rescans whose events nobody wants (see Rescan),
+    like the first scan of a tree
+    """
+    pass
+
+
+class TreeSnapshot(object):
+    """
+    {directory path: {name: (inode, mtime, size, is_dir)}}
+    Only the directories added with add_dir, and their subdirs, are tracked.
+
+    'mtimes' keeps the mtime of each directory when it was listed : if it
+    didn't change, the listing is still valid.
+    """
+
+    def __init__(self):
+        """ init """
+        self.dirs = {}
+        self.mtimes = {}
+
+
+    def __len__(self):
+        """ Number of tracked directories """
+        return len(self.dirs)
+
+
+    def add_dir(self, path):
+        """
+        Track the directory 'path' (a root, usually)
+        """
+        self.dirs.setdefault(path, {})
+
+
+    def entries(self, path):
+        """
+        Returns the {name: entry} dict of the directory 'path', or None
+        """
+        return self.dirs.get(path)
+
+
+    def update(self, path):
+        """
+        Refresh the entry of 'path', if its parent directory is tracked
+        """
+        parent, name = os.path.split(path)
+        entries = self.dirs.get(parent)
+        if entries is None:
+            return
+        entry = stat_entry(path)
+        previous = entries.get(name)
+        if previous is not None and previous[3] and (entry is None or entry[0] != previous[0]):
+            self._forget_dir(path)
+        if entry is None:
+            entries.pop(name, None)
+            return
+        entries[name] = entry
+        if entry[3] and path not in self.dirs:
+            # the directory is going to be listed
+            self.dirs[path] = {}
+            self.mtimes[path] = entry[1]
+
+
+    def remove(self, path):
+        """
+        Forget 'path', and its content if it's a directory
+        """
+        parent, name = os.path.split(path)
+        entries = self.dirs.get(parent)
+        if entries is not None:
+            entries.pop(name, None)
+        self._forget_dir(path)
+
+
+    def rename(self, src, dst):
+        """
+        'src' has been renamed 'dst' : move its entry, and its content if
+        it's a directory. Anything tracked at 'dst' is forgotten.
+        """
+        src_parent, src_name = os.path.split(src)
+        dst_parent, dst_name = os.path.split(dst)
+        src_entries = self.dirs.get(src_parent)
+        if src_entries is not None:
+            entry = src_entries.pop(src_name, None)
+        else:
+            entry = None
+        self.remove(dst)
+        dst_entries = self.dirs.get(dst_parent)
+
+        if entry is None or dst_entries is None:
+            # we didn't know it, or we don't track its destination
+            self._forget_dir(src)
+            if dst_entries is not None:
+                self.update(dst)
+                # its content is unknown : it has to be listed
+                self.mtimes.pop(dst, None)
+            return
+
+        dst_entries[dst_name] = entry
+        stack = [ (src, dst) ]
+        while stack:
+            src, dst = stack.pop()
+            entries = self.dirs.pop(src, None)
+            if entries is None:
+                continue
+            self.dirs[dst] = entries
+            mtime = self.mtimes.pop(src, None)
+            if mtime is not None:
+                self.mtimes[dst] = mtime
+            stack.extend((os.path.join(src, name), os.path.join(dst, name))
+                         for name, entry in entries.iteritems() if entry[3])
+
+
+    def _forget_dir(self, path):
+        """
+        Forget the content of the directory 'path' and of its subdirs
+        """
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            entries = self.dirs.pop(path, None)
+            self.mtimes.pop(path, None)
+            if entries:
+                stack.extend(os.path.join(path, name) for name, entry in entries.iteritems() if entry[3])
+
+
+    def save(self, filename, roots):
+        """
+        Write the trees of 'roots' in 'filename'
+        """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as snapshot_file:
+            write = snapshot_file.write
+            write(_FILE_HEADER)
+            stack = [ root for root in roots if root in self.dirs ]
+            while stack:
+                path = stack.pop()
+                entries = self.dirs[path]
+                write(_DIR_STRUCT.pack(self.mtimes.get(path, _NO_MTIME), len(path), len(entries)))
+                write(path)
+                for name, entry in entries.iteritems():
+                    write(_ENTRY_STRUCT.pack(entry[0], entry[1], entry[2], entry[3], len(name)))
+                    write(name)
+                    if entry[3]:
+                        sub_path = os.path.join(path, name)
+                        if sub_path in self.dirs:
+                            stack.append(sub_path)
+        # never leave a truncated snapshot behind us
+        os.rename(tmp_filename, filename)
+
+
+    def load(self, filename):
+        """
+        Add the directories saved in 'filename' to the snapshot.
+        Raise SnapshotFileError if it's not a valid snapshot file.
+        """
+        with open(filename, 'rb') as snapshot_file:
+            try:
+                data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise SnapshotFileError('%s is empty' % filename)
+        try:
+            self._load(data, filename)
+        finally:
+            data.close()
+
+
+    def _load(self, data, filename):
+        """
+        Parse the content of a snapshot file
+        """
+        if data[:len(_FILE_HEADER)] != _FILE_HEADER:
+            raise SnapshotFileError('%s is not a snapshot file' % filename)
+        offset = len(_FILE_HEADER)
+        end = len(data)
+        dir_unpack, dir_size = _DIR_STRUCT.unpack_from, _DIR_STRUCT.size
+        entry_unpack, entry_size = _ENTRY_STRUCT.unpack_from, _ENTRY_STRUCT.size
+        try:
+            while offset < end:
+                mtime, path_len, count = dir_unpack(data, offset)
+                offset += dir_size
+                path = data[offset:offset + path_len]
+                offset += path_len
+                entries = {}
+                for _ in xrange(count):
+                    ino, entry_mtime, size, is_dir, name_len = entry_unpack(data, offset)
+                    offset += entry_size
+                    entries[data[offset:offset + name_len]] = (ino, entry_mtime, size, bool(is_dir))
+                    offset += name_len
+                if offset > end:
+                    raise SnapshotFileError('%s is truncated' % filename)
+                self.dirs[path] = entries
+                if mtime != _NO_MTIME:
+                    self.mtimes[path] = mtime
+        except struct.error:
+            raise SnapshotFileError('%s is truncated' % filename)
+
+
+class Rescan(object):
+    """
+    Incremental rescan of one tree of a snapshot (see step).
+
+    on_event(code, path, is_dir) is called for each difference found :
+     - EVENT_CREATE for a new entry, followed by EVENT_CLOSE_WRITE for a file,
+     - EVENT_DELETE for an entry which is gone (only the top of a removed tree),
+     - EVENT_CLOSE_WRITE for a file whose mtime or size changed,
+     - EVENT_DELETE then EVENT_CREATE for an entry replaced by another inode.
+    watch_dir(path), if given, is called for each directory before listing it.
+
+    If 'trust_mtime' is True, a directory whose mtime didn't change since it
+    was listed is not listed again : only its subdirs are checked, and its
+    files if 'stat_files' is True. Otherwise the files appended or rewritten
+    in place are not detected, since they don't change the mtime of their
+    directory.
+
+    The directories can be read by the threads of 'pool' ('workers' threads),
+    the snapshot is only updated by the thread calling step.
+
+    The entries rejected by 'path_filter' (see filters.py) are kept out of
+    the snapshot, as if they didn't exist.
+    """
+
+    def __init__(self, snapshot, root, on_event, watch_dir=None, trust_mtime=False,
+                 stat_files=False, pool=None, workers=1, path_filter=None):
+        """ init """
+        self.snapshot = snapshot
+        self.path_filter = path_filter
+        self.root = root
+        self.on_event = on_event
+        self.watch_dir = watch_dir
+        self.trust_mtime = trust_mtime
+        self.stat_files = stat_files
+        self.pool = pool
+        self.workers = workers
+        self.frontier = collections.deque([root])
+        self.dirs = 0
+        self._results = Queue.Queue()
+        self._in_flight = 0
+        snapshot.add_dir(root)
+
+
+    def done(self):
+        """
+        Returns True if every directory has been rescanned
+        """
+        return not self.frontier and not self._in_flight
+
+
+    def _created(self, path, is_dir):
+        """
+        Report a new entry
+        """
+        self.on_event(EVENT_CREATE, path, is_dir)
+        if not is_dir:
+            self.on_event(EVENT_CLOSE_WRITE, path, is_dir)
+
+
+    def _read_dir(self, path):
+        """
+        Returns the (path, mtime, entries) triplet of the directory 'path'.
+        entries is None if it's gone, and it's the snapshot listing itself
+        if it's still valid. It only reads the snapshot : it can run in a thread.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return path, None, None
+        old_entries = self.snapshot.dirs.get(path)
+        if not self.trust_mtime or old_entries is None or self.snapshot.mtimes.get(path) != mtime:
+            return path, mtime, scan_dir(path)
+        if not self.stat_files:
+            return path, mtime, old_entries
+        entries = {}
+        for name, entry in old_entries.items():
+            if not entry[3]:
+                entry = stat_entry(os.path.join(path, name))
+                if entry is None:
+                    continue
+            entries[name] = entry
+        return path, mtime, entries
+
+
+    def _apply(self, path, mtime, new_entries):
+        """
+        Compare the entries read by _read_dir with the snapshot and report the differences
+        """
+        if new_entries is None:
+            # gone or unreadable : its parent will tell
+            return
+        snapshot = self.snapshot
+        old_entries = snapshot.dirs.get(path) or {}
+        if new_entries is old_entries:
+            self.frontier.extend(os.path.join(path, name)
+                                 for name, entry in old_entries.iteritems() if entry[3])
+            return
+        if self.path_filter is not None:
+            accepts = self.path_filter.accepts
+            new_entries = dict((name, entry) for name, entry in new_entries.iteritems()
+                               if accepts(os.path.join(path, name), entry[3]))
+        snapshot.dirs[path] = new_entries
+        snapshot.mtimes[path] = mtime
+
+        for name, old in old_entries.iteritems():
+            if name not in new_entries:
+                sub_path = os.path.join(path, name)
+                if old[3]:
+                    snapshot._forget_dir(sub_path)
+                self.on_event(EVENT_DELETE, sub_path, old[3])
+
+        for name, new in new_entries.iteritems():
+            sub_path = os.path.join(path, name)
+            old = old_entries.get(name)
+            if old is None:
+                self._created(sub_path, new[3])
+            elif old[0] != new[0] or old[3] != new[3]:
+                if old[3]:
+                    snapshot._forget_dir(sub_path)
+                self.on_event(EVENT_DELETE, sub_path, old[3])
+                self._created(sub_path, new[3])
+            elif not new[3] and (old[1] != new[1] or old[2] != new[2]):
+                self.on_event(EVENT_CLOSE_WRITE, sub_path, False)
+            if new[3]:
+                # the files of a subdir may have changed even if its
+                # listing didn't : we always go down
+                self.frontier.append(sub_path)
+
+
+    def _next_dir(self):
+        """
+        Returns the next directory to read, after watching it
+        """
+        # depth first, to bound the frontier
+        path = self.frontier.pop()
+        if self.watch_dir is not None:
+            self.watch_dir(path)
+        return path
+
+
+    def step(self, max_dirs=None):
+        """
+        Rescan at most 'max_dirs' directories (all of them if None).
+        Returns True when the rescan is over.
+        """
+        listed = 0
+        while True:
+            if self.pool is not None:
+                # keep every thread busy, with a small backlog
+                while self.frontier and self._in_flight < 2 * self.workers and \
+                      (max_dirs is None or listed + self._in_flight < max_dirs):
+                    self.pool.apply_async(self._read_dir, (self._next_dir(),), callback=self._results.put)
+                    self._in_flight += 1
+                if not self._in_flight:
+                    break
+                result = self._results.get()
+                self._in_flight -= 1
+            else:
+                if not self.frontier or (max_dirs is not None and listed >= max_dirs):
+                    break
+                result = self._read_dir(self._next_dir())
+            listed += 1
+            self._apply(*result)
+        self.dirs += listed
+        return self.done()